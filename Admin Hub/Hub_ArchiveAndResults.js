@@ -163,25 +163,266 @@ function csvFromRows_(rows) {
   return rows.map(r => (r || []).map(esc).join(',')).join('\n');
 }
 
-/** Download latest webhook CSV (GCS) and rotate it into processed path. */
+/**
+ * Fold append-only webhook segments (<path>.segments/*.csv, written when an
+ * agent runs with "storage_mode": "segments") into the live CSV via GCS compose.
+ * Mirrors compact_segments() in services_router-webhook/gcs_segments.py.
+ * Returns the number of segments folded (0 when the target is not segmented).
+ */
+function gcsComposeSegments_() {
+  const token = ScriptApp.getOAuthToken();
+  const bucket = CFG().GCS_BUCKET, path = CFG().GCS_RESULTS_PATH;
+  const base = `https://storage.googleapis.com/storage/v1/b/${bucket}/o`;
+  const prefix = path + '.segments/';
+  const header = prefix + '_header.csv';
+  const COMPOSE_LIMIT = 32;
+
+  // list pending segments (oldest first – names start with epoch ms)
+  let names = [], pageToken = '';
+  do {
+    const url = `${base}?prefix=${encodeURIComponent(prefix)}&fields=items(name),nextPageToken` +
+      (pageToken ? `&pageToken=${encodeURIComponent(pageToken)}` : '');
+    const res = UrlFetchApp.fetch(url, {
+      headers: { Authorization: 'Bearer ' + token },
+      muteHttpExceptions: true
+    });
+    if (res.getResponseCode() !== 200) return 0;
+    const j = JSON.parse(res.getContentText() || '{}');
+    (j.items || []).forEach(it => { if (it.name !== header) names.push(it.name); });
+    pageToken = j.nextPageToken || '';
+  } while (pageToken);
+  names.sort();
+
+  let folded = 0;
+  while (names.length) {
+    // live object (if any) is the head; otherwise start from the header segment
+    const meta = UrlFetchApp.fetch(`${base}/${encodeURIComponent(path)}?fields=generation`, {
+      headers: { Authorization: 'Bearer ' + token },
+      muteHttpExceptions: true
+    });
+    const live = meta.getResponseCode() === 200;
+    const gen = live ? JSON.parse(meta.getContentText() || '{}').generation : 0;
+
+    const batch = names.slice(0, COMPOSE_LIMIT - 1);
+    const sources = [{ name: live ? path : header }].concat(batch.map(n => ({ name: n })));
+    const res = UrlFetchApp.fetch(
+      `${base}/${encodeURIComponent(path)}/compose?ifGenerationMatch=${encodeURIComponent(gen)}`, {
+        method: 'post',
+        contentType: 'application/json',
+        headers: { Authorization: 'Bearer ' + token },
+        payload: JSON.stringify({ sourceObjects: sources, destination: { contentType: 'text/csv' } }),
+        muteHttpExceptions: true
+      });
+    if (res.getResponseCode() !== 200) {
+      Logger.log(`Segment compose failed (${res.getResponseCode()}): ${res.getContentText()}`);
+      break;
+    }
+
+    batch.forEach(n => UrlFetchApp.fetch(`${base}/${encodeURIComponent(n)}`, {
+      method: 'delete',
+      headers: { Authorization: 'Bearer ' + token },
+      muteHttpExceptions: true
+    }));
+    folded += batch.length;
+    names = names.slice(batch.length);
+  }
+  return folded;
+}
+
+/**
+ * Sealed-segment rollover (writers with "storage_mode": "rollover", see
+ * services_router-webhook/gcs_rollover.py – handoff() there is the same
+ * protocol):
+ *   1. advance <path>.rollover/_open from N to N+1 (ifGenerationMatch), so
+ *      writers move on to a fresh segment;
+ *   2. seal every segment <= N with a metadata patch – that bumps its
+ *      metageneration, which fails any writer upload still in flight;
+ *   3. download the sealed generation, copy it to /processed, delete it.
+ * The open segment is never read or touched, so this can run as often as
+ * we like while webhooks keep arriving.
+ * Returns the sealed segments' CSV texts, oldest first ([] when the target
+ * is not in rollover mode or nothing was pending).
+ */
+function gcsRolloverHandoff_() {
+  const token = ScriptApp.getOAuthToken();
+  const bucket = CFG().GCS_BUCKET, path = CFG().GCS_RESULTS_PATH;
+  const base = `https://storage.googleapis.com/storage/v1/b/${bucket}/o`;
+  const prefix = path + '.rollover/';
+  const pointer = prefix + '_open';
+  const auth = { Authorization: 'Bearer ' + token };
+
+  // 1) read + advance the open-segment pointer
+  const meta = UrlFetchApp.fetch(`${base}/${encodeURIComponent(pointer)}?fields=generation`, {
+    headers: auth,
+    muteHttpExceptions: true
+  });
+  if (meta.getResponseCode() !== 200) return [];
+  const pgen = JSON.parse(meta.getContentText() || '{}').generation;
+  const cur = UrlFetchApp.fetch(
+    `${base}/${encodeURIComponent(pointer)}?alt=media&generation=${encodeURIComponent(pgen)}`, {
+      headers: auth,
+      muteHttpExceptions: true
+    });
+  if (cur.getResponseCode() !== 200) return [];
+  const open = parseInt(cur.getContentText(), 10);
+  const adv = UrlFetchApp.fetch(
+    `https://storage.googleapis.com/upload/storage/v1/b/${bucket}/o` +
+    `?uploadType=media&name=${encodeURIComponent(pointer)}&ifGenerationMatch=${encodeURIComponent(pgen)}`, {
+      method: 'post',
+      contentType: 'text/plain',
+      headers: auth,
+      payload: String(open + 1),
+      muteHttpExceptions: true
+    });
+  if (adv.getResponseCode() !== 200) {
+    Logger.log(`Rollover pointer not advanced (${adv.getResponseCode()}) – another ingestion is running?`);
+    return [];
+  }
+
+  // 2) every segment up to the old open one
+  let names = [], pageToken = '';
+  do {
+    const url = `${base}?prefix=${encodeURIComponent(prefix)}&fields=items(name),nextPageToken` +
+      (pageToken ? `&pageToken=${encodeURIComponent(pageToken)}` : '');
+    const res = UrlFetchApp.fetch(url, { headers: auth, muteHttpExceptions: true });
+    if (res.getResponseCode() !== 200) break;
+    const j = JSON.parse(res.getContentText() || '{}');
+    (j.items || []).forEach(it => {
+      const m = it.name.slice(prefix.length).match(/^(\d{10})\.csv$/);
+      if (m && Number(m[1]) <= open) names.push(it.name);
+    });
+    pageToken = j.nextPageToken || '';
+  } while (pageToken);
+  names.sort();
+
+  // 3) seal → download → archive → delete, each pinned to the sealed generation
+  const ts = Utilities.formatDate(new Date(), CFG().CT_TZ, "yyyy-MM-dd'T'HH-mm-ss");
+  const texts = [];
+  for (const name of names) {
+    const enc = encodeURIComponent(name);
+    const seal = UrlFetchApp.fetch(`${base}/${enc}?fields=generation`, {
+      method: 'patch',
+      contentType: 'application/json',
+      headers: auth,
+      payload: JSON.stringify({ metadata: { sealed: ts } }),
+      muteHttpExceptions: true
+    });
+    if (seal.getResponseCode() !== 200) continue; // consumed by an earlier run
+    const gen = encodeURIComponent(JSON.parse(seal.getContentText() || '{}').generation);
+
+    // any failure stops here: the segment stays sealed and is handed off next run
+    const media = UrlFetchApp.fetch(`${base}/${enc}?alt=media&generation=${gen}`, {
+      headers: auth,
+      muteHttpExceptions: true
+    });
+    if (media.getResponseCode() !== 200) {
+      Logger.log(`Rollover segment ${name} not downloaded (${media.getResponseCode()}); stopping the handoff.`);
+      break;
+    }
+    const seq = name.slice(prefix.length, prefix.length + 10);
+    const arc = encodeURIComponent(path.replace(/(^|\/)([^\/]+)$/, `$1processed/$2_${ts}_${seq}`));
+    const copy = UrlFetchApp.fetch(`${base}/${enc}/rewriteTo/b/${bucket}/o/${arc}?sourceGeneration=${gen}`, {
+      method: 'post',
+      headers: auth,
+      muteHttpExceptions: true
+    });
+    if (copy.getResponseCode() !== 200 || JSON.parse(copy.getContentText() || '{}').done === false) {
+      Logger.log(`Rollover segment ${name} not archived (${copy.getResponseCode()}); stopping the handoff.`);
+      break;
+    }
+    UrlFetchApp.fetch(`${base}/${enc}?ifGenerationMatch=${gen}`, {
+      method: 'delete',
+      headers: auth,
+      muteHttpExceptions: true
+    });
+    texts.push(media.getContentText('UTF-8'));
+  }
+  if (texts.length) Logger.log(`Handed off ${texts.length} sealed rollover segment(s) of ${path}.`);
+  return texts;
+}
+
+/**
+ * Dedupe key of a segmented target: the key_column its writers store in the
+ * metadata of <path>.segments/_header.csv (gcs_segments.py).  '' when the
+ * target is not segmented or is configured without a key.
+ */
+function gcsSegmentKeyColumn_() {
+  const bucket = CFG().GCS_BUCKET, path = CFG().GCS_RESULTS_PATH;
+  const header = encodeURIComponent(path + '.segments/_header.csv');
+  const res = UrlFetchApp.fetch(`https://storage.googleapis.com/storage/v1/b/${bucket}/o/${header}?fields=metadata`, {
+    headers: { Authorization: 'Bearer ' + ScriptApp.getOAuthToken() },
+    muteHttpExceptions: true
+  });
+  if (res.getResponseCode() !== 200) return '';
+  return String((JSON.parse(res.getContentText() || '{}').metadata || {}).key_column || '');
+}
+
+/**
+ * Keep only the last row per `key` value, at the position of that last
+ * occurrence – the writers' merge_csv_stream() semantics (gcs_csv.py), which
+ * a composed segment CSV skipped.  Unchanged when the CSV has no such column.
+ */
+function csvDedupeByKey_(text, key) {
+  const rows = Utilities.parseCsv(text);
+  const k = rows && rows.length ? rows[0].indexOf(key) : -1;
+  if (k < 0) return text;
+  const data = rows.slice(1);
+  const lastIdx = {};
+  data.forEach((r, i) => { lastIdx[r[k]] = i; });
+  const kept = data.filter((r, i) => lastIdx[r[k]] === i);
+  if (kept.length === data.length) return text;
+  Logger.log(`Dropped ${data.length - kept.length} superseded row(s) by ${key}.`);
+  return csvFromRows_([rows[0]].concat(kept));
+}
+
+/** Concatenate CSV texts whose headers may differ (columns = union, first-seen order). */
+function csvConcat_(texts) {
+  if (texts.length === 1) return texts[0];
+  const tables = texts.map(t => Utilities.parseCsv(t)).filter(t => t && t.length);
+  const headers = [];
+  tables.forEach(t => t[0].forEach(h => { if (headers.indexOf(h) < 0) headers.push(h); }));
+  const out = [headers];
+  tables.forEach(t => {
+    const idx = headers.map(h => t[0].indexOf(h));
+    t.slice(1).forEach(r => out.push(idx.map(i => (i < 0 ? '' : r[i]))));
+  });
+  return csvFromRows_(out);
+}
+
+/**
+ * Download latest webhook CSV (GCS) and rotate it into processed path.
+ * Rollover targets hand over their sealed segments instead; a live CSV
+ * left from before the switch is still consumed (first, as the oldest rows).
+ */
 function gcsDownloadAndRotate_() {
   const token = ScriptApp.getOAuthToken();
   const bucket = CFG().GCS_BUCKET, path = CFG().GCS_RESULTS_PATH;
   const base = `https://storage.googleapis.com/storage/v1/b/${bucket}/o`;
   const enc = encodeURIComponent(path);
 
+  const sealed = gcsRolloverHandoff_();
+  const done = (texts) => (texts.length ? Utilities.newBlob(csvConcat_(texts), 'text/csv', path) : null);
+
+  // segmented writers → one logical CSV
+  const folded = gcsComposeSegments_();
+  if (folded) Logger.log(`Composed ${folded} webhook segment(s) into ${path}.`);
+
   // exist?
   const meta = UrlFetchApp.fetch(`${base}/${enc}?fields=size`, {
     headers: { Authorization: 'Bearer ' + token },
     muteHttpExceptions: true
   });
-  if (meta.getResponseCode() !== 200) return null;
+  if (meta.getResponseCode() !== 200) return done(sealed);
 
   // download
   const media = UrlFetchApp.fetch(`${base}/${enc}?alt=media`, {
     headers: { Authorization: 'Bearer ' + token }
   });
-  const blob = media.getBlob();
+  let blob = media.getBlob();
+
+  // composed segments were never deduped by the writers
+  const key = gcsSegmentKeyColumn_();
+  if (key) blob = Utilities.newBlob(csvDedupeByKey_(blob.getDataAsString('UTF-8'), key), 'text/csv', path);
 
   // archive copy
   const ts = Utilities.formatDate(new Date(), CFG().CT_TZ, "yyyy-MM-dd'T'HH-mm-ss");
@@ -197,7 +438,70 @@ function gcsDownloadAndRotate_() {
     headers: { Authorization: 'Bearer ' + token }
   });
 
-  return blob;
+  return sealed.length ? done([blob.getDataAsString('UTF-8')].concat(sealed)) : blob;
+}
+
+/**
+ * Incremental read of a change-feed target (writers with "storage_mode": "feed",
+ * see services_router-webhook/gcs_feed.py): chunk objects <path>.feed/<seq>.csv
+ * named by the sequence number of their first row, carrying their row count
+ * in metadata.rows.  Lists from the stored cursor and downloads only the new
+ * chunks, so a poll costs what was appended since the last one.
+ * Returns null when the target has no feed, else { texts, next } – persist
+ * `next` with gcsFeedCommit_() once the rows are safely ingested.
+ */
+function gcsFeedSince_() {
+  const token = ScriptApp.getOAuthToken();
+  const bucket = CFG().GCS_BUCKET, path = CFG().GCS_RESULTS_PATH;
+  const base = `https://storage.googleapis.com/storage/v1/b/${bucket}/o`;
+  const prefix = path + '.feed/';
+  const auth = { Authorization: 'Bearer ' + token };
+  const MAX_CHUNKS = 2000; // per poll; the rest is picked up next time
+
+  const head = UrlFetchApp.fetch(`${base}/${encodeURIComponent(prefix + '_head')}?fields=generation`, {
+    headers: auth,
+    muteHttpExceptions: true
+  });
+  if (head.getResponseCode() !== 200) return null;
+
+  const cursor = Number(PropertiesService.getScriptProperties().getProperty('WEBHOOK_FEED_CURSOR:' + path) || 0);
+  const pad = n => ('000000000000' + n).slice(-12);
+  let next = cursor, texts = [], pageToken = '', done = false;
+  do {
+    const url = `${base}?prefix=${encodeURIComponent(prefix)}` +
+      `&startOffset=${encodeURIComponent(prefix + pad(cursor) + '.csv')}` +
+      `&fields=items(name,metadata),nextPageToken` +
+      (pageToken ? `&pageToken=${encodeURIComponent(pageToken)}` : '');
+    const res = UrlFetchApp.fetch(url, { headers: auth, muteHttpExceptions: true });
+    if (res.getResponseCode() !== 200) break;
+    const j = JSON.parse(res.getContentText() || '{}');
+    for (const it of (j.items || [])) {
+      const m = it.name.slice(prefix.length).match(/^(\d{12})\.csv$/);
+      if (!m) continue;
+      const start = Number(m[1]);
+      if (start !== next) {
+        if (next !== cursor) { done = true; break; } // being created – next poll
+        Logger.log(`Feed cursor ${cursor} is before the oldest retained chunk (${start}); resuming there.`);
+      }
+      const media = UrlFetchApp.fetch(`${base}/${encodeURIComponent(it.name)}?alt=media`, {
+        headers: auth,
+        muteHttpExceptions: true
+      });
+      if (media.getResponseCode() !== 200) { done = true; break; }
+      texts.push(media.getContentText('UTF-8'));
+      next = start + Number((it.metadata || {}).rows || 0);
+      if (texts.length >= MAX_CHUNKS) { done = true; break; }
+    }
+    pageToken = j.nextPageToken || '';
+  } while (pageToken && !done);
+
+  if (texts.length) Logger.log(`Feed ${path}: ${texts.length} chunk(s), cursor ${cursor} → ${next}.`);
+  return { texts: texts, next: next };
+}
+
+/** Persist the feed cursor after a successful ingest. */
+function gcsFeedCommit_(next) {
+  PropertiesService.getScriptProperties().setProperty('WEBHOOK_FEED_CURSOR:' + CFG().GCS_RESULTS_PATH, String(next));
 }
 
 /** Next Call Date logic */
@@ -246,16 +550,20 @@ function hubIngestWebhooks_() {
   }
   
   try {
+    // feed targets: only the chunks appended since the stored cursor
+    const feed = gcsFeedSince_();
     const blob = gcsDownloadAndRotate_();
-    if (!blob) {
-      Logger.log('No CSV found to ingest (gcsDownloadAndRotate_ returned null).');
+    const texts = (blob ? [blob.getDataAsString('UTF-8')] : []).concat(feed ? feed.texts : []);
+    if (!texts.length) {
+      Logger.log('No CSV found to ingest (gcsDownloadAndRotate_ returned null, no new feed rows).');
       return { ok: true, message: 'No new results to ingest.' };
     }
 
-    const csv = blob.getDataAsString('UTF-8');
+    const csv = csvConcat_(texts);
     const rows = Utilities.parseCsv(csv);
     if (!rows || rows.length < 2) {
       Logger.log('CSV had no data rows.');
+      if (feed) gcsFeedCommit_(feed.next);
       return { ok: true, message: 'No new results to ingest.' };
     }
 
@@ -337,6 +645,7 @@ function hubIngestWebhooks_() {
       _ing_setNextCallForPhones_(recallMap);
     }
 
+    if (feed) gcsFeedCommit_(feed.next);
     Logger.log('CSV fully consumed; live file removed (archived to /processed).');
     return { ok: true, message: `Successfully ingested ${outRows.length} results.` };
 
@@ -0,0 +1,304 @@
+"""
+bq_sink.py
+─────────────────────────────────────────────────────────────
+Background BigQuery sink for the per-call history rows.
+
+`log_to_bigquery` used to call `insert_rows_json(table, [row])` inline,
+one row per webhook, before the CSV work even started.  It now hands
+the row to a sink and returns immediately:
+
+* bounded in-memory queue (BQ_SINK_MAX_QUEUE rows);
+* one flusher thread that batches rows by count (BQ_SINK_BATCH_ROWS)
+  or age of the oldest row (BQ_SINK_MAX_AGE_MS) into a single
+  `insert_rows_json` call per table;
+* `call_id` is sent as the insertId so BigQuery de-duplicates Retell
+  redeliveries and our own retries;
+* when the queue is full BQ_SINK_POLICY decides: `drop_oldest`
+  (default), `drop_new`, or `block` (wait up to BQ_SINK_BLOCK_MS);
+* pending rows are flushed at interpreter exit;
+* only a sync sink (`confirms`) knows whether a row landed: there
+  submit() / submit_many() report the rows BigQuery accepted, so a
+  caller marks its "bigquery" stage done only then – an async hand-off
+  stays open and a redelivery resubmits (deduped by insertId);
+* a row may be a zero-argument callable returning the row
+  (payload_archive.history_row in gcs mode): the flusher calls it just
+  before the insert, BQ_SINK_PREPARE_THREADS at a time, so the payload
+  upload stays off the request path.  A row whose callable raises is
+  counted in failed_rows.
+
+BQ_SINK_MODE=sync restores the old inline insert.  Note that on Cloud
+Functions / Cloud Run the flusher only gets CPU while a request is in
+flight unless CPU is always allocated, so keep BQ_SINK_MAX_AGE_MS short.
+"""
+
+import atexit
+import collections
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import spans
+
+MODE = os.getenv("BQ_SINK_MODE", "async").lower()
+MAX_QUEUE = int(os.getenv("BQ_SINK_MAX_QUEUE", "10000"))
+BATCH_ROWS = int(os.getenv("BQ_SINK_BATCH_ROWS", "500"))
+MAX_AGE = float(os.getenv("BQ_SINK_MAX_AGE_MS", "500")) / 1000
+POLICY = os.getenv("BQ_SINK_POLICY", "drop_oldest").lower()
+BLOCK_TIMEOUT = float(os.getenv("BQ_SINK_BLOCK_MS", "2000")) / 1000
+PREPARE_THREADS = int(os.getenv("BQ_SINK_PREPARE_THREADS", "8"))
+
+
+class BigQuerySink:
+    """
+    `client_factory()` must return a BigQuery client (or anything exposing
+    `insert_rows_json(table, rows, row_ids=...)`), or None when unavailable.
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[], Any],
+        mode: str = MODE,
+        max_queue: int = MAX_QUEUE,
+        batch_rows: int = BATCH_ROWS,
+        max_age: float = MAX_AGE,
+        policy: str = POLICY,
+        block_timeout: float = BLOCK_TIMEOUT,
+        prepare_threads: int = PREPARE_THREADS,
+    ):
+        self._client_factory = client_factory
+        self.mode = mode
+        self.max_queue = max_queue
+        self.batch_rows = batch_rows
+        self.max_age = max_age
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.prepare_threads = prepare_threads
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._flush_requested = False
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {
+            "enqueued": 0,
+            "inserted": 0,
+            "batches": 0,
+            "dropped": 0,
+            "failed_rows": 0,
+            "errors": 0,
+        }
+
+    # ─────────────────────── producer side ───────────────────────
+    @property
+    def confirms(self) -> bool:
+        """True when submit() returning True means the row is in BigQuery."""
+        return self.mode == "sync"
+
+    def submit(self, table: str, row: Dict[str, Any], insert_id: Optional[str] = None) -> bool:
+        """Queue one row; returns False if the row was dropped (sync: not inserted)."""
+        insert_id = insert_id or str(uuid.uuid4())
+        if self.mode == "sync":
+            return insert_id not in self._insert([(time.monotonic(), table, row, insert_id)])
+
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                if self.policy == "block":
+                    deadline = time.monotonic() + self.block_timeout
+                    while len(self._queue) >= self.max_queue:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats["dropped"] += 1
+                            return False
+                        self._cond.wait(remaining)
+                elif self.policy == "drop_new":
+                    self._stats["dropped"] += 1
+                    return False
+                else:  # drop_oldest
+                    self._queue.popleft()
+                    self._stats["dropped"] += 1
+            self._queue.append((time.monotonic(), table, row, insert_id))
+            self._stats["enqueued"] += 1
+            self._cond.notify_all()
+            self._ensure_thread()
+        return True
+
+    def submit_many(self, table: str, rows: Iterable[Tuple[Dict[str, Any], Optional[str]]]) -> Set[str]:
+        """Queue (row, insert_id) pairs for one table; returns the insert_ids kept (sync: inserted).
+
+        In sync mode they go out as one insert per BQ_SINK_BATCH_ROWS rows
+        instead of one per row (bulk ingestion).
+        """
+        items = [(row, insert_id or str(uuid.uuid4())) for row, insert_id in rows]
+        if self.mode != "sync":
+            return {insert_id for row, insert_id in items if self.submit(table, row, insert_id)}
+        now = time.monotonic()
+        lost: Set[str] = set()
+        for start in range(0, len(items), self.batch_rows):
+            lost |= self._insert([(now, table, row, iid) for row, iid in items[start : start + self.batch_rows]])
+        return {insert_id for _, insert_id in items} - lost
+
+    def _ensure_thread(self) -> None:
+        # started lazily (and re-started after fork) – caller holds _cond
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="bq-sink", daemon=True)
+            self._thread.start()
+
+    # ─────────────────────── flusher side ────────────────────────
+    def _next_batch(self) -> Optional[list]:
+        with self._cond:
+            while not self._queue:
+                if self._stopping:
+                    return None
+                self._cond.wait()
+
+            deadline = self._queue[0][0] + self.max_age
+            while (
+                len(self._queue) < self.batch_rows
+                and not (self._flush_requested or self._stopping)
+            ):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            n = min(self.batch_rows, len(self._queue))
+            batch = [self._queue.popleft() for _ in range(n)]
+            self._inflight += n
+            self._cond.notify_all()  # room for blocked producers
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._insert(batch)
+            finally:
+                with self._cond:
+                    self._inflight -= len(batch)
+                    if not self._queue and not self._inflight:
+                        self._flush_requested = False
+                    self._cond.notify_all()
+
+    def _prepare(self, batch: list) -> Tuple[list, Set[str]]:
+        """Call the batch's callable rows (concurrently); drops, counts and returns the ones that raise."""
+        lazy = [item for item in batch if callable(item[2])]
+        if not lazy:
+            return batch, set()
+
+        def build(item):
+            try:
+                return item[2]()
+            except Exception as exc:
+                print(f"bq_sink: building the row for {item[3]} failed: {exc}")
+                return None
+
+        if len(lazy) == 1 or self.prepare_threads <= 1:
+            built = [build(item) for item in lazy]
+        else:
+            with ThreadPoolExecutor(min(self.prepare_threads, len(lazy)), thread_name_prefix="bq-sink-prepare") as pool:
+                built = list(pool.map(build, lazy))
+        rows = {id(item): row for item, row in zip(lazy, built)}
+        out, failed = [], set()
+        for item in batch:
+            row = rows.get(id(item), item[2])
+            if row is None:
+                failed.add(item[3])
+                continue
+            out.append((item[0], item[1], row, item[3]))
+        if failed:
+            self._count(failed_rows=len(failed), errors=1)
+        return out, failed
+
+    def _insert(self, batch: list) -> Set[str]:
+        """Insert `batch`; returns the insert_ids that did not make it."""
+        prepared, lost = self._prepare(batch)
+        by_table: Dict[str, List] = collections.defaultdict(list)
+        for _, table, row, insert_id in prepared:
+            by_table[table].append((row, insert_id))
+
+        client = self._client_factory()
+        for table, items in by_table.items():
+            if client is None:
+                self._count(failed_rows=len(items), errors=1)
+                print(f"bq_sink: no BigQuery client – {len(items)} row(s) for {table} lost")
+                lost.update(insert_id for _, insert_id in items)
+                continue
+            t0 = time.perf_counter()
+            try:
+                errors = client.insert_rows_json(
+                    table,
+                    [row for row, _ in items],
+                    row_ids=[insert_id for _, insert_id in items],
+                )
+            except Exception as exc:
+                self._count(failed_rows=len(items), errors=1)
+                print(f"bq_sink: insert of {len(items)} row(s) into {table} failed: {exc}")
+                lost.update(insert_id for _, insert_id in items)
+                continue
+            # request stage in sync mode, "_background" from the flusher thread
+            spans.observe("bq_insert", (time.perf_counter() - t0) * 1000)
+            self._count(batches=1, inserted=len(items) - len(errors or []))
+            if errors:
+                self._count(failed_rows=len(errors), errors=1)
+                print(f"bq_sink: BigQuery insert errors for {table}: {errors}")
+                # each error names its row by index; without one, assume the whole request
+                failed_at = {e.get("index") if isinstance(e, dict) else None for e in errors}
+                if None in failed_at:
+                    failed_at = set(range(len(items)))
+                lost.update(items[i][1] for i in failed_at if isinstance(i, int) and 0 <= i < len(items))
+        return lost
+
+    def _count(self, **deltas: int) -> None:
+        with self._cond:
+            for name, n in deltas.items():
+                self._stats[name] += n
+
+    # ───────────────────────── control ───────────────────────────
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Push out everything queued so far; True if drained within timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if not (self._queue or self._inflight):
+                return True
+            self._flush_requested = True
+            self._ensure_thread()
+            self._cond.notify_all()
+            while self._queue or self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 10.0) -> None:
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {**self._stats, "queued": len(self._queue), "inflight": self._inflight}
+
+
+# ─────────────────────── Process-wide sink ───────────────────────
+_sink: Optional[BigQuerySink] = None
+_sink_lock = threading.Lock()
+
+
+def get_sink(client_factory: Callable[[], Any]) -> BigQuerySink:
+    """The shared sink, created on first use with `client_factory`."""
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = BigQuerySink(client_factory)
+                atexit.register(_sink.close)
+    return _sink
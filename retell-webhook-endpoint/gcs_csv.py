@@ -0,0 +1,339 @@
+"""
+gcs_csv.py
+─────────────────────────────────────────────────────────────
+Shared read-modify-write helpers for the webhook CSVs in GCS.
+
+* `merge_csv_stream` – pandas-free merge engine.  Streams the existing
+  CSV, applies last-write-wins dedupe on `key_column` with a dict keyed
+  on that column, and streams the result back out with QUOTE_ALL.
+  Memory is O(distinct keys), never O(file size) in DataFrames.
+* `read_modify_write` – optimistic-concurrency loop.  The CSV is
+  rewritten with `if_generation_match`, and the loser of a race gets a
+  quick local retry (re-fetch, re-merge, jittered exponential backoff)
+  instead of failing the request and waiting for Retell to redeliver.
+* `append_rows` – the two combined, behind an in-instance group commit
+  (see group_commit.py) so concurrent appends to the same object share
+  one download/merge/upload cycle; what every handler's
+  append_to_gcs_csv calls.  Keyed appends go through the persistent
+  key index (gcs_keyindex.py) instead, which falls back to this
+  read-modify-write whenever it cannot do better.
+
+Tunables (environment):
+  GCS_WRITE_MAX_ATTEMPTS   attempts per write          (default 8)
+  GCS_WRITE_BASE_DELAY     first backoff, seconds      (default 0.05)
+  GCS_WRITE_MAX_DELAY      backoff ceiling, seconds    (default 2.0)
+  GCS_SPOOL_MAX_BYTES      in-memory spool before disk (default 32 MiB)
+  GCS_GROUP_COMMIT_MS      extra batching window, ms   (default 0)
+  GCS_KEY_INDEX            key index for keyed appends (default on)
+"""
+
+import csv
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Any, BinaryIO, Callable, Dict, List, Optional
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+import spans
+from group_commit import GroupCommitter
+
+MAX_ATTEMPTS = int(os.getenv("GCS_WRITE_MAX_ATTEMPTS", "8"))
+BASE_DELAY = float(os.getenv("GCS_WRITE_BASE_DELAY", "0.05"))
+MAX_DELAY = float(os.getenv("GCS_WRITE_MAX_DELAY", "2.0"))
+SPOOL_MAX_BYTES = int(os.getenv("GCS_SPOOL_MAX_BYTES", str(32 * 1024 * 1024)))
+GROUP_COMMIT_WINDOW = float(os.getenv("GCS_GROUP_COMMIT_MS", "0")) / 1000
+
+# ───────────────────────── Counters ──────────────────────────
+_stats_lock = threading.Lock()
+_stats: Dict[str, int] = {
+    "writes": 0,     # successful uploads
+    "attempts": 0,   # upload attempts (successful or not)
+    "conflicts": 0,  # 412 generation-precondition failures
+    "exhausted": 0,  # writes that gave up after MAX_ATTEMPTS
+}
+
+
+def _bump(name: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[name] += n
+
+
+def retry_stats() -> Dict[str, int]:
+    """Snapshot of the process-wide write counters."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff for the given (1-based) attempt."""
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * (2 ** (attempt - 1))))
+
+
+# ───────────────────── Streaming merge engine ──────────────────────
+def _cell(value: Any) -> str:
+    return "" if value is None else str(value)
+
+
+class _Codec:
+    """
+    Re-usable single-record csv reader/writer.  Building a csv.reader/writer
+    per record costs more than the parse itself on the hot path.
+    """
+
+    def __init__(self):
+        self._pending: List[str] = []
+        self._reader = csv.reader(iter(self._pending.pop, None))
+        self._buf = io.StringIO()
+        self._writer = csv.writer(self._buf, quoting=csv.QUOTE_ALL, lineterminator="\n")
+
+    def parse(self, raw: bytes) -> List[str]:
+        text = raw.decode("utf-8")
+        if raw.count(b'"') % 2:
+            # unterminated quote (truncated tail) – parse standalone so the
+            # shared reader never waits for a continuation line
+            return next(csv.reader([text]), [])
+        self._pending.append(text)
+        return next(self._reader, [])
+
+    def format(self, fields: List[str]) -> bytes:
+        """One QUOTE_ALL record, LF-terminated (what pandas.to_csv produced)."""
+        self._buf.seek(0)
+        self._buf.truncate()
+        self._writer.writerow(fields)
+        return self._buf.getvalue().encode("utf-8")
+
+
+def _raw_records(fh: BinaryIO):
+    """Split a CSV byte stream into raw records (quoted fields may span lines)."""
+    fh.seek(0)
+    pending = b""
+    for line in fh:
+        if pending:
+            line = pending + line
+        if line.count(b'"') % 2:
+            pending = line  # still inside a quoted field
+            continue
+        pending = b""
+        yield line
+    if pending:
+        yield pending
+
+
+def _split_canonical(raw: bytes, width: int) -> Optional[List[bytes]]:
+    """
+    Fields of a record already in canonical form – every cell quoted, no
+    embedded quotes, LF-terminated – or None.  Canonical records can be
+    copied to the output byte-for-byte without a csv parse/re-serialise.
+    """
+    if raw[:1] == b'"' and raw[-2:] == b'"\n':
+        inner = raw[1:-2]
+        if inner.count(b'"') == 2 * (width - 1):
+            parts = inner.split(b'","')
+            if len(parts) == width:
+                return parts
+    return None
+
+
+def _records(existing: BinaryIO, headers: List[str], key_i: Optional[int], codec: _Codec):
+    """
+    Yield `(key, raw, fields)` for every existing data row.  `fields` is None
+    when `raw` is already canonical and can be copied as-is; otherwise it is
+    the row re-ordered to `headers` (missing columns → "", like
+    DataFrame.reindex) and must be re-serialised.
+    """
+    width = len(headers)
+    raws = (raw for raw in _raw_records(existing) if raw.strip())
+    header_raw = next(raws, None)
+    if header_raw is None:
+        return
+    file_headers = codec.parse(header_raw)
+
+    if file_headers == headers:
+        for raw in raws:
+            parts = _split_canonical(raw, width)
+            if parts is not None:
+                yield (parts[key_i].decode("utf-8") if key_i is not None else None), raw, None
+                continue
+            rec = codec.parse(raw)
+            if len(rec) != width:
+                rec = (rec + [""] * width)[:width]
+            yield (rec[key_i] if key_i is not None else None), raw, rec
+        return
+
+    # Header drift: project onto the current HEADERS
+    pos = {h: i for i, h in enumerate(file_headers)}
+    idx = [pos.get(h) for h in headers]
+    for raw in raws:
+        rec = codec.parse(raw)
+        rec = [rec[i] if i is not None and i < len(rec) else "" for i in idx]
+        yield (rec[key_i] if key_i is not None else None), raw, rec
+
+
+def merge_csv_stream(
+    existing: Optional[BinaryIO],
+    out: BinaryIO,
+    new_rows: List[Dict[str, Any]],
+    headers: List[str],
+    key_column: Optional[str],
+) -> int:
+    """
+    Write `existing` + `new_rows` to `out`, keeping only the last row per
+    `key_column` value (at the position of that last occurrence, exactly like
+    `drop_duplicates(keep="last")`).  Returns the number of rows written.
+
+    Two passes over the spooled input: the first builds {key: last ordinal}
+    and the (usually tiny) set of superseded ordinals, the second streams the
+    survivors out.  Rows already in canonical form are copied verbatim.
+    """
+    key_i = headers.index(key_column) if key_column in headers else None
+    fresh = [[_cell(r.get(h, "")) for h in headers] for r in new_rows]
+
+    last: Dict[str, int] = {}
+    dropped = set()
+
+    def see(key, i):
+        if key_i is None:
+            return
+        prev = last.get(key)
+        if prev is not None:
+            dropped.add(prev)
+        last[key] = i
+
+    codec = _Codec()
+    n_existing = 0
+    if existing is not None:
+        for n_existing, (key, _, _) in enumerate(_records(existing, headers, key_i, codec), 1):
+            see(key, n_existing - 1)
+    for i, rec in enumerate(fresh, n_existing):
+        see(rec[key_i] if key_i is not None else None, i)
+
+    out.write(codec.format(headers))
+    total = 0
+    if existing is not None:
+        for i, (_, raw, rec) in enumerate(_records(existing, headers, key_i, codec)):
+            if i not in dropped:
+                out.write(raw if rec is None else codec.format(rec))
+                total += 1
+    for i, rec in enumerate(fresh, n_existing):
+        if i not in dropped:
+            out.write(codec.format(rec))
+            total += 1
+    return total
+
+
+# ─────────────────── Optimistic-concurrency loop ───────────────────
+def read_modify_write(
+    bucket,
+    path: str,
+    merge: Callable[[Optional[BinaryIO], BinaryIO], int],
+    content_type: str = "text/csv",
+    max_attempts: int = None,
+    check: Callable[[Any, bool], None] = None,
+) -> int:
+    """
+    Apply `merge` to the current contents of gs://bucket/path and upload the
+    result, guarded by the generation that was read.
+
+    `merge(existing, out)` receives the spooled object (None when it does not
+    exist) and writes the new contents to `out`, returning the total row
+    count; it is re-run on every retry so the pending rows are merged into
+    the freshest copy.  Only 412 conflicts are retried – any other error
+    propagates immediately.  Returns the row count from the successful attempt.
+
+    `check(blob, exists)` runs after every download and may raise to abandon
+    the write (gcs_rollover.py: the segment was sealed).  With it the upload
+    is also pinned to the metageneration that was read, so a metadata-only
+    change fails it like a content change would.
+    """
+    max_attempts = max_attempts or MAX_ATTEMPTS
+
+    for attempt in range(1, max_attempts + 1):
+        blob = bucket.blob(path)  # fresh handle – no stale generation
+        with tempfile.SpooledTemporaryFile(SPOOL_MAX_BYTES) as src, \
+                tempfile.SpooledTemporaryFile(SPOOL_MAX_BYTES) as out:
+            with spans.span("gcs_download") as s:
+                try:
+                    blob.download_to_file(src)
+                    existing = src
+                except NotFound:
+                    existing = None
+                s.add_bytes(src.tell())
+            if check is not None:
+                check(blob, existing is not None)
+
+            with spans.span("csv_merge"):
+                total = merge(existing, out)
+            size = out.tell()
+            out.seek(0)
+
+            _bump("attempts")
+            pins = {"if_generation_match": blob.generation or 0}
+            if check is not None and existing is not None:
+                pins["if_metageneration_match"] = blob.metageneration
+            try:
+                with spans.span("gcs_upload", size):
+                    blob.upload_from_file(out, size=size, content_type=content_type, **pins)
+            except PreconditionFailed:
+                _bump("conflicts")
+                if attempt == max_attempts:
+                    _bump("exhausted")
+                    print(
+                        f"gcs_csv: gave up on gs://{bucket.name}/{path} "
+                        f"after {attempt} conflicting attempts"
+                    )
+                    raise
+                with spans.span("gcs_backoff"):
+                    time.sleep(_backoff(attempt))
+                continue
+
+        _bump("writes")
+        if attempt > 1:
+            print(
+                f"gcs_csv: gs://{bucket.name}/{path} written on "
+                f"attempt {attempt} after {attempt - 1} conflict(s)"
+            )
+        return total
+
+
+def _flush_batch(key, items) -> int:
+    _, path, headers, key_column = key
+    bucket = items[0][0]
+    rows = [row for _, row in items]
+    if key_column in headers:
+        import gcs_keyindex  # imports this module
+
+        if gcs_keyindex.ENABLED:
+            return gcs_keyindex.append(bucket, path, rows, list(headers), key_column)
+    return read_modify_write(
+        bucket,
+        path,
+        lambda existing, out: merge_csv_stream(existing, out, rows, list(headers), key_column),
+    )
+
+
+_committer = GroupCommitter(_flush_batch, window=GROUP_COMMIT_WINDOW)
+
+
+def group_commit_stats() -> Dict[str, int]:
+    return _committer.stats()
+
+
+def append_rows(
+    bucket,
+    path: str,
+    new_rows: List[Dict[str, Any]],
+    headers: List[str],
+    key_column: Optional[str] = None,
+) -> int:
+    """
+    Merge `new_rows` into gs://bucket/path; returns the resulting row count.
+    Concurrent callers for the same object are merged into one write.
+    """
+    key = (bucket.name, path, tuple(headers), key_column)
+    return _committer.submit(
+        key, [(bucket, row) for row in new_rows], lock_key=(bucket.name, path)
+    )
@@ -0,0 +1,199 @@
+"""
+gcs_feed.py
+─────────────────────────────────────────────────────────────
+Sequenced change feed per target: "rows since cursor N" without
+downloading the whole CSV.
+
+Every write appends one immutable chunk whose name is the sequence
+number of its first row:
+
+    raw_leads/inbound_webhook.csv.feed/000000000000.csv   rows 0-2
+    raw_leads/inbound_webhook.csv.feed/000000000003.csv   rows 3-3
+    raw_leads/inbound_webhook.csv.feed/000000000004.csv   rows 4-9
+    raw_leads/inbound_webhook.csv.feed/_head              "10"
+
+A chunk is a CSV with its header row and carries its row count in the
+`rows` metadata field, so chunk k+1 starts where chunk k ends and the
+numbering is contiguous and monotonic.
+
+Writers create the chunk at `_head` with if_generation_match=0.  If that
+number is taken (a writer whose `_head` bump has not landed yet), they
+follow the chain to the next free number and then advance `_head`.
+Chunks are never rewritten, and `_head` is only a hint – the chain is
+the truth.  A write is one `_head` read, one create and one
+conditional `_head` update, whatever the size of the feed.
+
+Readers list from startOffset=<chunk for cursor> and download only the
+chunks at or after it (`read_since`, the router's retell_webhook_feed
+route, or gcsFeedSince_ in Admin Hub/Hub_ArchiveAndResults.js).
+Cursors are the `next` values a read returns (chunk boundaries).  0
+means "from the oldest retained chunk".
+
+Retention: delete old chunks with a bucket lifecycle rule
+(age + matchesPrefix "<csv_path>.feed/" + matchesSuffix ".csv", so
+`_head` is kept) or with `trim()`.  A reader whose cursor falls before
+the oldest retained chunk gets `truncated: true`.
+
+Enable per agent in agent_config.json with:
+    "storage_mode": "feed"
+"""
+
+import csv
+import io
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import NotFound, PreconditionFailed, TooManyRequests
+
+import gcs_csv
+import gcs_segments
+from group_commit import GroupCommitter
+
+FEED_SUFFIX = ".feed/"
+HEAD_NAME = "_head"
+ROWS_KEY = "rows"
+SEQ_WIDTH = 12
+HEAD_ATTEMPTS = 5
+
+
+def feed_prefix(csv_path: str) -> str:
+    return f"{csv_path}{FEED_SUFFIX}"
+
+
+def chunk_name(csv_path: str, seq: int) -> str:
+    return f"{feed_prefix(csv_path)}{seq:0{SEQ_WIDTH}d}.csv"
+
+
+def _seq_of(name: str) -> Optional[int]:
+    tail = name.rsplit("/", 1)[-1]
+    stem = tail[:-4] if tail.endswith(".csv") else ""
+    return int(stem) if len(stem) == SEQ_WIDTH and stem.isdigit() else None
+
+
+def _rows_of(blob) -> int:
+    return int((blob.metadata or {})[ROWS_KEY])
+
+
+# ───────────────────────────── Head ────────────────────────────────
+def read_head(bucket, csv_path: str) -> Tuple[int, int]:
+    """(next sequence number hint, generation of `_head`) – (0, 0) for a new feed."""
+    blob = bucket.blob(feed_prefix(csv_path) + HEAD_NAME)
+    try:
+        return int(blob.download_as_bytes()), blob.generation
+    except NotFound:
+        return 0, 0
+
+
+def _advance_head(bucket, csv_path: str, nxt: int, seen: Tuple[int, int]) -> None:
+    """Move `_head` forward to `nxt` (never back); losing the race is harmless."""
+    value, generation = seen
+    for _ in range(HEAD_ATTEMPTS):
+        if value >= nxt:
+            return
+        try:
+            bucket.blob(feed_prefix(csv_path) + HEAD_NAME).upload_from_string(
+                str(nxt), content_type="text/plain", if_generation_match=generation
+            )
+            return
+        except (PreconditionFailed, TooManyRequests):
+            value, generation = read_head(bucket, csv_path)
+
+
+# ──────────────────────────── Writers ──────────────────────────────
+def append(bucket, csv_path: str, rows: List[Dict[str, Any]], headers: List[str]) -> Tuple[int, int]:
+    """Append `rows` as the next chunk; returns (first sequence number, next cursor)."""
+    body = gcs_segments.rows_to_csv(rows, headers, include_header=True)
+    head = read_head(bucket, csv_path)
+    seq = head[0]
+    while True:
+        chunk = bucket.blob(chunk_name(csv_path, seq))
+        chunk.metadata = {ROWS_KEY: str(len(rows))}
+        try:
+            chunk.upload_from_string(body, content_type="text/csv", if_generation_match=0)
+            break
+        except PreconditionFailed:
+            taken = bucket.get_blob(chunk.name)
+            if taken is not None:
+                seq += _rows_of(taken)
+            # else: lost a create race – the winner's chunk shows up on retry
+    _advance_head(bucket, csv_path, seq + len(rows), head)
+    return seq, seq + len(rows)
+
+
+def _flush_batch(key, items) -> Tuple[int, int]:
+    _, csv_path, headers = key
+    return append(items[0][0], csv_path, [row for _, row in items], list(headers))
+
+
+_committer = GroupCommitter(_flush_batch, window=gcs_csv.GROUP_COMMIT_WINDOW)
+
+
+def append_rows(bucket, csv_path: str, new_rows: List[Dict[str, Any]], headers: List[str]) -> Tuple[int, int]:
+    """append(), with concurrent callers for the same feed sharing one chunk."""
+    key = (bucket.name, csv_path, tuple(headers))
+    return _committer.submit(key, [(bucket, row) for row in new_rows], lock_key=(bucket.name, csv_path))
+
+
+# ──────────────────────────── Readers ──────────────────────────────
+def read_since(bucket, csv_path: str, cursor: int = 0, max_rows: int = None) -> Dict[str, Any]:
+    """
+    Rows from `cursor` on, whole chunks at a time, stopping after
+    `max_rows` (at least one chunk).  Returns
+        {"since": cursor, "next": cursor for the next read,
+         "truncated": rows before the first one returned were trimmed,
+         "headers": [...], "rows": [[...], ...]}
+    Headers are the union over the chunks read (a column missing from a
+    chunk reads as "").
+    """
+    headers: List[str] = []
+    rows: List[List[str]] = []
+    nxt, truncated = cursor, False
+    for blob in bucket.list_blobs(prefix=feed_prefix(csv_path), start_offset=chunk_name(csv_path, cursor)):
+        start = _seq_of(blob.name)
+        if start is None:
+            continue
+        if start != nxt:
+            if nxt != cursor:
+                break  # a chunk being created right now – next read picks it up
+            truncated = True
+        try:
+            text = blob.download_as_bytes().decode("utf-8")
+        except NotFound:
+            break  # trimmed under us
+        records = list(csv.reader(io.StringIO(text)))
+        if records:
+            for h in records[0]:
+                if h not in headers:
+                    headers.append(h)
+            pos = {h: i for i, h in enumerate(records[0])}
+            for rec in records[1:]:
+                rows.append([rec[pos[h]] if h in pos and pos[h] < len(rec) else "" for h in headers])
+        nxt = start + _rows_of(blob)
+        if max_rows is not None and len(rows) >= max_rows:
+            break
+    width = len(headers)
+    rows = [r + [""] * (width - len(r)) for r in rows]
+    return {"since": cursor, "next": nxt, "truncated": truncated, "headers": headers, "rows": rows}
+
+
+# ──────────────────────────── Retention ────────────────────────────
+def trim(bucket, csv_path: str, older_than_s: float) -> int:
+    """
+    Delete chunks older than `older_than_s` that end at or before `_head`;
+    returns how many.  Readers behind them see `truncated`.
+    """
+    head, _ = read_head(bucket, csv_path)
+    cutoff = time.time() - older_than_s
+    deleted = 0
+    for blob in bucket.list_blobs(prefix=feed_prefix(csv_path)):
+        start = _seq_of(blob.name)
+        if start is None or start + _rows_of(blob) > head:
+            continue
+        if blob.time_created is None or blob.time_created.timestamp() > cutoff:
+            continue
+        try:
+            blob.delete(if_generation_match=blob.generation)
+            deleted += 1
+        except (NotFound, PreconditionFailed):
+            pass
+    return deleted
@@ -0,0 +1,205 @@
+"""
+gcs_rollover.py
+─────────────────────────────────────────────────────────────
+Sealed-segment rollover: a rotation-safe handoff between the webhook
+writers and the Hub's ingestion.
+
+Instead of one live CSV that the Hub copies to processed/ and deletes
+while writers may be half-way through a read-modify-write of it, the
+rows go to numbered segments next to it:
+
+    raw_leads/inbound_webhook.csv.rollover/_open            "42"
+    raw_leads/inbound_webhook.csv.rollover/0000000041.csv   sealed, for the Hub
+    raw_leads/inbound_webhook.csv.rollover/0000000042.csv   open, writers append
+
+Writers read-modify-write the open segment exactly like the plain CSV
+(gcs_csv merge engine, group commit, generation precondition), so
+every segment is a complete deduped CSV with its header.
+
+Handoff (gcsRolloverHandoff_ in Admin Hub/Hub_ArchiveAndResults.js;
+`handoff()` below is the same protocol):
+  1. advance `_open` from N to N+1 (generation-conditional) – new
+     writes go to the next segment from here on;
+  2. seal every segment ≤ N with a metadata patch ("sealed": time);
+  3. download the sealed generation, copy it to processed/ and delete
+     it (both pinned to that generation).
+
+Nothing written is lost, nothing is resurrected:
+  * a writer's upload is pinned to the generation *and* metageneration
+    it read; sealing bumps the metageneration, so a write in flight
+    across the seal gets a 412, and its retry sees the seal and moves
+    on to the segment `_open` names;
+  * a writer whose segment is gone re-reads `_open` before creating
+    it, and a segment created late under a stale pointer is below the
+    open one, so the next handoff seals and consumes it;
+  * the Hub only reads sealed – immutable – generations and never
+    touches the open segment, so ingestion can run as often as wanted.
+
+Enable per agent in agent_config.json with:
+    "storage_mode": "rollover"
+"""
+
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+import gcs_csv
+from group_commit import GroupCommitter
+
+ROLLOVER_SUFFIX = ".rollover/"
+POINTER_NAME = "_open"
+SEALED_KEY = "sealed"
+
+
+class Sealed(Exception):
+    """The segment being written was sealed or consumed – re-read `_open`."""
+
+
+def rollover_prefix(csv_path: str) -> str:
+    return f"{csv_path}{ROLLOVER_SUFFIX}"
+
+
+def segment_name(csv_path: str, seq: int) -> str:
+    return f"{rollover_prefix(csv_path)}{seq:010d}.csv"
+
+
+def _seq_of(name: str) -> Optional[int]:
+    tail = name.rsplit("/", 1)[-1]
+    stem = tail[:-4] if tail.endswith(".csv") else ""
+    return int(stem) if stem.isdigit() else None
+
+
+def processed_name(csv_path: str, stamp: str, seq: int) -> str:
+    """Same place the Hub archives the legacy live CSV: <dir>/processed/<file>_<stamp>."""
+    head, _, tail = csv_path.rpartition("/")
+    return f"{head + '/' if head else ''}processed/{tail}_{stamp}_{seq:010d}"
+
+
+# ───────────────────────────── Pointer ─────────────────────────────
+_open_lock = threading.Lock()
+_open: Dict[Tuple[str, str], int] = {}  # (bucket, csv_path) → last seen open segment
+
+
+def read_pointer(bucket, csv_path: str) -> int:
+    """The open segment number, creating `_open` = 1 for a new target."""
+    blob = bucket.blob(rollover_prefix(csv_path) + POINTER_NAME)
+    try:
+        return int(blob.download_as_bytes())
+    except NotFound:
+        pass
+    try:
+        blob.upload_from_string("1", content_type="text/plain", if_generation_match=0)
+        return 1
+    except PreconditionFailed:
+        return int(bucket.blob(blob.name).download_as_bytes())  # another writer created it
+
+
+def open_segment(bucket, csv_path: str, refresh: bool = False) -> int:
+    key = (bucket.name, csv_path)
+    with _open_lock:
+        seq = None if refresh else _open.get(key)
+    if seq is None:
+        seq = read_pointer(bucket, csv_path)
+        with _open_lock:
+            _open[key] = seq
+    return seq
+
+
+def _check_open(bucket, csv_path: str, seq: int):
+    def check(blob, exists: bool) -> None:
+        if exists:
+            # writers never patch metadata, so metageneration > 1 means sealed
+            if (blob.metageneration or 1) > 1:
+                raise Sealed(f"segment {seq} of gs://{bucket.name}/{csv_path} is sealed")
+        elif read_pointer(bucket, csv_path) != seq:
+            raise Sealed(f"segment {seq} of gs://{bucket.name}/{csv_path} was handed off")
+
+    return check
+
+
+# ───────────────────────────── Writers ─────────────────────────────
+def _flush_batch(key, items) -> int:
+    _, csv_path, headers, key_column = key
+    bucket = items[0][0]
+    rows = [row for _, row in items]
+    seq = open_segment(bucket, csv_path)
+    while True:
+        try:
+            return gcs_csv.read_modify_write(
+                bucket,
+                segment_name(csv_path, seq),
+                lambda existing, out: gcs_csv.merge_csv_stream(existing, out, rows, list(headers), key_column),
+                check=_check_open(bucket, csv_path, seq),
+            )
+        except Sealed as e:
+            print(f"gcs_rollover: {e} – moving to the open segment.")
+        # the Hub advances `_open` before sealing, so every hop moves forward
+        nxt = open_segment(bucket, csv_path, refresh=True)
+        if nxt <= seq:
+            raise RuntimeError(f"gcs_rollover: gs://{bucket.name}/{csv_path}: _open={nxt} after segment {seq} was sealed")
+        seq = nxt
+
+
+_committer = GroupCommitter(_flush_batch, window=gcs_csv.GROUP_COMMIT_WINDOW)
+
+
+def append_rows(
+    bucket,
+    csv_path: str,
+    new_rows: List[Dict[str, Any]],
+    headers: List[str],
+    key_column: Optional[str] = None,
+) -> int:
+    """
+    Merge `new_rows` into the open segment of `csv_path`; returns that
+    segment's row count.  Concurrent callers share one write.
+    """
+    key = (bucket.name, csv_path, tuple(headers), key_column)
+    return _committer.submit(
+        key, [(bucket, row) for row in new_rows], lock_key=(bucket.name, csv_path)
+    )
+
+
+# ───────────────────────────── Handoff ─────────────────────────────
+def handoff(storage_client, bucket_name: str, csv_path: str, archive: bool = True) -> List[Tuple[str, bytes]]:
+    """
+    Seal and consume every segment below the open one; returns
+    [(segment name, CSV bytes)] oldest first ([] for a target that was
+    never written in rollover mode).  Raises PreconditionFailed if
+    another handoff advanced `_open` first.
+    """
+    bucket = storage_client.bucket(bucket_name)
+    pointer = bucket.get_blob(rollover_prefix(csv_path) + POINTER_NAME)
+    if pointer is None:
+        return []
+    current = int(pointer.download_as_bytes(if_generation_match=pointer.generation))
+    bucket.blob(pointer.name).upload_from_string(
+        str(current + 1), content_type="text/plain", if_generation_match=pointer.generation
+    )
+
+    stamp = time.strftime("%Y-%m-%dT%H-%M-%S")
+    consumed = []
+    pending = [
+        b.name for b in bucket.list_blobs(prefix=rollover_prefix(csv_path))
+        if _seq_of(b.name) is not None and _seq_of(b.name) <= current
+    ]
+    for name in sorted(pending):
+        seg = bucket.blob(name)  # no generation: patch whatever is live
+        seg.metadata = {SEALED_KEY: stamp}
+        try:
+            seg.patch()
+            body = seg.download_as_bytes(if_generation_match=seg.generation)
+            if archive:
+                bucket.copy_blob(
+                    seg, bucket, processed_name(csv_path, stamp, _seq_of(name)),
+                    source_generation=seg.generation,
+                )
+            seg.delete(if_generation_match=seg.generation)
+        except NotFound:
+            continue  # consumed by an earlier, interrupted handoff
+        consumed.append((name, body))
+    if consumed:
+        print(f"gcs_rollover: handed off {len(consumed)} sealed segment(s) of gs://{bucket_name}/{csv_path}.")
+    return consumed
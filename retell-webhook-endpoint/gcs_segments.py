@@ -0,0 +1,154 @@
+"""
+gcs_segments.py
+─────────────────────────────────────────────────────────────
+Append-only segmented storage for the webhook CSVs.
+
+Instead of downloading, re-writing and re-uploading the whole
+`inbound_webhook.csv` on every call, each webhook writes one small
+immutable segment object next to it:
+
+    raw_leads/inbound_webhook.csv.segments/_header.csv
+    raw_leads/inbound_webhook.csv.segments/<epoch_ms>-<token>.csv
+
+Segments carry no header row, so a GCS `compose` of
+`_header.csv` + segments (or live CSV + segments) yields one logical
+CSV.  The Hub's gcsDownloadAndRotate_ runs that compose before it
+downloads, so it still sees a single file.
+
+Segments are never deduped by the writers, so `_header.csv` carries the
+target's `key_column` in its metadata; the Hub keeps the last row per
+key of the composed CSV (none when the key is empty, like gcs_csv.py).
+
+Enable per agent in agent_config.json with:
+    "storage_mode": "segments"
+"""
+
+import csv
+import io
+import time
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+import spans
+
+SEGMENTS_SUFFIX = ".segments/"
+HEADER_NAME = "_header.csv"
+KEY_COLUMN_KEY = "key_column"  # header metadata read by the Hub's ingest dedupe
+COMPOSE_LIMIT = 32  # GCS hard limit on source objects per compose
+
+# (bucket, csv_path) pairs whose header object is known to exist
+_known_headers = set()
+
+
+def segment_prefix(csv_path: str) -> str:
+    return f"{csv_path}{SEGMENTS_SUFFIX}"
+
+
+def rows_to_csv(rows: Iterable[Dict], headers: List[str], include_header: bool = False) -> str:
+    """Serialise rows exactly like the pandas path (all cells quoted, LF endings)."""
+    buf = io.StringIO()
+    writer = csv.writer(buf, quoting=csv.QUOTE_ALL, lineterminator="\n")
+    if include_header:
+        writer.writerow(headers)
+    for row in rows:
+        writer.writerow([row.get(h, "") for h in headers])
+    return buf.getvalue()
+
+
+def _ensure_header(bucket, csv_path: str, headers: List[str], key_column: Optional[str]) -> None:
+    key = (bucket.name, csv_path)
+    if key in _known_headers:
+        return
+    name = segment_prefix(csv_path) + HEADER_NAME
+    blob = bucket.blob(name)
+    blob.metadata = {KEY_COLUMN_KEY: key_column or ""}
+    try:
+        blob.upload_from_string(
+            rows_to_csv([], headers, include_header=True),
+            content_type="text/csv",
+            if_generation_match=0,
+        )
+    except PreconditionFailed:
+        # another writer created it first – possibly before headers carried the key
+        existing = bucket.get_blob(name)
+        if existing is not None and (existing.metadata or {}).get(KEY_COLUMN_KEY) != (key_column or ""):
+            existing.metadata = {KEY_COLUMN_KEY: key_column or ""}
+            existing.patch()
+    _known_headers.add(key)
+
+
+def append_segment(
+    storage_client,
+    bucket_name: str,
+    csv_path: str,
+    rows: List[Dict],
+    headers: List[str],
+    key_column: Optional[str] = None,
+) -> str:
+    """
+    Write `rows` as a new immutable segment and return its object name.
+    Cost is independent of how many rows the target already holds.
+    `key_column` is the column the Hub dedupes the composed CSV on.
+    """
+    bucket = storage_client.bucket(bucket_name)
+    _ensure_header(bucket, csv_path, headers, key_column)
+
+    name = (
+        f"{segment_prefix(csv_path)}"
+        f"{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:12]}.csv"
+    )
+    body = rows_to_csv(rows, headers)
+    with spans.span("gcs_upload", len(body)):
+        bucket.blob(name).upload_from_string(
+            body,
+            content_type="text/csv",
+            if_generation_match=0,
+        )
+    return name
+
+
+def list_segments(bucket, csv_path: str) -> list:
+    """Return the data segments for `csv_path`, oldest first."""
+    header = segment_prefix(csv_path) + HEADER_NAME
+    blobs = [
+        b
+        for b in bucket.list_blobs(prefix=segment_prefix(csv_path))
+        if b.name != header
+    ]
+    return sorted(blobs, key=lambda b: b.name)
+
+
+def compact_segments(storage_client, bucket_name: str, csv_path: str) -> int:
+    """
+    Fold all pending segments into the live CSV using server-side compose,
+    then delete the consumed segments.  Returns the number of segments folded.
+
+    Mirrors gcsComposeSegments_ in Admin Hub/Hub_ArchiveAndResults.js.
+    """
+    bucket = storage_client.bucket(bucket_name)
+    pending = list_segments(bucket, csv_path)
+    folded = 0
+
+    while pending:
+        live = bucket.get_blob(csv_path)
+        if live is not None:
+            head, generation = live, live.generation
+        else:
+            head, generation = bucket.blob(segment_prefix(csv_path) + HEADER_NAME), 0
+
+        batch = pending[: COMPOSE_LIMIT - 1]
+        dest = bucket.blob(csv_path)
+        dest.content_type = "text/csv"
+        dest.compose([head] + batch, if_generation_match=generation)
+
+        for seg in batch:
+            try:
+                seg.delete()
+            except NotFound:
+                pass
+        folded += len(batch)
+        pending = pending[len(batch):]
+
+    return folded
@@ -0,0 +1,176 @@
+"""
+group_commit.py
+─────────────────────────────────────────────────────────────
+In-instance group commit for writes that share a target.
+
+With Cloud Functions gen2 concurrency (or the Procfile server) several
+webhooks for the same `(bucket_name, csv_path)` can be in flight at
+once.  Instead of each one downloading, merging and re-uploading the
+CSV – and then fighting over the generation precondition – they join
+a batch:
+
+* the first caller for a key becomes the batch leader;
+* callers arriving while the batch is open (the optional window, plus
+  however long the previous write for the same target takes) add
+  their items and wait;
+* the leader runs one flush for the whole batch and releases every
+  waiter with its result (or re-raises its error in each of them).
+
+Only one flush per target runs at a time inside the instance, so
+generation conflicts are left to cross-instance races.
+
+Several processes on one host (gunicorn workers, router_gunicorn.py)
+are separate instances to each other: still correct – the generation
+precondition catches them – but every overlap is a wasted merge and
+upload.  With GROUP_COMMIT_LOCK_DIR set, the leader also holds an
+flock on a per-target file in that directory for its flush, so the
+processes sharing it take turns as well, and a process's batch keeps
+filling while another process writes the target.
+
+Tunables (environment):
+  GROUP_COMMIT_LOCK_DIR   per-target lock files shared by the
+                          processes on this host  (default off)
+"""
+
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+LOCK_DIR = os.getenv("GROUP_COMMIT_LOCK_DIR", "")
+
+
+class _Batch:
+    __slots__ = ("items", "done", "result", "error")
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _FileLocks:
+    """One lock file per lock key under `directory`, flock'd across processes."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._files: Dict[Hashable, Any] = {}
+        self._pid = os.getpid()
+
+    def _file(self, lock_key: Hashable):
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked: descriptors opened by the parent share its locks
+                self._files, self._pid = {}, os.getpid()
+            fh = self._files.get(lock_key)
+            if fh is None:
+                os.makedirs(self.directory, exist_ok=True)
+                name = hashlib.sha1(repr(lock_key).encode("utf-8")).hexdigest()
+                fh = self._files[lock_key] = open(os.path.join(self.directory, f"{name}.lock"), "a")
+            return fh
+
+    @contextmanager
+    def hold(self, lock_key: Hashable):
+        """Yields the seconds spent waiting for another process."""
+        fh = self._file(lock_key)
+        waited = 0.0
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            t0 = time.perf_counter()
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            waited = time.perf_counter() - t0
+        try:
+            yield waited
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+@contextmanager
+def _no_file_lock(lock_key: Hashable):
+    yield 0.0
+
+
+class GroupCommitter:
+    """
+    `flush(key, items)` is called once per batch; its return value is handed
+    to every caller that contributed to the batch.
+    """
+
+    def __init__(self, flush: Callable[[Hashable, List[Any]], Any], window: float = 0.0, lock_dir: str = LOCK_DIR):
+        self._flush = flush
+        self.window = window
+        self._lock = threading.Lock()
+        self._open: Dict[Hashable, _Batch] = {}
+        self._target_locks: Dict[Hashable, threading.Lock] = {}
+        self._file_lock = _FileLocks(lock_dir).hold if lock_dir else _no_file_lock
+        self._stats = {
+            "batches": 0,
+            "items": 0,
+            "callers": 0,
+            "max_batch": 0,
+            "file_lock_waits": 0,    # flushes that waited for another process
+            "file_lock_wait_ms": 0,
+        }
+
+    def _target_lock(self, lock_key: Hashable) -> threading.Lock:
+        with self._lock:
+            lock = self._target_locks.get(lock_key)
+            if lock is None:
+                lock = self._target_locks[lock_key] = threading.Lock()
+            return lock
+
+    def submit(self, key: Hashable, items: List[Any], lock_key: Hashable = None) -> Any:
+        """
+        Add `items` to the open batch for `key` and block until it is flushed.
+        Batches with different keys but the same `lock_key` never flush
+        concurrently (defaults to `key`).
+        """
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = _Batch()
+            batch.items.extend(items)
+            self._stats["callers"] += 1
+
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.result
+
+        lock_key = key if lock_key is None else lock_key
+        try:
+            if self.window:
+                time.sleep(self.window)
+            with self._target_lock(lock_key), self._file_lock(lock_key) as waited:
+                with self._lock:  # seal: later callers start the next batch
+                    if self._open.get(key) is batch:
+                        del self._open[key]
+                    self._stats["batches"] += 1
+                    self._stats["items"] += len(batch.items)
+                    self._stats["max_batch"] = max(self._stats["max_batch"], len(batch.items))
+                    if waited:
+                        self._stats["file_lock_waits"] += 1
+                        self._stats["file_lock_wait_ms"] += int(waited * 1000)
+                batch.result = self._flush(key, batch.items)
+        except BaseException as exc:
+            # also when a lock could not be taken: unseal, or followers wait forever
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            batch.error = exc
+            raise
+        finally:
+            batch.done.set()
+        return batch.result
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,485 @@
+"""
+lead_sink.py
+─────────────────────────────────────────────────────────────
+Write-behind Firestore lead updates.
+
+Each webhook used to run its own leads.record_call transaction before
+responding.  During a campaign burst that is thousands of transactions
+in a few minutes, many of them on the same leads.  With
+LEAD_SINK_MODE=async the webhook hands (lead, call_id, row) to the
+sink, which spools it and returns leads.QUEUED.  A flusher thread then
+writes the updates in batches:
+
+* the batch closes at LEAD_SINK_BATCH_WRITES writes (500, Firestore's
+  WriteBatch limit) or LEAD_SINK_MAX_AGE_MS after its oldest update;
+* updates to the same lead are coalesced: one marker create per call
+  plus a single lead update (Increment(n), one ArrayUnion, the fields
+  of the latest call);
+* one masked get_all drops calls that were already recorded and leads
+  that do not exist, then one WriteBatch commit writes the rest;
+* if that commit fails, each lead is retried on its own through
+  leads.record_calls (one transaction per lead).  Updates that still
+  fail are re-queued, up to LEAD_SINK_MAX_ATTEMPTS flushes in all.
+
+The call markers make every step idempotent, so a re-queued or
+recovered update that already landed comes back as a duplicate.
+
+Spool – what "queued" guarantees when the webhook is acked
+(LEAD_SINK_SPOOL):
+  local   one fsync'd file per update under LEAD_SINK_DIR (default)
+  gcs     one create-only object per update under
+          gs://LEAD_SINK_BUCKET/LEAD_SINK_PREFIX/
+The caller marks the Firestore stage done on "queued", so the update
+must outlive the request: LEAD_SINK_SPOOL=memory (or any other value)
+is refused with a warning and the sink records inline, as in sync mode.
+/tmp on Cloud Functions is memory and goes with the instance – use gcs
+there.
+A spool entry is deleted once its update is committed (or found to be
+a duplicate or for a missing lead).  Entries older than
+LEAD_SINK_RECOVER_S, left behind by an instance that died, are
+re-queued by whichever sink lists the spool next.  That happens when
+the flusher starts and then every LEAD_SINK_RECOVER_S.
+
+When LEAD_SINK_MAX_QUEUE updates are already waiting, the webhook
+records its own update inline (back-pressure, never a drop).  Pending
+updates are flushed at interpreter exit.  As with bq_sink, on Cloud
+Functions / Cloud Run the flusher only gets CPU while a request is in
+flight unless CPU is always allocated.
+
+LEAD_SINK_MODE=sync (the default) is the plain per-webhook transaction.
+"""
+
+import atexit
+import collections
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+import leads
+import spans
+
+MODE = os.getenv("LEAD_SINK_MODE", "sync").lower()
+SPOOL = os.getenv("LEAD_SINK_SPOOL", "local").lower()
+BATCH_WRITES = int(os.getenv("LEAD_SINK_BATCH_WRITES", "500"))
+MAX_AGE = float(os.getenv("LEAD_SINK_MAX_AGE_MS", "1000")) / 1000
+MAX_QUEUE = int(os.getenv("LEAD_SINK_MAX_QUEUE", "10000"))
+MAX_ATTEMPTS = int(os.getenv("LEAD_SINK_MAX_ATTEMPTS", "5"))
+RECOVER_AFTER = float(os.getenv("LEAD_SINK_RECOVER_S", "300"))
+LOCAL_DIR = os.getenv("LEAD_SINK_DIR", "/tmp/retell-lead-spool")
+BUCKET_NAME = os.getenv("LEAD_SINK_BUCKET", "retell-calling-reference-data")
+PREFIX = os.getenv("LEAD_SINK_PREFIX", "lead_spool").strip("/")
+
+_SAFE = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def spool_key(doc_id: str, call_id: str) -> str:
+    return f"{_SAFE.sub('_', str(doc_id))}__{_SAFE.sub('_', str(call_id))}.json"
+
+
+# ──────────────────────────── Spools ──────────────────────────────
+class _MemorySpool:
+    def put(self, key: str, record: Dict[str, Any]) -> None:
+        pass
+
+    def done(self, keys: Iterable[str]) -> None:
+        pass
+
+    def stale(self, older_than: float) -> List[Tuple[str, Dict[str, Any]]]:
+        return []
+
+
+class _LocalSpool:
+    """One file per update; written to a temp name, fsync'd, then renamed into place."""
+
+    def __init__(self, directory: str = LOCAL_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, key: str, record: Dict[str, Any]) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as fh:
+            json.dump(record, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, os.path.join(self.directory, key))
+
+    def done(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except FileNotFoundError:
+                pass
+
+    def stale(self, older_than: float) -> List[Tuple[str, Dict[str, Any]]]:
+        cutoff = time.time() - older_than
+        out = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json") or entry.stat().st_mtime > cutoff:
+                continue
+            try:
+                with open(entry.path) as fh:
+                    out.append((entry.name, json.load(fh)))
+            except (FileNotFoundError, ValueError):
+                pass  # finished meanwhile, or half-written by a crashed put
+        return out
+
+
+class _GcsSpool:
+    """One create-only object per update; a redelivery finds it already there."""
+
+    def __init__(self, storage_factory: Callable[[], Any], bucket_name: str = BUCKET_NAME, prefix: str = PREFIX):
+        self._storage_factory = storage_factory
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def _bucket(self):
+        client = self._storage_factory()
+        if client is None:
+            raise RuntimeError("lead_sink: no storage client for the GCS spool")
+        return client.bucket(self.bucket_name)
+
+    def put(self, key: str, record: Dict[str, Any]) -> None:
+        try:
+            with spans.span("gcs_upload"):
+                self._bucket().blob(f"{self.prefix}/{key}").upload_from_string(
+                    json.dumps(record), content_type="application/json", if_generation_match=0
+                )
+        except PreconditionFailed:
+            pass  # already spooled by an earlier delivery
+
+    def done(self, keys: Iterable[str]) -> None:
+        bucket = self._bucket()
+        for key in keys:
+            try:
+                bucket.blob(f"{self.prefix}/{key}").delete()
+            except NotFound:
+                pass
+
+    def stale(self, older_than: float) -> List[Tuple[str, Dict[str, Any]]]:
+        cutoff = time.time() - older_than
+        out = []
+        for blob in self._bucket().list_blobs(prefix=f"{self.prefix}/"):
+            if blob.time_created is not None and blob.time_created.timestamp() > cutoff:
+                continue
+            try:
+                out.append((blob.name.rsplit("/", 1)[-1], json.loads(blob.download_as_bytes())))
+            except (NotFound, ValueError):
+                pass
+        return out
+
+
+def make_spool(kind: str, storage_factory: Callable[[], Any] = None):
+    if kind == "local":
+        return _LocalSpool()
+    if kind == "gcs":
+        return _GcsSpool(storage_factory or (lambda: None))
+    return _MemorySpool()
+
+
+# ───────────────────────────── Sink ───────────────────────────────
+class LeadSink:
+    """
+    `client_factory()` must return a Firestore client (or None when
+    unavailable); `spool` is one of the spool classes above.
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[], Any],
+        spool=None,
+        mode: str = MODE,
+        batch_writes: int = BATCH_WRITES,
+        max_age: float = MAX_AGE,
+        max_queue: int = MAX_QUEUE,
+        max_attempts: int = MAX_ATTEMPTS,
+        recover_after: float = RECOVER_AFTER,
+    ):
+        self._client_factory = client_factory
+        self.spool = spool or _MemorySpool()
+        self.mode = mode
+        if mode == "async" and isinstance(self.spool, _MemorySpool):
+            # "queued" would be a promise nothing keeps once max_attempts is hit
+            print("lead_sink: LEAD_SINK_MODE=async needs LEAD_SINK_SPOOL=local or gcs – recording inline.")
+            self.mode = "sync"
+        self.batch_writes = batch_writes
+        self.max_age = max_age
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.recover_after = recover_after
+
+        self._queue = collections.deque()  # (queued monotonic, key, record, attempts)
+        self._keys = set()  # queued or in flight – recovery skips these
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._flush_requested = False
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._next_recovery = 0.0
+        self._stats = {
+            "enqueued": 0,
+            "recorded": 0,     # calls written
+            "coalesced": 0,    # calls folded into another call's lead update
+            "duplicates": 0,
+            "missing": 0,
+            "batches": 0,
+            "fallbacks": 0,    # batches retried lead by lead
+            "retried": 0,      # updates re-queued after a failure
+            "failed": 0,       # updates given up on (still in a durable spool)
+            "recovered": 0,
+            "inline": 0,       # recorded synchronously because the queue was full
+        }
+
+    # ─────────────────────── producer side ───────────────────────
+    def record(self, doc_id: str, call_id: str, row: Dict[str, Any]) -> str:
+        """leads.record_call() in sync mode; otherwise spool the update and return leads.QUEUED."""
+        if self.mode != "async":
+            return leads.record_call(self._client_factory(), doc_id, call_id, row)
+        with self._cond:
+            full = len(self._queue) >= self.max_queue
+        if full:
+            self._count(inline=1)
+            return leads.record_call(self._client_factory(), doc_id, call_id, row)
+
+        key = spool_key(doc_id, call_id)
+        record = {"lead": doc_id, "call_id": call_id, "row": row, "at": datetime.utcnow().isoformat()}
+        with spans.span("lead_spool"):
+            self.spool.put(key, record)
+        with self._cond:
+            if key not in self._keys:
+                self._keys.add(key)
+                self._queue.append((time.monotonic(), key, record, 0))
+                self._stats["enqueued"] += 1
+            self._cond.notify_all()
+            self._ensure_thread()
+        return leads.QUEUED
+
+    def _ensure_thread(self) -> None:
+        # started lazily (and re-started after fork) – caller holds _cond
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="lead-sink", daemon=True)
+            self._thread.start()
+
+    # ─────────────────────── flusher side ────────────────────────
+    def _recover(self) -> None:
+        """Re-queue spool entries an earlier (dead) process never finished."""
+        self._next_recovery = time.monotonic() + max(self.recover_after, 1.0)
+        try:
+            stale = self.spool.stale(self.recover_after)
+        except Exception as e:
+            print(f"lead_sink: listing the spool failed: {e}")
+            return
+        with self._cond:
+            fresh = [(key, record) for key, record in stale if key not in self._keys]
+            for key, record in fresh:
+                self._keys.add(key)
+                self._queue.append((time.monotonic(), key, record, 0))
+            self._stats["recovered"] += len(fresh)
+            if fresh:
+                self._cond.notify_all()
+        if fresh:
+            print(f"lead_sink: recovered {len(fresh)} spooled lead update(s).")
+
+    def _next_batch(self) -> Optional[list]:
+        with self._cond:
+            while not self._queue:
+                if self._stopping:
+                    return None
+                remaining = self._next_recovery - time.monotonic()
+                if remaining <= 0:
+                    return []  # nothing to write – just the periodic recovery pass
+                self._cond.wait(remaining)
+
+            deadline = self._queue[0][0] + self.max_age
+            while not (self._flush_requested or self._stopping) and self._writes(self._queue) < self.batch_writes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, leads_seen = [], set()
+            while self._queue:
+                lead = self._queue[0][2]["lead"]
+                writes = len(batch) + 1 + len(leads_seen) + (lead not in leads_seen)
+                if batch and writes > self.batch_writes:
+                    break
+                batch.append(self._queue.popleft())
+                leads_seen.add(lead)
+            self._inflight += len(batch)
+            return batch
+
+    @staticmethod
+    def _writes(items) -> int:
+        """WriteBatch writes `items` need once coalesced: a marker per call + an update per lead."""
+        return len(items) + len({item[2]["lead"] for item in items})
+
+    def _run(self) -> None:
+        self._recover()
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                if batch:
+                    self._write(batch)
+                if time.monotonic() >= self._next_recovery:
+                    self._recover()
+            except Exception as e:
+                print(f"lead_sink: flush failed: {e}")
+                self._requeue(batch)
+            finally:
+                with self._cond:
+                    self._inflight -= len(batch)
+                    if not self._queue and not self._inflight:
+                        self._flush_requested = False
+                    self._cond.notify_all()
+
+    def _write(self, batch: list) -> None:
+        db = self._client_factory()
+        if db is None:
+            raise RuntimeError("no Firestore client")
+        from google.cloud import firestore
+
+        groups: Dict[str, list] = collections.OrderedDict()
+        for item in batch:
+            groups.setdefault(item[2]["lead"], []).append(item)
+        refs = {doc_id: leads.lead_ref(db, doc_id) for doc_id in groups}
+        markers = {item[1]: leads.marker_ref(refs[item[2]["lead"]], item[2]["call_id"]) for item in batch}
+        t0 = time.perf_counter()
+        found = {
+            snap.reference.path
+            for snap in db.get_all(list(refs.values()) + list(markers.values()), field_paths=["call_id"])
+            if snap.exists
+        }
+
+        settled, pending = [], []  # keys done without a write / (doc_id, items) to write
+        for doc_id, items in groups.items():
+            if refs[doc_id].path not in found:
+                self._count(missing=len(items))
+                print(f"lead_sink: lead {doc_id} not found – {len(items)} update(s) skipped.")
+                settled += [item[1] for item in items]
+                continue
+            fresh = []
+            for item in items:
+                if markers[item[1]].path in found or any(f[2]["call_id"] == item[2]["call_id"] for f in fresh):
+                    self._count(duplicates=1)
+                    settled.append(item[1])
+                else:
+                    fresh.append(item)
+            if fresh:
+                pending.append((doc_id, fresh))
+
+        if pending:
+            wb = db.batch()
+            for doc_id, items in pending:
+                leads.add_calls(wb, firestore, refs[doc_id], [self._call(item) for item in items])
+            try:
+                wb.commit()
+            except Exception as e:
+                self._count(fallbacks=1)
+                print(f"lead_sink: batch of {len(pending)} lead(s) failed ({e}) – retrying lead by lead.")
+                pending = self._write_each(db, pending)
+            else:
+                n = sum(len(items) for _, items in pending)
+                self._count(batches=1, recorded=n, coalesced=n - len(pending))
+                pending = [item for _, items in pending for item in items]
+        spans.observe("firestore_batch", (time.perf_counter() - t0) * 1000)
+
+        settled += [item[1] for item in pending]
+        with self._cond:
+            self._keys.difference_update(settled)
+        try:
+            self.spool.done(settled)
+        except Exception as e:
+            # harmless: recovery re-queues them and the markers turn them into duplicates
+            print(f"lead_sink: could not clear {len(settled)} spool entr(ies): {e}")
+
+    def _write_each(self, db, pending: List[Tuple[str, list]]) -> list:
+        """leads.record_calls per lead; failures are re-queued.  Returns the items that settled."""
+        settled = []
+        for doc_id, items in pending:
+            try:
+                outcomes = leads.record_calls(db, doc_id, [self._call(item) for item in items])
+            except Exception as e:
+                print(f"lead_sink: lead {doc_id} failed: {e}")
+                self._requeue(items)
+                continue
+            for item in items:
+                outcome = outcomes[item[2]["call_id"]]
+                self._count(**{
+                    leads.UPDATED: {"recorded": 1},
+                    leads.DUPLICATE: {"duplicates": 1},
+                    leads.MISSING: {"missing": 1},
+                }[outcome])
+            settled += items
+        return settled
+
+    @staticmethod
+    def _call(item) -> leads.Call:
+        record = item[2]
+        return record["call_id"], record["row"], datetime.fromisoformat(record["at"])
+
+    def _requeue(self, items: list) -> None:
+        with self._cond:
+            for _, key, record, attempts in items:
+                if attempts + 1 >= self.max_attempts:
+                    self._keys.discard(key)  # left in the spool for recovery
+                    self._stats["failed"] += 1
+                    continue
+                self._queue.append((time.monotonic(), key, record, attempts + 1))
+                self._stats["retried"] += 1
+
+    def _count(self, **deltas: int) -> None:
+        with self._cond:
+            for name, n in deltas.items():
+                self._stats[name] += n
+
+    # ───────────────────────── control ───────────────────────────
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Push out everything queued so far; True if drained within timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if not (self._queue or self._inflight):
+                return True
+            self._flush_requested = True
+            self._ensure_thread()
+            self._cond.notify_all()
+            while self._queue or self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 10.0) -> None:
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {**self._stats, "queued": len(self._queue), "inflight": self._inflight}
+
+
+# ─────────────────────── Process-wide sink ───────────────────────
+_sink: Optional[LeadSink] = None
+_sink_lock = threading.Lock()
+
+
+def get_sink(client_factory: Callable[[], Any], storage_factory: Callable[[], Any] = None) -> LeadSink:
+    """The shared sink, created on first use with `client_factory` (and `storage_factory` for the GCS spool)."""
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = LeadSink(client_factory, make_spool(SPOOL, storage_factory) if MODE == "async" else None)
+                atexit.register(_sink.close)
+    return _sink
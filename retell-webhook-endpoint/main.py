@@ -1,15 +1,26 @@
 import base64
 import json
 import os
-import io
-import csv
 from datetime import datetime
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, List, Tuple
 
-import pandas as pd
 from google.cloud import firestore, bigquery, storage
 import functions_framework
 
+import bq_sink
+import gcs_csv
+import gcs_feed
+import gcs_rollover
+import gcs_segments
+import idempotency
+import lead_sink
+import leads
+import payload_archive
+import routing_table
+import spans
+import webhook_spool
+from row_schema import Column, compile_columns, headers
+
 # ───────────────────────── Configuration ──────────────────────────
 PROJECT_ID = os.getenv("GCP_PROJECT", "retell-calling")
 BUCKET_NAME = os.getenv("GCS_BUCKET_NAME", "retell-calling-reference-data")
@@ -23,7 +34,8 @@ BQ_DATASET_ID = "lead_warehouse"
 # Set to "" to disable BigQuery logging
 BQ_TABLE_ID = os.getenv("BQ_TABLE_ID", "retell_call_history")
 
-LEADS_COLLECTION = "leads"
+# Per-stage timing (spans.py): printed for requests slower than this, or failing
+SLOW_MS = float(os.getenv("WEBHOOK_SLOW_MS", "5000"))  # 0 = only on 500s
 
 # ───────────────────── Approved Retell agent IDs ──────────────────
 AGENT_CONFIG = {
@@ -63,8 +75,6 @@ AGENT_CONFIG = {
 
 }
 
-# Will be replaced by contents of AGENT_CONFIG_URI if present
-ALLOWED_AGENT_IDS = set(AGENT_CONFIG)
 
 # ───────────────────── Initialise Cloud clients ───────────────────
 try:
@@ -77,72 +87,29 @@ except Exception as e:
     db = bq_client = storage_client = None
 
 
-def _load_agent_config_from_gcs(uri: str):
-    """Load agent configuration mapping from a JSON file in GCS.
-
-    The file must have the structure:
-
-    {
-      "agents": {
-        "agent_id": {
-          "bucket": "...",
-          "csv_path": "...",
-          "use_firestore": false,
-          "key_column": "Phone"
-        }
-      }
-    }
-    """
-
-    if not (uri and storage_client):
-        return None
-    try:
-        bucket, path = uri.split("/", 1)
-        blob = storage_client.bucket(bucket).blob(path)
-        data = json.loads(blob.download_as_text())
-        return data.get("agents", {})
-    except Exception as exc:  # pragma: no cover - best effort only
-        print(f"Failed to load agent config from {uri}: {exc}")
-        return None
-
-
-_dynamic_agents = _load_agent_config_from_gcs(AGENT_CONFIG_URI)
-if _dynamic_agents:
-    AGENT_CONFIG = _dynamic_agents
-    ALLOWED_AGENT_IDS = set(AGENT_CONFIG)
-
-# ──────────────────────── CSV schema / headers ─────────────────────
-HEADERS = [
-    "Date",
-    "Phone",
-    "Call Time",
-    "First Name",
-    "Last Name",
-    "Address",
-    "City",
-    "Input State",
-    "State Given",
-    "Zip",
-    "Input Email",
-    "Email Given",
-    "Accredited",
-    "Correct Name",
-    "New Investments",
-    "Sectors",
-    "DNC",
-    "Summery",
-    "Quality", 
-    "Disconnection Reason",
-    "Recording",
-    # NEW COLUMN – filled with Firestore document ID
-    "Firestore_ID",
-    # Flags for downstream processing
-    "Processed",
-    "Sector Processed",
-    # ─── NEW Vista‑only columns ───
-    "Interested", "Liquid To Invest", "Job",
-    "Follow Up", "Past Experience","summary"
-]
+# Agent routing: AGENT_CONFIG above, replaced by the "agents" mapping in
+# AGENT_CONFIG_URI when present.  The file has the structure:
+#
+#   {
+#     "agents": {
+#       "agent_id": {
+#         "bucket": "...",
+#         "csv_path": "...",
+#         "use_firestore": false,
+#         "key_column": "Phone"
+#       }
+#     }
+#   }
+#
+# and is re-checked (conditional GET) every ROUTER_CONFIG_TTL_S without a
+# redeploy – see routing_table.py.
+ROUTES = routing_table.RoutingTable(
+    AGENT_CONFIG_URI,
+    AGENT_CONFIG,
+    lambda: storage_client,
+    merge_defaults=False,
+)
+ROUTES.load()
 
 # ─────────────────── Helper: flexible key lookup ───────────────────
 VAR_ALIASES = {
@@ -156,138 +123,75 @@ VAR_ALIASES = {
     "Recording": ("recording_url", " recording_url", "recording_url ", "recording",)
 }
 
-def get_var(vars_dict: dict, *keys, default="") -> str:
-    if not isinstance(vars_dict, dict):
-        return default
-    for k in keys:
-        if k in vars_dict:
-            return vars_dict[k]
-    return default
-
-
-def normalize_phone(raw: str) -> str:
-    if not raw or not isinstance(raw, str):
-        return ""
-    digits = "".join(ch for ch in raw if ch.isdigit())
-    return digits[1:] if len(digits) == 11 and digits.startswith("1") else digits
-
-
-def get_valid_datetime(ts):
-    try:
-        if ts and isinstance(ts, (int, float)):
-            if ts > 10 ** 12:  # ms → s
-                ts /= 1000
-        return datetime.fromtimestamp(ts)
-    except Exception as e:
-        print(f"Warning: bad timestamp {ts}: {e}")
-    return None
-
+# ──────────────────────── CSV schema / headers ─────────────────────
+# (header, source, aliases, transform) – see row_schema.py
+COLUMNS = [
+    Column("Date", "call", ("end_timestamp",), "datetime"),
+    Column("Phone", "call", ("to_number",), "phone"),
+    Column("Call Time", "cost", ("total_duration_seconds",)),
+    Column("First Name", "vars", VAR_ALIASES["First Name"]),
+    Column("Last Name", "vars", VAR_ALIASES["Last Name"]),
+    Column("Address", "vars", VAR_ALIASES["Address"]),
+    Column("City", "vars", VAR_ALIASES["City"]),
+    Column("Input State", "vars", VAR_ALIASES["State"]),
+    Column("State Given", "analysis", ("_state",)),
+    Column("Zip", "vars", VAR_ALIASES["Zip"]),
+    Column("Input Email", "vars", VAR_ALIASES["Email"]),
+    Column("Email Given", "analysis", ("_email",)),
+    Column("Accredited", "analysis", ("_accredited_investor", "_accredited _investor"), "lower"),
+    Column("Correct Name", "analysis", ("_correct_name", "_correct _name"), "lower"),
+    Column("New Investments", "analysis", ("_new_investments", "_new _investments"), "lower"),
+    Column("Sectors", "analysis", ("_investment_sectors", "_investment _sectors")),
+    Column("DNC", "analysis", ("_dnc", "_d_n_c"), "lower"),
+    Column("Summery", "analysis",
+           ("_summary", "_call_summary", "_call _summery", "_Summary", "Summary", "summary")),
+    Column("Quality", "analysis", ("_quality",)),
+    Column("Disconnection Reason", "call", ("disconnection_reason",)),
+    Column("Recording", "vars", VAR_ALIASES["Recording"]),
+    # NEW COLUMN – filled with Firestore document ID
+    Column("Firestore_ID", "vars", ("firestore_doc_id",)),
+    # Flags for downstream processing
+    Column("Processed"),
+    Column("Sector Processed"),
+    # ─── NEW Vista‑only columns ───
+    Column("Interested", "analysis", ("_interested",), "lower"),
+    Column("Liquid To Invest", "analysis", ("_liquid_to_invest", "_liquid _to _invest"), "lower"),
+    Column("Job", "analysis", ("_job",)),
+    Column("Follow Up", "analysis", ("_follow_up", "_follow _up")),
+    Column("Past Experience", "analysis",
+           ("_past_oil", "_past _oil", "_past_experience", "past_experience"), "lower"),
+    Column("summary"),
+]
+HEADERS = headers(COLUMNS)
 
 # ──────────────── Build a one‑row dict for CSV ─────────────────────
-
-def build_row(call: dict, vars_: dict, analysis: dict, cost: dict) -> Dict[str, Any]:
-    def a_field(*keys, default=""):
-        if not isinstance(analysis, dict):
-            return default
-        # normalise keys by stripping whitespace
-        norm = {str(k).strip(): v for k, v in analysis.items()}
-        for k in keys:
-            if k in norm:
-                return norm[k]
-        return default
-
-    end_dt = get_valid_datetime(call.get("end_timestamp"))
-    return {
-        "Date": end_dt.strftime("%Y-%m-%d %H:%M:%S") if end_dt else "",
-        "Phone": normalize_phone(call.get("to_number", "")),
-        "Call Time": cost.get("total_duration_seconds", ""),
-        "First Name": get_var(vars_, *VAR_ALIASES["First Name"]),
-        "Last Name": get_var(vars_, *VAR_ALIASES["Last Name"]),
-        "Address": get_var(vars_, *VAR_ALIASES["Address"]),
-        "City": get_var(vars_, *VAR_ALIASES["City"]),
-        "Input State": get_var(vars_, *VAR_ALIASES["State"]),
-        "State Given": a_field("_state"),
-        "Zip": get_var(vars_, *VAR_ALIASES["Zip"]),
-        "Input Email": get_var(vars_, *VAR_ALIASES["Email"]),
-        "Email Given": a_field("_email"),
-        "Accredited": str(a_field("_accredited_investor", "_accredited _investor")).lower(),
-        "Correct Name": str(a_field("_correct_name", "_correct _name")).lower(),
-        "New Investments": str(a_field("_new_investments", "_new _investments")).lower(),
-        "Sectors": a_field("_investment_sectors", "_investment _sectors"),
-        "DNC": str(a_field("_dnc", "_d_n_c")).lower(),
-        "Summery": a_field("_summary", "_call_summary", "_call _summery", "_Summary", "Summary","summary"),
-        "Quality": a_field("_quality"),
-        "Disconnection Reason": call.get("disconnection_reason", ""),
-        "Firestore_ID": vars_.get("firestore_doc_id", ""),
-        "Processed": "",
-        "Sector Processed": "",
-        # ─── Vista additions ───
-        "Interested": str(a_field("_interested")).lower(),
-        "Liquid To Invest": str(a_field("_liquid_to_invest", "_liquid _to _invest")).lower(),
-        "Job": a_field("_job"),
-        "Follow Up": a_field("_follow_up", "_follow _up"),
-        "Past Experience": str(a_field("_past_oil", "_past _oil", "_past_experience", "past_experience")).lower(),
-        "Recording": get_var(vars_, *VAR_ALIASES["Recording"]),
-    }
+# build_row(call, vars_, analysis, cost) -> {header: value}
+build_row = compile_columns(COLUMNS, label="retell-webhook")
 
 
 # ─────────────── Helper: append to a single CSV file ───────────────
 
-def append_to_gcs_csv(bucket_name: str, path: str, new_df: pd.DataFrame,
+def append_to_gcs_csv(bucket_name: str, path: str, new_rows: List[Dict[str, Any]],
                       key_column: str = None):
-    """Atomic read‑append‑write with optimistic locking."""
+    """Atomic read‑append‑write with optimistic locking (retried on 412)."""
     bucket = storage_client.bucket(bucket_name)
-    blob   = bucket.blob(path)
-
-    # Load existing data if the file exists
-    try:
-        existing_bytes = blob.download_as_bytes()
-        existing_df    = pd.read_csv(io.BytesIO(existing_bytes))
-    except Exception:
-        existing_df    = pd.DataFrame(columns=HEADERS)
-
-    # Align columns in case of new headers
-    if not existing_df.columns.equals(new_df.columns):
-        existing_df = existing_df.reindex(columns=HEADERS)
-
-    combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-
-    # Deduplicate on the chosen key
-    if key_column and key_column in combined_df.columns:
-        combined_df[key_column] = combined_df[key_column].astype(str)
-        combined_df.drop_duplicates(subset=[key_column],
-                                     keep="last", inplace=True)
-
-    # ---- write back (all cells quoted) ----
-    blob.upload_from_string(
-        combined_df.to_csv(index=False, quoting=csv.QUOTE_ALL),  # always‑quote
-        content_type="text/csv",
-        if_generation_match=blob.generation or 0                # fail if blob changed mid‑flight
-    )
+    # streams existing CSV, dedupes on key (last wins), re-quotes all cells
+    total_rows = gcs_csv.append_rows(bucket, path, new_rows, HEADERS, key_column)
 
     print(
-        f"Appended {len(new_df)} row(s) to gs://{bucket_name}/{path}. "
-        f"Total rows: {len(combined_df)}"
+        f"Appended {len(new_rows)} row(s) to gs://{bucket_name}/{path}. "
+        f"Total rows: {total_rows}"
     )
 
 
-# ─────────────── Firestore + BigQuery helpers ─────────────────────
-
-def get_lead_by_id(doc_id: str):
-    if not (db and doc_id):
-        return None, None
-    try:
-        ref = db.collection(LEADS_COLLECTION).document(doc_id)
-        doc = ref.get()
-        return (ref, doc.to_dict()) if doc.exists else (None, None)
-    except Exception as e:
-        print(f"Error loading lead {doc_id}: {e}")
-        return None, None
-
+# ──────────────────────── BigQuery helpers ─────────────────────────
 
-def log_to_bigquery(payload: dict, call: dict):
-    if not (bq_client and BQ_TABLE_ID):
-        return
+def log_to_bigquery(payload: dict, call: dict) -> bool:
+    """True once the row is known to be in BigQuery – never for an async hand-off (bq_sink.py)."""
+    if not BQ_TABLE_ID:
+        return True
+    if not bq_client:
+        return False
     table_ref = f"{PROJECT_ID}.{BQ_DATASET_ID}.{BQ_TABLE_ID}"
     try:
         analysis = call.get("call_analysis", {}).get("custom_analysis_data", {})
@@ -302,26 +206,59 @@ def log_to_bigquery(payload: dict, call: dict):
             "retell_agent_id": call.get("agent_id"),
             "call_duration_ms": call.get("call_cost", {}).get("total_duration_seconds", 0)
             * 1000,
-            "transcript": json.dumps(call.get("transcript")),
-            "full_webhook_payload": json.dumps(payload),
         }
-        errors = bq_client.insert_rows_json(table_ref, [row])
-        if errors:
-            print(f"BigQuery insert errors: {errors}")
+        # inline JSON, or a gs:// reference to the payload archived by the sink's flusher
+        row = payload_archive.history_row(row, storage_client, payload, call)
+        # batched off the response path (see bq_sink.py)
+        sink = bq_sink.get_sink(lambda: bq_client)
+        return sink.submit(table_ref, row, insert_id=call.get("call_id")) and sink.confirms
     except Exception as e:
         print(f"BigQuery logging failed: {e}")
+        return False
+
+
+def write_csv(cfg: dict, row: dict, key_column: str) -> None:
+    """Append `row` to the agent's CSV target; any failure propagates."""
+    bucket_name = (
+        cfg.get("bucket")
+        or cfg.get("bucket_name")
+        or cfg.get("bucketName")
+        or BUCKET_NAME
+    )
+    csv_path = cfg.get("csv_path") or cfg.get("path") or GCS_CSV_PATH
+    if cfg.get("storage_mode") == "segments":
+        gcs_segments.append_segment(
+            storage_client, bucket_name, csv_path, [row], HEADERS, key_column
+        )
+    elif cfg.get("storage_mode") == "feed":
+        gcs_feed.append_rows(storage_client.bucket(bucket_name), csv_path, [row], HEADERS)
+    elif cfg.get("storage_mode") == "rollover":
+        gcs_rollover.append_rows(
+            storage_client.bucket(bucket_name), csv_path, [row], HEADERS, key_column
+        )
+    else:
+        append_to_gcs_csv(bucket_name, csv_path, [row], key_column=key_column)
 
 
 # ───────────────── Cloud Function entry‑point ──────────────────────
 @functions_framework.http
 def retell_webhook_endpoint(request):
+    with spans.request() as trace:
+        body, status = handle_request(request, trace)
+        if trace is not None and (status >= 500 or (SLOW_MS and trace.elapsed_ms() >= SLOW_MS)):
+            print(f"webhook timing {json.dumps({'agent_id': trace.agent_id, 'status': status, **trace.summary()})}")
+    return body, status
+
+
+def handle_request(request, trace):
     if not all([db, bq_client, storage_client]):
         return ("Internal server error: clients not configured.", 500)
 
     if not request.is_json:
         return ("Invalid payload: content‑type must be application/json.", 400)
 
-    payload = request.get_json(silent=True)
+    with spans.span("parse_json", request.content_length or 0):
+        payload = request.get_json(silent=True)
     if not payload:
         return ("Empty or invalid JSON payload.", 400)
 
@@ -333,11 +270,46 @@ def retell_webhook_endpoint(request):
         return ("Invalid payload structure.", 400)
 
     agent_id = call.get("agent_id")
-    cfg = AGENT_CONFIG.get(agent_id)
+    if trace is not None:
+        trace.agent_id = agent_id
+    cfg = ROUTES.configs().get(agent_id)
     if not cfg:
         print(f"Ignoring call from unapproved agent {agent_id}")
         return ("Call from unapproved agent ignored.", 200)
 
+    # Ack-first (WEBHOOK_ACK_MODE=spool): a spool worker runs the rest
+    if SPOOL is not None and SPOOL.submit(request.get_data()):
+        return ("Webhook queued for processing.", 200)
+    return dispatch(payload, call, cfg)
+
+
+def dispatch(payload: dict, call: dict, cfg: dict):
+    # Retell redeliveries skip the stages that already completed
+    with idempotency.guard(lambda: storage_client).execution(call.get("call_id")) as ex:
+        if ex.complete:
+            return (f"Duplicate delivery of call {ex.call_id} ignored.", 200)
+        return process_call(ex, payload, call, cfg)
+
+
+def process_spooled(body: bytes) -> None:
+    """Spool worker (webhook_spool.py): raising has the webhook retried."""
+    if not all([db, bq_client, storage_client]):
+        raise RuntimeError("clients not configured")
+    payload = json.loads(body)
+    call = payload.get("data") or payload.get("call", {})
+    cfg = ROUTES.configs().get(call.get("agent_id"))
+    if not cfg:
+        print(f"Ignoring spooled call from unapproved agent {call.get('agent_id')}")
+        return
+    with spans.request(call.get("agent_id")) as trace:
+        message, status = dispatch(payload, call, cfg)
+        if trace is not None and (status >= 500 or (SLOW_MS and trace.elapsed_ms() >= SLOW_MS)):
+            print(f"webhook timing {json.dumps({'agent_id': trace.agent_id, 'status': status, **trace.summary()})}")
+    if status >= 500:
+        raise RuntimeError(message)
+
+
+def process_call(ex, payload: dict, call: dict, cfg: dict):
     # swap bucket/path dynamically
     KEY_COL = (
         cfg.get("key_column")
@@ -353,30 +325,32 @@ def retell_webhook_endpoint(request):
         USE_FIRESTORE = True
 
     # Log raw payload to BigQuery
-    log_to_bigquery(payload, call)
+    if ex.needs("bigquery"):
+        with spans.span("bigquery"):
+            landed = log_to_bigquery(payload, call)
+        if landed:  # a queued row stays open: the next delivery resubmits it
+            ex.mark("bigquery")
 
     vars_ = call.get("retell_llm_dynamic_variables", {}) or {}
     analysis = call.get("call_analysis", {}).get("custom_analysis_data", {}) or {}
     cost = call.get("call_cost", {}) or {}
 
-    row = build_row(call, vars_, analysis, cost)
+    with spans.span("build_row"):
+        row = build_row(call, vars_, analysis, cost)
     if not row["Date"]:
         return ("Webhook logged, but missing/invalid end_timestamp. Skipping CSV.", 200)
 
-    try:
-        df = pd.DataFrame([row], columns=HEADERS)
-        bucket_name = (
-            cfg.get("bucket")
-            or cfg.get("bucket_name")
-            or cfg.get("bucketName")
-            or BUCKET_NAME
-        )
-        csv_path = cfg.get("csv_path") or cfg.get("path") or GCS_CSV_PATH
-        append_to_gcs_csv(bucket_name, csv_path, df, key_column=KEY_COL)
-    except Exception as e:
-        print(f"CRITICAL: unable to update inbound_webhook.csv – {e}")
-
-    # ─────── Firestore side‑effects (unchanged) ────────
+    if ex.needs("csv"):
+        try:
+            with spans.span("csv_append"):
+                write_csv(cfg, row, KEY_COL)
+        except Exception as e:
+            print(f"CRITICAL: unable to update inbound_webhook.csv – {e}")
+            ex.fail()  # left open: Retell's redelivery (or the spool) writes it again
+            return ("Error updating CSV.", 500)
+        ex.mark("csv")
+
+    # ─────── Firestore side‑effects (leads.py, lead_sink.py) ────────
     if not USE_FIRESTORE:
         return ("CSV written (Vista – no Firestore sync).", 200)
 
@@ -384,51 +358,30 @@ def retell_webhook_endpoint(request):
     if not firestore_doc_id:
         return ("CSV written, but payload lacks firestore_doc_id.", 200)
 
-    lead_ref, lead_data = get_lead_by_id(firestore_doc_id)
-    if not lead_ref:
-        return (f"CSV written, but lead {firestore_doc_id} not found.", 200)
-
     call_id = call.get("call_id")
-    if lead_data and any(
-        d.get("call_id") == call_id for d in lead_data.get("disposition_history", [])
-    ):
-        return (f"CSV written, duplicate call_id {call_id} ignored.", 200)
-
     try:
-        @firestore.transactional
-        def txn(t, ref, r):
-            entry = {
-                "call_id": call_id,
-                "timestamp": datetime.utcnow(),
-                "disposition": r.get("Correct Name", "").strip(),
-            }
-            t.update(
-                ref,
-                {
-                    "call_attempts": firestore.Increment(1),
-                    "last_call_timestamp": datetime.utcnow(),
-                    "disposition_history": firestore.ArrayUnion([entry]),
-                    "disposition": r.get("Correct Name", "").strip(),
-                    "Status": "Called",
-                    "analysis_email": r.get("Email Given"),
-                    "analysis_state": r.get("State Given"),
-                    "analysis_accredited": r.get("Accredited"),
-                    "analysis_new_investments": r.get("New Investments"),
-                    "analysis_sectors": r.get("Sectors"),
-                    "analysis_dnc": r.get("DNC"),
-                    "analysis_summary": r.get("Summery"),
-                    "analysis_quality": r.get("Quality"), 
-                    "call_duration_seconds": r.get("Call Time"),
-                    "disconnection_reason": r.get("Disconnection Reason"),
-                    "processed": False,
-                    "sector_processed": False,
-                },
-            )
-
-        txn(db.transaction(), lead_ref, row)
-        print(f"Lead {lead_ref.id} updated with call results.")
+        # inline transaction, or spooled for the write-behind flusher (LEAD_SINK_MODE)
+        outcome = lead_sink.get_sink(lambda: db, lambda: storage_client).record(firestore_doc_id, call_id, row)
     except Exception as e:
-        print(f"Firestore transaction failed for {lead_ref.id}: {e}")
+        print(f"Firestore transaction failed for {firestore_doc_id}: {e}")
+        ex.fail()
         return ("Error updating Firestore.", 500)
+    if outcome == leads.MISSING:
+        return (f"CSV written, but lead {firestore_doc_id} not found.", 200)
+    if outcome == leads.DUPLICATE:
+        return (f"CSV written, duplicate call_id {call_id} ignored.", 200)
+    if outcome == leads.QUEUED:
+        print(f"Lead {firestore_doc_id} update queued.")
+    else:
+        print(f"Lead {firestore_doc_id} updated with call results.")
+
+    ex.mark("firestore")
+    return ("Webhook processed successfully.", 200)
+
 
-    return ("Webhook processed successfully.", 200)
\ No newline at end of file
+# Ack-first mode: started here so a spool left by a crashed process is replayed now
+SPOOL = (
+    webhook_spool.get_spool(process_spooled, lambda: storage_client)
+    if webhook_spool.ACK_MODE == "spool"
+    else None
+)
@@ -0,0 +1,257 @@
+"""
+spans.py
+─────────────────────────────────────────────────────────────
+Per-stage timers for webhook requests.
+
+    with spans.request() as trace:            # router / endpoint, once
+        trace.agent_id = agent_id
+        with spans.span("parse_json"):
+            ...
+        with spans.span("gcs_download") as s:  # anywhere below
+            body = blob.download_as_bytes()
+            s.add_bytes(len(body))
+
+* A trace is carried in a contextvar, so library code (gcs_csv,
+  bq_sink, …) times itself without any plumbing; outside a request
+  `span()` is a shared no-op object.
+* Stages are plain named accumulators – they may nest (csv_append
+  contains gcs_download / csv_merge / gcs_upload) and repeat (retries
+  add up and bump the count).  `total` is the request's wall time.
+* When the request ends its stages are folded into in-process
+  log-bucketed histograms per agent_id (`histograms()`); work with no
+  request around it (the bq_sink flusher thread) lands under
+  "_background".
+* `trace.summary()` is what the router attaches to its _log_struct
+  records: {"total_ms": …, "stages": {name: {"ms", "n", "bytes"}}}.
+
+WEBHOOK_SPANS=off turns every call into a no-op (one global check).
+"""
+
+import contextvars
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+ENABLED = os.getenv("WEBHOOK_SPANS", "on").lower() not in ("off", "0", "false")
+
+BACKGROUND = "_background"
+
+# histogram bucket upper bounds, ms: 0.05 … ~10 min, ×1.5 per bucket
+_BOUNDS: List[float] = []
+_b = 0.05
+while _b < 600_000:
+    _BOUNDS.append(_b)
+    _b *= 1.5
+_BOUNDS.append(float("inf"))
+
+
+class Trace:
+    __slots__ = ("agent_id", "stages", "started")
+
+    def __init__(self, agent_id: Optional[str] = None):
+        self.agent_id = agent_id
+        self.stages: Dict[str, List[float]] = {}  # name → [ms, count, bytes]
+        self.started = time.perf_counter()
+
+    def add(self, name: str, ms: float, nbytes: int = 0) -> None:
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stages[name] = [ms, 1, nbytes]
+        else:
+            stage[0] += ms
+            stage[1] += 1
+            stage[2] += nbytes
+
+    def add_bytes(self, name: str, nbytes: int) -> None:
+        stage = self.stages.setdefault(name, [0.0, 0, 0])
+        stage[2] += nbytes
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "total_ms": round(self.elapsed_ms(), 2),
+            "stages": {
+                name: {"ms": round(ms, 2), "n": n, **({"bytes": b} if b else {})}
+                for name, (ms, n, b) in self.stages.items()
+            },
+        }
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("webhook_trace", default=None)
+
+
+# ─────────────────────────── Spans ───────────────────────────
+class _Span:
+    __slots__ = ("_trace", "_name", "_bytes", "_t0")
+
+    def __init__(self, trace: Trace, name: str, nbytes: int):
+        self._trace = trace
+        self._name = name
+        self._bytes = nbytes
+
+    def add_bytes(self, nbytes: int) -> None:
+        self._bytes += nbytes
+
+    def __enter__(self) -> "_Span":
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._trace.add(self._name, (time.perf_counter() - self._t0) * 1000, self._bytes)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def add_bytes(self, nbytes: int) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name: str, nbytes: int = 0):
+    """Time a block as stage `name` of the current request (no-op outside one)."""
+    if not ENABLED:
+        return _NOOP
+    trace = _current.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, nbytes)
+
+
+def observe(name: str, ms: float, nbytes: int = 0) -> None:
+    """Record an externally timed stage; outside a request it goes to _background."""
+    if not ENABLED:
+        return
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, ms, nbytes)
+    else:
+        _histograms.fold(BACKGROUND, {name: [ms, 1, nbytes]}, None)
+
+
+def current() -> Optional[Trace]:
+    return _current.get() if ENABLED else None
+
+
+class request:
+    """Context manager opening a trace for one webhook; yields it (None if disabled)."""
+
+    __slots__ = ("_trace", "_token")
+
+    def __init__(self, agent_id: Optional[str] = None):
+        self._trace = Trace(agent_id) if ENABLED else None
+
+    def __enter__(self) -> Optional[Trace]:
+        if self._trace is not None:
+            self._token = _current.set(self._trace)
+        return self._trace
+
+    def __exit__(self, *exc) -> None:
+        trace = self._trace
+        if trace is None:
+            return
+        _current.reset(self._token)
+        _histograms.fold(trace.agent_id or "unknown", trace.stages, trace.elapsed_ms())
+
+
+# ───────────────────────── Histograms ────────────────────────
+class _Histogram:
+    __slots__ = ("count", "sum_ms", "max_ms", "bytes", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+        self.bytes = 0
+        self.buckets = [0] * len(_BOUNDS)
+
+    def add(self, ms: float, nbytes: int = 0) -> None:
+        self.count += 1
+        self.sum_ms += ms
+        self.bytes += nbytes
+        if ms > self.max_ms:
+            self.max_ms = ms
+        lo, hi = 0, len(_BOUNDS) - 1
+        while lo < hi:  # first bound >= ms
+            mid = (lo + hi) // 2
+            if _BOUNDS[mid] < ms:
+                lo = mid + 1
+            else:
+                hi = mid
+        self.buckets[lo] += 1
+
+    def quantile(self, q: float) -> float:
+        want = q * self.count
+        seen = 0
+        for bound, n in zip(_BOUNDS, self.buckets):
+            seen += n
+            if seen >= want and n:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "n": self.count,
+            "mean_ms": round(self.sum_ms / self.count, 2) if self.count else 0.0,
+            "p50_ms": round(self.quantile(0.50), 2),
+            "p95_ms": round(self.quantile(0.95), 2),
+            "p99_ms": round(self.quantile(0.99), 2),
+            "max_ms": round(self.max_ms, 2),
+            **({"bytes": self.bytes} if self.bytes else {}),
+        }
+
+
+class _Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Dict[str, Dict[str, _Histogram]] = {}
+
+    def fold(self, agent_id: str, stages: Dict[str, List[float]], total_ms: Optional[float]) -> None:
+        with self._lock:
+            per_agent = self._data.setdefault(agent_id, {})
+            for name, (ms, _, nbytes) in stages.items():
+                hist = per_agent.get(name)
+                if hist is None:
+                    hist = per_agent[name] = _Histogram()
+                hist.add(ms, nbytes)
+            if total_ms is not None:
+                hist = per_agent.get("total")
+                if hist is None:
+                    hist = per_agent["total"] = _Histogram()
+                hist.add(total_ms)
+
+    def snapshot(self, agent_id: str = None) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        with self._lock:
+            agents = [agent_id] if agent_id else list(self._data)
+            return {
+                a: {name: h.summary() for name, h in self._data.get(a, {}).items()}
+                for a in agents
+                if a in self._data
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+_histograms = _Registry()
+
+
+def histograms(agent_id: str = None) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """{agent_id: {stage: {n, mean_ms, p50_ms, p95_ms, p99_ms, max_ms[, bytes]}}}."""
+    return _histograms.snapshot(agent_id)
+
+
+def reset() -> None:
+    _histograms.reset()
@@ -0,0 +1,679 @@
+"""
+webhook_spool.py
+─────────────────────────────────────────────────────────────
+Ack-first webhook processing.
+
+By default (WEBHOOK_ACK_MODE=sync) a webhook is answered only after its
+handler has finished with BigQuery, GCS and Firestore, so Retell's
+delivery latency, and its timeout, are those of our slowest dependency.
+With WEBHOOK_ACK_MODE=spool the entry point still validates the
+request, but then appends the raw body to a durable spool and answers
+200 straight away.  A pool of WEBHOOK_SPOOL_WORKERS threads drains the
+spool through the same dispatch the synchronous path uses.
+
+Spool (WEBHOOK_SPOOL):
+  local  append-only log under WEBHOOK_SPOOL_DIR: length + CRC32
+         framed records in numbered segment files, fsync'd before the
+         ack (concurrent appends share one fsync).  Progress is
+         checkpointed to checkpoint.json (temp file, fsync, rename) as
+         a watermark plus the records finished beyond it.  On start the
+         log is replayed from the checkpoint and a torn tail is cut
+         off; segments below the watermark are deleted.  Processes
+         sharing the directory (gunicorn workers, router_gunicorn.py)
+         each lock the first free slot-N subdirectory, so a process
+         that replaces a dead one replays its log; a slot nobody
+         reclaims is adopted by a live process within
+         WEBHOOK_SPOOL_RECOVER_S.
+  gcs    one create-only object per webhook under
+         gs://WEBHOOK_SPOOL_BUCKET/WEBHOOK_SPOOL_PREFIX/, deleted once
+         processed.  Objects older than WEBHOOK_SPOOL_RECOVER_S, left by
+         an instance that died, are picked up by whichever instance
+         lists the spool next.  /tmp on Cloud Functions is memory and
+         goes with the instance, so this is the durable choice there.
+Both implement append / ack / replay / stale / dead; a Pub/Sub
+subscription would fit the same calls.
+
+Processing is at-least-once: a record finished after the last
+checkpoint, or recovered by two instances at once, runs again.  The
+handlers already absorb Retell's own redeliveries (idempotency markers,
+keyed CSV dedupe, BigQuery insertIds, lead call markers).
+
+A record whose handler raises is retried with exponential backoff,
+up to WEBHOOK_SPOOL_MAX_ATTEMPTS runs, and then moved to the dead
+letters (dead.ndjson in the slot / WEBHOOK_SPOOL_PREFIX_dead/) – Retell
+no longer retries for us once it has its 200.  When
+WEBHOOK_SPOOL_MAX_PENDING webhooks are already waiting, or the append
+fails, the entry point processes the request inline as before.
+
+As with bq_sink, on Cloud Functions / Cloud Run the workers only get
+CPU while a request is in flight unless CPU is always allocated
+(`--no-cpu-throttling`); without it the spool drains only under load.
+
+Tunables (environment):
+  WEBHOOK_ACK_MODE              sync | spool                (default sync)
+  WEBHOOK_SPOOL                 local | gcs                 (default local)
+  WEBHOOK_SPOOL_WORKERS         worker threads              (default 4)
+  WEBHOOK_SPOOL_MAX_PENDING     queued before inline        (default 5000)
+  WEBHOOK_SPOOL_MAX_ATTEMPTS    runs before dead-lettering  (default 8)
+  WEBHOOK_SPOOL_RETRY_S         first retry delay, seconds  (default 1)
+  WEBHOOK_SPOOL_CHECKPOINT_MS   checkpoint at most every    (default 200)
+  WEBHOOK_SPOOL_SEGMENT_BYTES   local segment size          (default 16 MiB)
+  WEBHOOK_SPOOL_DIR             local spool directory
+  WEBHOOK_SPOOL_BUCKET / _PREFIX  GCS spool location
+  WEBHOOK_SPOOL_RECOVER_S       adopt others' records every (default 300)
+"""
+
+import atexit
+import collections
+import fcntl
+import heapq
+import itertools
+import json
+import os
+import random
+import struct
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+import spans
+
+ACK_MODE = os.getenv("WEBHOOK_ACK_MODE", "sync").lower()
+SPOOL = os.getenv("WEBHOOK_SPOOL", "local").lower()
+WORKERS = int(os.getenv("WEBHOOK_SPOOL_WORKERS", "4"))
+MAX_PENDING = int(os.getenv("WEBHOOK_SPOOL_MAX_PENDING", "5000"))
+MAX_ATTEMPTS = int(os.getenv("WEBHOOK_SPOOL_MAX_ATTEMPTS", "8"))
+RETRY_BASE = float(os.getenv("WEBHOOK_SPOOL_RETRY_S", "1"))
+RETRY_MAX = 60.0
+CHECKPOINT_INTERVAL = float(os.getenv("WEBHOOK_SPOOL_CHECKPOINT_MS", "200")) / 1000
+SEGMENT_BYTES = int(os.getenv("WEBHOOK_SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+LOCAL_DIR = os.getenv("WEBHOOK_SPOOL_DIR", "/tmp/retell-webhook-spool")
+BUCKET_NAME = os.getenv("WEBHOOK_SPOOL_BUCKET", "retell-calling-reference-data")
+PREFIX = os.getenv("WEBHOOK_SPOOL_PREFIX", "webhook_spool").strip("/")
+RECOVER_AFTER = float(os.getenv("WEBHOOK_SPOOL_RECOVER_S", "300"))
+
+_FRAME = struct.Struct(">II")  # body length, crc32(body)
+
+
+def _frames(data: bytes) -> Iterator[Tuple[int, bytes]]:
+    """(offset, body) of every intact record; stops at the first torn or corrupt one."""
+    offset = 0
+    while offset + _FRAME.size <= len(data):
+        size, crc = _FRAME.unpack_from(data, offset)
+        start = offset + _FRAME.size
+        body = data[start:start + size]
+        if len(body) < size or zlib.crc32(body) != crc:
+            return
+        yield offset, body
+        offset = start + size
+
+
+def _fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _segment_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f"{segment:012d}.log")
+
+
+def _segments(directory: str) -> List[int]:
+    return sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+
+
+def _read_checkpoint(directory: str) -> Tuple[Tuple[int, int], set]:
+    try:
+        with open(os.path.join(directory, "checkpoint.json")) as fh:
+            cp = json.load(fh)
+        return (cp["segment"], cp["offset"]), {tuple(rid) for rid in cp["done"]}
+    except FileNotFoundError:
+        return (0, 0), set()
+
+
+def _unfinished(directory: str) -> Tuple[List[int], set, List[Tuple[Tuple[int, int], bytes]]]:
+    """
+    Scan a slot: (segments left, ids finished beyond the watermark,
+    records its checkpoint has not passed).  Segments below the
+    watermark are deleted and a torn tail is cut off.
+    """
+    mark, done = _read_checkpoint(directory)
+    left, out = [], []
+    for segment in _segments(directory):
+        path = _segment_path(directory, segment)
+        if segment < mark[0]:
+            os.remove(path)
+            continue
+        left.append(segment)
+        with open(path, "rb") as fh:
+            data = fh.read()
+        good = 0
+        for offset, body in _frames(data):
+            good = offset + _FRAME.size + len(body)
+            rid = (segment, offset)
+            if rid >= mark and rid not in done:
+                out.append((rid, body))
+        if good < len(data):
+            print(f"webhook_spool: {path}: cut {len(data) - good} byte(s) of torn tail")
+            with open(path, "r+b") as fh:
+                fh.truncate(good)
+                os.fsync(fh.fileno())
+    return left, done, out
+
+
+# ──────────────────────────── Local log ────────────────────────────
+class _LocalLog:
+    """
+    Segmented append-only log; a record id is (segment, offset).
+    Records are pending from append (or replay) until acked; the
+    checkpoint is the lowest pending id plus the acked ids above it.
+    """
+
+    def __init__(
+        self,
+        directory: str = LOCAL_DIR,
+        segment_bytes: int = SEGMENT_BYTES,
+        checkpoint_interval: float = CHECKPOINT_INTERVAL,
+    ):
+        self.root = directory
+        self.segment_bytes = segment_bytes
+        self.checkpoint_interval = checkpoint_interval
+        self.directory: Optional[str] = None
+
+        self._lock = threading.Lock()             # appends and segment switches
+        self._sync_lock = threading.Lock()        # one fsync at a time, shared by waiters
+        self._state = threading.Lock()            # pending / done / end
+        self._checkpoint_lock = threading.Lock()
+        self._slot = None
+        self._fh = None
+        self._retired: list = []                  # rotated segments, closed by the next _sync
+        self._segment = 0
+        self._offset = 0
+        self._end: Tuple[int, int] = (0, 0)
+        self._synced: Tuple[int, int] = (0, 0)
+        self._pending: List[Tuple[int, int]] = []  # heap
+        self._done = set()
+        self._dirty = False
+        self._last_checkpoint = 0.0
+
+    def _path(self, segment: int) -> str:
+        return _segment_path(self.directory, segment)
+
+    @staticmethod
+    def _lock_slot(directory: str):
+        """The slot's lock file, flock'd; None when a live process holds it."""
+        fh = open(os.path.join(directory, "lock"), "w")
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fh.close()
+            return None
+        return fh
+
+    def _claim(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        for n in itertools.count():
+            directory = os.path.join(self.root, f"slot-{n}")
+            os.makedirs(directory, exist_ok=True)
+            fh = self._lock_slot(directory)
+            if fh is not None:
+                self.directory, self._slot = directory, fh
+                return
+
+    def _open_segment(self) -> None:
+        self._fh = open(self._path(self._segment), "ab", buffering=0)
+        self._offset = 0
+        _fsync_dir(self.directory)
+
+    def replay(self) -> List[Tuple[Any, bytes]]:
+        """Claim a slot; returns the records its checkpoint has not passed, in log order."""
+        self._claim()
+        segments, done, out = _unfinished(self.directory)
+        with self._lock:
+            self._segment = (segments[-1] + 1) if segments else 0
+            self._open_segment()
+            with self._state:
+                self._end = self._synced = (self._segment, 0)
+                self._pending = [rid for rid, _ in out]  # log order is heap order
+                self._done = done  # finished out of order last time; pruned once passed
+                self._dirty = True
+        self.checkpoint()
+        return out
+
+    def append(self, body: bytes) -> Tuple[int, int]:
+        """Write one record and return its id once it is on disk."""
+        frame = _FRAME.pack(len(body), zlib.crc32(body)) + body
+        with self._lock:
+            if self._offset and self._offset + len(frame) > self.segment_bytes:
+                os.fsync(self._fh.fileno())
+                self._retired.append(self._fh)
+                self._segment += 1
+                self._open_segment()
+            rid = (self._segment, self._offset)
+            self._fh.write(frame)
+            self._offset += len(frame)
+            with self._state:
+                # pushed under _lock: the watermark never passes a record still being written
+                heapq.heappush(self._pending, rid)
+                self._end = (self._segment, self._offset)
+        try:
+            self._sync((rid[0], rid[1] + len(frame)))
+        except Exception:
+            self.ack([rid])
+            raise
+        return rid
+
+    def _sync(self, upto: Tuple[int, int]) -> None:
+        with self._sync_lock:
+            if self._synced >= upto:
+                return  # an fsync that started after our write already covered it
+            with self._lock:
+                fh, end = self._fh, (self._segment, self._offset)
+                retired, self._retired = self._retired, []
+            with spans.span("spool_fsync"):
+                os.fsync(fh.fileno())
+            self._synced = end
+            for old in retired:
+                old.close()  # fsync'd when it was rotated out
+
+    def ack(self, rids: Iterable[Tuple[int, int]]) -> None:
+        with self._state:
+            self._done.update(rids)
+            while self._pending and self._pending[0] in self._done:
+                self._done.discard(heapq.heappop(self._pending))
+            self._dirty = True
+            due = time.monotonic() - self._last_checkpoint >= self.checkpoint_interval
+        if due:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """Persist the watermark if anything was acked since the last one; drop passed segments."""
+        with self._checkpoint_lock:
+            with self._state:
+                if not self._dirty or self.directory is None:
+                    return
+                mark = self._pending[0] if self._pending else self._end
+                self._done = {rid for rid in self._done if rid > mark}
+                done = sorted(self._done)
+                self._dirty = False
+                self._last_checkpoint = time.monotonic()
+            path = os.path.join(self.directory, "checkpoint.json")
+            try:
+                with open(path + ".tmp", "w") as fh:
+                    json.dump({"segment": mark[0], "offset": mark[1], "done": done}, fh)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.replace(path + ".tmp", path)
+                for segment in _segments(self.directory):
+                    if segment < mark[0]:
+                        os.remove(self._path(segment))
+            except OSError as e:
+                print(f"webhook_spool: checkpoint failed: {e}")
+                with self._state:
+                    self._dirty = True
+
+    def stale(self, older_than: float) -> List[Tuple[Any, bytes]]:
+        """
+        Adopt the slots no process holds – their process exited and none
+        replaced it (fewer workers after a restart): their unfinished
+        records are appended to this slot, then their segments and
+        checkpoint are removed.  The lock is the liveness test, so
+        `older_than` does not apply.
+        """
+        out = []
+        for name in sorted(os.listdir(self.root)):
+            directory = os.path.join(self.root, name)
+            if not name.startswith("slot-") or directory == self.directory:
+                continue
+            fh = self._lock_slot(directory)
+            if fh is None:
+                continue
+            try:
+                segments, _, records = _unfinished(directory)
+                for _, body in records:
+                    out.append((self.append(body), body))  # on disk here before it leaves there
+                for segment in segments:
+                    os.remove(_segment_path(directory, segment))
+                if os.path.exists(os.path.join(directory, "checkpoint.json")):
+                    os.remove(os.path.join(directory, "checkpoint.json"))
+            finally:
+                fh.close()
+        return out
+
+    def dead(self, rid: Tuple[int, int], body: bytes, error: str) -> None:
+        entry = {
+            "rid": list(rid),
+            "at": datetime.utcnow().isoformat(),
+            "error": error,
+            "body": body.decode("utf-8", "replace"),
+        }
+        with open(os.path.join(self.directory, "dead.ndjson"), "a") as fh:
+            fh.write(json.dumps(entry) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.ack([rid])
+
+    def close(self) -> None:
+        with self._state:
+            self._dirty = True
+        self.checkpoint()
+        with self._lock:
+            for fh in self._retired + [self._fh, self._slot]:
+                if fh is not None:
+                    fh.close()
+            self._retired, self._fh, self._slot = [], None, None
+
+
+# ───────────────────────────── GCS log ─────────────────────────────
+class _GcsLog:
+    """One create-only object per record; the object name is the record id."""
+
+    def __init__(self, storage_factory: Callable[[], Any], bucket_name: str = BUCKET_NAME, prefix: str = PREFIX):
+        self._storage_factory = storage_factory
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def _bucket(self):
+        client = self._storage_factory()
+        if client is None:
+            raise RuntimeError("webhook_spool: no storage client for the GCS spool")
+        return client.bucket(self.bucket_name)
+
+    def append(self, body: bytes) -> str:
+        name = f"{self.prefix}/{time.time_ns():020d}-{uuid.uuid4().hex}.json"
+        with spans.span("gcs_upload", len(body)):
+            self._bucket().blob(name).upload_from_string(
+                body, content_type="application/json", if_generation_match=0
+            )
+        return name
+
+    def ack(self, rids: Iterable[str]) -> None:
+        bucket = self._bucket()
+        for name in rids:
+            try:
+                bucket.blob(name).delete()
+            except NotFound:
+                pass
+
+    def replay(self) -> List[Tuple[Any, bytes]]:
+        return []  # a new instance holds nothing of its own – stale() adopts the dead's
+
+    def stale(self, older_than: float) -> List[Tuple[Any, bytes]]:
+        cutoff = time.time() - older_than
+        out = []
+        for blob in self._bucket().list_blobs(prefix=f"{self.prefix}/"):
+            if blob.time_created is not None and blob.time_created.timestamp() > cutoff:
+                continue
+            try:
+                out.append((blob.name, blob.download_as_bytes()))
+            except NotFound:
+                pass  # finished meanwhile
+        return out
+
+    def dead(self, rid: str, body: bytes, error: str) -> None:
+        blob = self._bucket().blob(f"{self.prefix}_dead/{rid.rsplit('/', 1)[-1]}")
+        blob.metadata = {"error": error[:1024]}
+        try:
+            blob.upload_from_string(body, content_type="application/json", if_generation_match=0)
+        except PreconditionFailed:
+            pass  # dead-lettered already by another instance
+        self.ack([rid])
+
+    def checkpoint(self) -> None:
+        pass  # every ack is a delete
+
+    def close(self) -> None:
+        pass
+
+
+def make_log(kind: str, storage_factory: Callable[[], Any] = None):
+    if kind == "gcs":
+        return _GcsLog(storage_factory or (lambda: None))
+    return _LocalLog()
+
+
+# ───────────────────────────── Spool ──────────────────────────────
+class WebhookSpool:
+    """
+    `handler(body)` processes one raw webhook body and raises to have it
+    retried; `log` is one of the logs above.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[bytes], None],
+        log,
+        workers: int = WORKERS,
+        max_pending: int = MAX_PENDING,
+        max_attempts: int = MAX_ATTEMPTS,
+        retry_base: float = RETRY_BASE,
+        recover_after: float = RECOVER_AFTER,
+    ):
+        self.handler = handler
+        self.log = log
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.recover_after = recover_after
+
+        self._ready = collections.deque()  # (rid, body, attempts)
+        self._delayed: list = []            # heap of (due monotonic, seq, item)
+        self._seq = itertools.count()
+        self._known = set()                 # ready, delayed or in flight
+        self._cond = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._inflight = 0
+        self._started = False
+        self._stopping = False
+        self._threads: List[threading.Thread] = []
+        self._next_recovery = 0.0
+        self._stats = {
+            "spooled": 0,
+            "processed": 0,
+            "retried": 0,       # failed runs scheduled again
+            "dead": 0,          # moved to the dead letters
+            "replayed": 0,      # from this slot's log at start
+            "recovered": 0,     # stale records of other instances
+            "inline": 0,        # processed by the request because the spool was full
+            "append_errors": 0, # processed by the request because the append failed
+        }
+
+    def start(self) -> None:
+        """Replay what the log still holds and start the workers (once)."""
+        with self._start_lock:
+            if self._started:
+                return
+            replayed = self.log.replay()
+            self._enqueue(replayed, "replayed")
+            if replayed:
+                print(f"webhook_spool: replaying {len(replayed)} spooled webhook(s).")
+            self._next_recovery = time.monotonic() + min(self.recover_after, 1.0)
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"webhook-spool-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._started = True
+
+    # ─────────────────────── producer side ───────────────────────
+    def submit(self, body: bytes) -> bool:
+        """
+        Durably spool `body` for the workers.  False means the caller must
+        process it itself: the spool is full or could not be written.
+        """
+        self.start()
+        with self._cond:
+            full = len(self._known) >= self.max_pending
+        if full:
+            self._count(inline=1)
+            return False
+        try:
+            with spans.span("spool_append", len(body)):
+                rid = self.log.append(body)
+        except Exception as e:
+            print(f"webhook_spool: append failed, processing inline: {e}")
+            self._count(append_errors=1)
+            return False
+        self._enqueue([(rid, body)], "spooled")
+        return True
+
+    def _enqueue(self, records: List[Tuple[Any, bytes]], counter: str) -> int:
+        with self._cond:
+            fresh = [(rid, body, 0) for rid, body in records if rid not in self._known]
+            for item in fresh:
+                self._known.add(item[0])
+                self._ready.append(item)
+            self._stats[counter] += len(fresh)
+            if fresh:
+                self._cond.notify_all()
+        return len(fresh)
+
+    # ─────────────────────── worker side ─────────────────────────
+    def _next(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    self._ready.append(heapq.heappop(self._delayed)[2])
+                if self._ready:
+                    self._inflight += 1
+                    return self._ready.popleft()
+                if self._stopping:
+                    return None
+                recover = now >= self._next_recovery
+                if recover:
+                    self._next_recovery = now + max(self.recover_after, 1.0)
+                else:
+                    waits = [self._next_recovery - now, CHECKPOINT_INTERVAL or 1.0]
+                    if self._delayed:
+                        waits.append(self._delayed[0][0] - now)
+                    self._cond.wait(min(waits))
+            if recover:
+                self._recover()
+            else:
+                self.log.checkpoint()  # idle: persist acks that did not reach the interval
+
+    def _recover(self) -> None:
+        try:
+            n = self._enqueue(self.log.stale(self.recover_after), "recovered")
+        except Exception as e:
+            print(f"webhook_spool: listing the spool failed: {e}")
+            return
+        if n:
+            print(f"webhook_spool: recovered {n} webhook(s) left by another instance.")
+
+    def _run(self) -> None:
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            try:
+                self.handler(item[1])
+            except Exception as e:
+                self._failed(item, e)
+            else:
+                self._settle(item[0], processed=1)
+            finally:
+                with self._cond:
+                    self._inflight -= 1
+                    self._cond.notify_all()
+
+    def _failed(self, item, error: Exception) -> None:
+        rid, body, attempts = item
+        attempts += 1
+        if attempts < self.max_attempts:
+            delay = min(RETRY_MAX, self.retry_base * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+            with self._cond:
+                heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), (rid, body, attempts)))
+                self._stats["retried"] += 1
+                self._cond.notify_all()
+            return
+        print(f"webhook_spool: giving up on {rid} after {attempts} attempt(s): {error}")
+        try:
+            self.log.dead(rid, body, str(error))
+        except Exception as e:
+            # left in the log: replayed by the next process (local) or recovered (gcs)
+            print(f"webhook_spool: could not dead-letter {rid}: {e}")
+            with self._cond:
+                self._known.discard(rid)
+            return
+        self._settle(rid, dead=1, ack=False)
+
+    def _settle(self, rid, ack: bool = True, **deltas: int) -> None:
+        with self._cond:
+            self._known.discard(rid)
+            for name, n in deltas.items():
+                self._stats[name] += n
+        if not ack:
+            return
+        try:
+            self.log.ack([rid])
+        except Exception as e:
+            # harmless: replayed / recovered later and absorbed by the handlers' idempotency
+            print(f"webhook_spool: could not ack {rid}: {e}")
+
+    def _count(self, **deltas: int) -> None:
+        with self._cond:
+            for name, n in deltas.items():
+                self._stats[name] += n
+
+    # ───────────────────────── control ───────────────────────────
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Wait for everything ready to be processed; True if nothing is left (retries included)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._ready or self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return not self._delayed
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Drain, stop the workers and checkpoint; retries still waiting stay in the log."""
+        deadline = time.monotonic() + timeout
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        self.log.close()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                **self._stats,
+                "queued": len(self._ready),
+                "delayed": len(self._delayed),
+                "inflight": self._inflight,
+            }
+
+
+# ─────────────────────── Process-wide spool ───────────────────────
+_spool: Optional[WebhookSpool] = None
+_spool_lock = threading.Lock()
+
+
+def get_spool(handler: Callable[[bytes], None], storage_factory: Callable[[], Any] = None) -> WebhookSpool:
+    """
+    The shared spool, created on first use with `handler` (and
+    `storage_factory` for the GCS log) and started at once so whatever
+    a previous process left behind is replayed.
+    """
+    global _spool
+    if _spool is None:
+        with _spool_lock:
+            if _spool is None:
+                spool = WebhookSpool(handler, make_log(SPOOL, storage_factory))
+                spool.start()
+                atexit.register(spool.close)
+                _spool = spool
+    return _spool
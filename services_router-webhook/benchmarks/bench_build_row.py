@@ -0,0 +1,182 @@
+"""
+benchmarks/bench_build_row.py
+─────────────────────────────────────────────────────────────
+Rows/sec of the per-handler `build_row`: the legacy hand-written
+version (a_field re-normalising the analysis dict on every lookup,
+kept verbatim below as the baseline) vs. the row_schema-compiled
+extractor now used by handlers/core.py.
+
+Also checks that both produce identical rows for every payload.
+
+  python benchmarks/bench_build_row.py
+  python benchmarks/bench_build_row.py --payloads 5000 --repeat 20 --json out.json
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from handlers import core  # noqa: E402
+
+
+# ─────────────────── Baseline: pre-row_schema build_row ───────────────────
+def _get_var(vars_dict, *keys, default=""):
+    if not isinstance(vars_dict, dict):
+        return default
+    for k in keys:
+        if k in vars_dict:
+            return vars_dict[k]
+    return default
+
+
+def _normalize_phone(raw):
+    if not raw or not isinstance(raw, str):
+        return ""
+    digits = "".join(ch for ch in raw if ch.isdigit())
+    return digits[1:] if len(digits) == 11 and digits.startswith("1") else digits
+
+
+def _get_valid_datetime(ts):
+    try:
+        if ts and isinstance(ts, (int, float)):
+            if ts > 10 ** 12:
+                ts /= 1000
+        return datetime.fromtimestamp(ts)
+    except Exception as e:
+        print(f"Core handler warning: bad timestamp {ts}: {e}")
+    return None
+
+
+def legacy_build_row(call, vars_, analysis, cost):
+    A = core.VAR_ALIASES
+
+    def a_field(*keys, default=""):
+        if not isinstance(analysis, dict):
+            return default
+        norm = {str(k).strip(): v for k, v in analysis.items()}
+        for k in keys:
+            if k in norm:
+                return norm[k]
+        return default
+
+    end_dt = _get_valid_datetime(call.get("end_timestamp"))
+    return {
+        "Date": end_dt.strftime("%Y-%m-%d %H:%M:%S") if end_dt else "",
+        "Phone": _normalize_phone(call.get("to_number", "")),
+        "Call Time": cost.get("total_duration_seconds", ""),
+        "First Name": _get_var(vars_, *A["First Name"]),
+        "Last Name": _get_var(vars_, *A["Last Name"]),
+        "Address": _get_var(vars_, *A["Address"]),
+        "City": _get_var(vars_, *A["City"]),
+        "Input State": _get_var(vars_, *A["State"]),
+        "State Given": a_field("_state"),
+        "Zip": _get_var(vars_, *A["Zip"]),
+        "Input Email": _get_var(vars_, *A["Email"]),
+        "Email Given": a_field("_email"),
+        "Accredited": str(a_field("_accredited_investor", "_accredited _investor")).lower(),
+        "Correct Name": str(a_field("_correct_name", "_correct _name")).lower(),
+        "New Investments": str(a_field("_new_investments", "_new _investments")).lower(),
+        "Sectors": a_field("_investment_sectors", "_investment _sectors"),
+        "DNC": str(a_field("_dnc", "_d_n_c")).lower(),
+        "Summary": a_field("_summary", "_call_summary", "_call _summary"),
+        "Quality": a_field("_quality"),
+        "Disconnection Reason": call.get("disconnection_reason", ""),
+        "Interested": str(a_field("_interested")).lower(),
+        "Liquid To Invest": str(a_field("_liquid_to_invest", "_liquid _to _invest")).lower(),
+        "Job": a_field("_job"),
+        "Follow Up": a_field("_follow_up", "_follow _up"),
+        "Past Experience": str(a_field("_past_experience", "_past _experience")).lower(),
+        "Recording": analysis.get("recording_url", ""),
+    }
+
+
+# ───────────────────────────── Fixtures ─────────────────────────────
+def make_payloads(n: int, seed: int = 7):
+    """(call, vars_, analysis, cost) tuples shaped like call_analyzed webhooks."""
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        call = {
+            "call_id": f"call_{i}",
+            "to_number": f"+1555{i:07d}",
+            "end_timestamp": 1_760_000_000_000 + i * 1000,
+            "disconnection_reason": rnd.choice(["user_hangup", "agent_hangup", "voicemail_reached"]),
+        }
+        vars_ = {
+            "first_name": "Pat",
+            "last_name": f"Lead{i}",
+            "address": "1 Main St",
+            "city": "Austin",
+            "state": "TX",
+            "zip": "78701",
+            "email": f"lead{i}@example.invalid",
+        }
+        analysis = {
+            "_state": "TX",
+            "_email": "",
+            "_accredited_investor": rnd.choice([True, False]),
+            # Retell pads some keys; the extractor has to strip them
+            "_correct_name ": rnd.choice(["Yes", "No"]),
+            "_new_investments": "Yes",
+            "_investment_sectors": "oil, real estate",
+            "_dnc": False,
+            "_summary": "Caller asked to follow up next week.",
+            "_quality": "good",
+            "_interested": "Yes",
+            "_liquid_to_invest": "50k",
+            "_job": "engineer",
+            "_follow_up": "next week",
+            "_past_experience": "No",
+            "recording_url": f"https://example.invalid/rec/{i}.wav",
+        }
+        cost = {"total_duration_seconds": 30 + i % 300}
+        out.append((call, vars_, analysis, cost))
+    return out
+
+
+def _rows_per_sec(fn, payloads, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for args in payloads:
+            fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    return len(payloads) / best
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--payloads", type=int, default=10_000)
+    ap.add_argument("--repeat", type=int, default=10, help="best-of-N timing")
+    ap.add_argument("--json", help="write results to this file")
+    args = ap.parse_args()
+
+    payloads = make_payloads(args.payloads)
+    with redirect_stdout(io.StringIO()):
+        mismatches = sum(legacy_build_row(*p) != core.build_row(*p) for p in payloads)
+    if mismatches:
+        sys.exit(f"{mismatches} payload(s) produce different rows – aborting")
+
+    results = []
+    for name, fn in (("legacy", legacy_build_row), ("compiled", core.build_row)):
+        rps = _rows_per_sec(fn, payloads, args.repeat)
+        results.append({"impl": name, "rows_per_sec": round(rps), "us_per_row": round(1e6 / rps, 2)})
+        print(f"{name:>9}  {rps:>12,.0f} rows/s  {1e6 / rps:7.2f} µs/row")
+    print(f"  speed-up  {results[1]['rows_per_sec'] / results[0]['rows_per_sec']:.1f}x")
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+benchmarks/bench_csv_engine.py
+─────────────────────────────────────────────────────────────
+Peak-RSS / latency comparison of the CSV merge engines used by
+append_to_gcs_csv: the legacy pandas read_csv → concat →
+drop_duplicates → to_csv path vs. gcs_csv.merge_csv_stream.
+
+Each (engine, size) pair runs in a fresh subprocess so peak RSS and
+import cost are not polluted by earlier runs.  No GCS access – the
+"existing object" is a local file of realistic webhook rows.
+
+  python benchmarks/bench_csv_engine.py                     # 10k/100k/1M
+  python benchmarks/bench_csv_engine.py --rows 10000 --json out.json
+
+The pandas engine is skipped if pandas is not installed.
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+HEADERS = [
+    "Date", "Phone", "Call Time", "First Name", "Last Name", "Address", "City",
+    "Input State", "State Given", "Zip", "Input Email", "Email Given",
+    "Accredited", "Correct Name", "New Investments", "Sectors", "DNC",
+    "Summary", "Quality", "Disconnection Reason", "Interested",
+    "Liquid To Invest", "Job", "Follow Up", "Past Experience", "Recording",
+]
+KEY = "Phone"
+
+
+def _fake_row(i: int) -> dict:
+    row = {h: "" for h in HEADERS}
+    row.update(
+        {
+            "Date": f"2025-01-{1 + i % 28:02d} 12:{i % 60:02d}:00",
+            "Phone": f"{5550000000 + i}",
+            "Call Time": str(30 + i % 300),
+            "First Name": "Pat",
+            "Last Name": f"Lead{i}",
+            "City": "Austin",
+            "Input State": "TX",
+            "Correct Name": "prospect reached",
+            # ~1 in 10 summaries quote the caller, which forces a full re-quote
+            "Summary": (
+                "Caller asked to follow up next week, said \"maybe\", no email."
+                if i % 10 == 0
+                else "Caller asked to follow up next week, no email given."
+            ),
+            "Recording": f"https://example.invalid/rec/{i}.wav",
+        }
+    )
+    return row
+
+
+def write_fixture(path: str, rows: int) -> None:
+    with open(path, "w", newline="", encoding="utf-8") as fh:
+        w = csv.writer(fh, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        w.writerow(HEADERS)
+        for i in range(rows):
+            r = _fake_row(i)
+            w.writerow([r[h] for h in HEADERS])
+
+
+# ─────────────────────────── Engines ───────────────────────────
+def run_pandas(data_path: str, new_row: dict) -> int:
+    import pandas as pd
+
+    with open(data_path, "rb") as fh:
+        existing_bytes = fh.read()
+    new_df = pd.DataFrame([new_row], columns=HEADERS)
+    existing_df = pd.read_csv(io.BytesIO(existing_bytes))
+    if not existing_df.columns.equals(new_df.columns):
+        existing_df = existing_df.reindex(columns=HEADERS)
+    combined_df = pd.concat([existing_df, new_df], ignore_index=True)
+    combined_df[KEY] = combined_df[KEY].astype(str)
+    combined_df.drop_duplicates(subset=[KEY], keep="last", inplace=True)
+    out = combined_df.to_csv(index=False, quoting=csv.QUOTE_ALL)
+    return len(out)
+
+
+def run_stream(data_path: str, new_row: dict) -> int:
+    import gcs_csv
+
+    with open(data_path, "rb") as src, tempfile.TemporaryFile() as out:
+        gcs_csv.merge_csv_stream(src, out, [new_row], HEADERS, KEY)
+        return out.tell()
+
+
+ENGINES = {"pandas": run_pandas, "stream": run_stream}
+
+
+def _child(engine: str, data_path: str, rows: int) -> None:
+    t0 = time.perf_counter()
+    if engine == "pandas":
+        import pandas  # noqa: F401  – import cost reported separately
+    else:
+        import gcs_csv  # noqa: F401
+    import_s = time.perf_counter() - t0
+
+    new_row = _fake_row(rows // 2)  # replaces an existing key
+    t1 = time.perf_counter()
+    out_bytes = ENGINES[engine](data_path, new_row)
+    merge_s = time.perf_counter() - t1
+
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(
+        json.dumps(
+            {
+                "engine": engine,
+                "rows": rows,
+                "import_ms": round(import_s * 1000, 1),
+                "merge_ms": round(merge_s * 1000, 1),
+                "peak_rss_mb": round(peak_kb / 1024, 1),
+                "output_bytes": out_bytes,
+            }
+        )
+    )
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    ap.add_argument("--engines", nargs="+", default=list(ENGINES))
+    ap.add_argument("--json", help="write results to this file")
+    ap.add_argument("--_child", nargs=3, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args._child:
+        engine, data_path, rows = args._child
+        _child(engine, data_path, int(rows))
+        return
+
+    engines = list(args.engines)
+    if "pandas" in engines:
+        try:
+            import pandas  # noqa: F401
+        except ImportError:
+            print("pandas not installed – skipping pandas engine")
+            engines.remove("pandas")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in args.rows:
+            data_path = os.path.join(tmp, f"existing_{rows}.csv")
+            write_fixture(data_path, rows)
+            size_mb = os.path.getsize(data_path) / 1e6
+            for engine in engines:
+                proc = subprocess.run(
+                    [sys.executable, __file__, "--_child", engine, data_path, str(rows)],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                res = json.loads(proc.stdout.strip().splitlines()[-1])
+                res["input_mb"] = round(size_mb, 1)
+                results.append(res)
+                print(
+                    f"{engine:>7} {rows:>9,} rows ({size_mb:7.1f} MB)  "
+                    f"merge {res['merge_ms']:>9.1f} ms  import {res['import_ms']:>7.1f} ms  "
+                    f"peak RSS {res['peak_rss_mb']:>7.1f} MB"
+                )
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
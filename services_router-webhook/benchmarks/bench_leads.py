@@ -0,0 +1,158 @@
+"""
+benchmarks/bench_leads.py
+─────────────────────────────────────────────────────────────
+Cost of recording a call on a Firestore lead as the lead accumulates
+attempts, against the in-process FakeFirestoreClient.
+
+  legacy   get the whole lead, scan disposition_history for the call_id,
+           then a separate @firestore.transactional update
+  leads    leads.record_call: one transaction that point-reads
+           leads/{id}/calls/{call_id} and commits the marker and the
+           lead update together
+
+Each --attempts point seeds a lead with that many earlier calls, both
+as disposition_history entries and as call markers, and then records
+--updates new calls followed by the same number of redeliveries.
+
+Reported per path and point: mean / p95 ms per new call and per
+redelivery, and Firestore calls, reads and bytes read per new call.
+Latency comes from the fake: --fs-ms per call plus --fs-mb-ms per MiB
+read.
+
+  python benchmarks/bench_leads.py
+  python benchmarks/bench_leads.py --attempts 0 100 500 2000 --updates 100 --json leads.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import fakes  # noqa: E402
+import leads  # noqa: E402
+from google.cloud import firestore  # noqa: E402  – imported up front, out of the timings
+
+ROW = {
+    "Correct Name": "prospect reached",
+    "Email Given": "pat@example.invalid",
+    "State Given": "TX",
+    "Accredited": "yes",
+    "New Investments": "no",
+    "Sectors": "energy, real estate",
+    "DNC": "false",
+    "Summary": "Caller asked to follow up next week, no email given.",
+    "Quality": "good",
+    "Call Time": 184,
+    "Disconnection Reason": "user_hangup",
+}
+
+
+def legacy_record(db, doc_id: str, call_id: str, row: dict) -> str:
+    """The pre-leads.py path: read + array scan, then a separate transaction."""
+    ref = db.collection(leads.LEADS_COLLECTION).document(doc_id)
+    snap = ref.get()
+    if not snap.exists:
+        return leads.MISSING
+    if any(d.get("call_id") == call_id for d in snap.to_dict().get("disposition_history", [])):
+        return leads.DUPLICATE
+
+    @firestore.transactional
+    def txn(t):
+        t.update(ref, leads.lead_update(firestore, call_id, row, datetime.utcnow()))
+
+    txn(db.transaction())
+    return leads.UPDATED
+
+
+PATHS = {"legacy": legacy_record, "leads": leads.record_call}
+
+
+def seed(db, doc_id: str, attempts: int) -> None:
+    start = datetime(2026, 1, 1)
+    history = [
+        {"call_id": f"call_{doc_id}_{k:05d}", "timestamp": start + timedelta(hours=k), "disposition": "voicemail"}
+        for k in range(attempts)
+    ]
+    db.docs[f"{leads.LEADS_COLLECTION}/{doc_id}"] = {
+        "First Name": "Pat",
+        "Phone": "5551234567",
+        "call_attempts": attempts,
+        "disposition_history": history,
+        "Status": "Called" if attempts else "New",
+    }
+    for entry in history:
+        db.docs[f"{leads.LEADS_COLLECTION}/{doc_id}/{leads.CALLS_COLLECTION}/{entry['call_id']}"] = dict(entry)
+
+
+def run_point(path: str, attempts: int, updates: int, fs_ms: float, fs_mb_ms: float) -> dict:
+    db = fakes.FakeFirestoreClient(fakes.Latency(fs_ms, 0.0, fs_mb_ms))
+    doc_id = f"lead_{attempts}"
+    seed(db, doc_id, attempts)
+    record = PATHS[path]
+
+    def timed(call_ids, expect):
+        ms = []
+        for call_id in call_ids:
+            t0 = time.perf_counter()
+            outcome = record(db, doc_id, call_id, ROW)
+            ms.append((time.perf_counter() - t0) * 1000)
+            assert outcome == expect, (path, call_id, outcome)
+        return ms
+
+    fresh = [f"call_new_{k:05d}" for k in range(updates)]
+    before = db.meter.snapshot()
+    new_ms = timed(fresh, leads.UPDATED)
+    after = db.meter.snapshot()
+    dup_ms = timed(fresh, leads.DUPLICATE)
+
+    lead = db.docs[f"{leads.LEADS_COLLECTION}/{doc_id}"]
+    assert lead["call_attempts"] == attempts + updates, lead["call_attempts"]
+
+    def per_call(name):
+        return (after.get(name, 0) - before.get(name, 0)) / updates
+
+    return {
+        "path": path,
+        "attempts": attempts,
+        "new_mean_ms": statistics.fmean(new_ms),
+        "new_p95_ms": sorted(new_ms)[int(0.95 * (len(new_ms) - 1))],
+        "dup_mean_ms": statistics.fmean(dup_ms),
+        "calls": per_call("calls"),
+        "reads": per_call("reads"),
+        "bytes_read": per_call("bytes_down"),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--attempts", type=int, nargs="+", default=[0, 100, 500, 1000])
+    ap.add_argument("--updates", type=int, default=50)
+    ap.add_argument("--fs-ms", type=float, default=15.0, help="per Firestore call")
+    ap.add_argument("--fs-mb-ms", type=float, default=40.0, help="per MiB read from Firestore")
+    ap.add_argument("--json", help="write the results to this file")
+    args = ap.parse_args()
+
+    results = []
+    print(f"{'path':<8} {'attempts':>8} {'new ms':>8} {'p95':>8} {'dup ms':>8} {'calls':>6} {'reads':>6} {'bytes read':>11}")
+    for attempts in args.attempts:
+        for path in PATHS:
+            r = run_point(path, attempts, args.updates, args.fs_ms, args.fs_mb_ms)
+            results.append(r)
+            print(
+                f"{r['path']:<8} {r['attempts']:>8} {r['new_mean_ms']:>8.1f} {r['new_p95_ms']:>8.1f} "
+                f"{r['dup_mean_ms']:>8.1f} {r['calls']:>6.1f} {r['reads']:>6.1f} {r['bytes_read']:>11.0f}"
+            )
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"settings": vars(args), "results": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+"""
+benchmarks/bench_router.py
+─────────────────────────────────────────────────────────────
+End-to-end latency of retell_webhook_router with no Google services:
+the in-process fakes from benchmarks/fakes.py (generation preconditions,
+injected latency) are installed through clients.install(), realistic
+call_analyzed payloads are POSTed through a real werkzeug request, and
+every request's wall time is recorded.
+
+Sweep dimensions (each point runs in a fresh subprocess, so peak RSS
+and warm caches are per point):
+  --rows         rows already in each target CSV      (1k … 1M)
+  --concurrency  requests in flight (threads, like a gen2 instance)
+  --server       wsgi: retell_webhook_router, a thread per request
+                 asgi: router_asgi on functions-framework's ASGI app,
+                 one event loop, handlers on ASGI_THREADS threads
+  --mix          agent mix: core | football | mixed | pipeline, or
+                 "agent_id=weight,…" against the routing table
+
+Reported per point: p50/p95/p99/max latency, throughput, peak RSS,
+bytes to/from GCS, BigQuery and Cloud Logging, Firestore calls, CSV
+write conflicts and status codes.  With WEBHOOK_ACK_MODE=spool the
+latency is the ack and spool_drain_ms the time the workers still
+needed afterwards.  --json saves the run (with git revision and
+settings) and --compare prints the deltas against an earlier run's
+file.
+
+  python benchmarks/bench_router.py
+  python benchmarks/bench_router.py --rows 1000 100000 1000000 --concurrency 1 8 32 \\
+      --mix core mixed pipeline --requests 300 --json runs/$(date +%F).json
+  python benchmarks/bench_router.py --rows 10000 --compare runs/2026-10-01.json
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+CORE_AGENTS = [
+    "agent_ac2199cdcb5af27a4e0684035e",
+    "agent_75254a5a68eaf2de1c6b108e38",
+    "agent_011ed302f36f8b8f67b3828546",
+    "agent_4f2c32a8c2ca2ba51b4424e79b",
+]
+FOOTBALL_AGENT = "agent_e1931906c2d794eaf3ec30a296"
+PIPELINE_AGENT = "agent_bench_pipeline"
+
+# extra route registered for the "pipeline" mix: schema-driven, Firestore on
+PIPELINE_ROUTE = {
+    "handler": "pipeline",
+    "label": "bench pipeline",
+    "bucket_name": "bench-pipeline-data",
+    "csv_path": "raw_leads/inbound_webhook.csv",
+    "key_column": "Phone",
+    "schema": "vista",
+    "use_firestore": True,
+}
+
+MIXES = {
+    "core": {a: 1 for a in CORE_AGENTS},
+    "football": {FOOTBALL_AGENT: 1},
+    "mixed": {**{a: 3 for a in CORE_AGENTS}, FOOTBALL_AGENT: 4},
+    "pipeline": {PIPELINE_AGENT: 1},
+}
+
+
+def parse_mix(spec: str) -> dict:
+    if spec in MIXES:
+        return MIXES[spec]
+    mix = {}
+    for part in spec.split(","):
+        agent, _, weight = part.partition("=")
+        mix[agent.strip()] = float(weight or 1)
+    return mix
+
+
+# ───────────────────────────── Fixtures ─────────────────────────────
+_TRANSCRIPT = (
+    "Agent: Hi, this is Alex calling about your investment inquiry. "
+    "User: Oh, hi. Yes, I filled out the form last week. "
+) * 20  # ~2 KB, the size class of real transcripts
+
+
+def make_payload(i: int, agent_id: str, phone: int, rnd: random.Random) -> dict:
+    return {
+        "event": "call_analyzed",
+        "call": {
+            "call_id": f"call_bench_{i:08d}_{rnd.getrandbits(32):08x}",
+            "agent_id": agent_id,
+            "to_number": f"+1{phone:010d}",
+            "from_number": "+15125550100",
+            "start_timestamp": 1_760_000_000_000 + i * 1000 - 90_000,
+            "end_timestamp": 1_760_000_000_000 + i * 1000,
+            "disconnection_reason": rnd.choice(["user_hangup", "agent_hangup", "voicemail_reached"]),
+            "recording_url": f"https://example.invalid/rec/{i}.wav",
+            "transcript": _TRANSCRIPT,
+            "call_cost": {"total_duration_seconds": 30 + i % 300},
+            "retell_llm_dynamic_variables": {
+                "first_name": "Pat",
+                "last_name": f"Lead{i}",
+                "address": "1 Main St",
+                "city": "Austin",
+                "state": "TX",
+                "zip": "78701",
+                "email": f"lead{i}@example.invalid",
+                "firestore_doc_id": f"lead{i:08d}",
+            },
+            "call_analysis": {
+                "custom_analysis_data": {
+                    "_state": "TX",
+                    "_email": "",
+                    "_accredited_investor": rnd.choice([True, False]),
+                    "_correct_name": rnd.choice(["Prospect Reached", "Wrong Number"]),
+                    "_new_investments": "Yes",
+                    "_investment_sectors": "oil, real estate",
+                    "_dnc": False,
+                    "_summary": "Caller asked to follow up next week, said \"maybe\".",
+                    "_quality": "good",
+                    "_interested": "Yes",
+                },
+            },
+        },
+    }
+
+
+def seed_csv(storage, pipe, rows: int) -> int:
+    """Put a `rows`-row CSV in pipe's target, built with its own build_row."""
+    buf = io.StringIO()
+    w = csv.writer(buf, quoting=csv.QUOTE_ALL, lineterminator="\n")
+    w.writerow(pipe.headers)
+    rnd = random.Random(rows)
+    for i in range(rows):
+        call = make_payload(i, "seed", 5_550_000_000 + i, rnd)["call"]
+        vars_, analysis, cost = pipe._sources(call)
+        row = pipe.build_row(call, vars_, analysis, cost)
+        w.writerow(["" if row.get(h) is None else row.get(h) for h in pipe.headers])
+    data = buf.getvalue().encode("utf-8")
+    storage.put(pipe.bucket_name, pipe.csv_path, data, content_type="text/csv")
+    return len(data)
+
+
+def _pct(sorted_ms, p: float) -> float:
+    if not sorted_ms:
+        return 0.0
+    k = min(len(sorted_ms) - 1, max(0, int(round(p / 100 * len(sorted_ms))) - 1))
+    return round(sorted_ms[k], 2)
+
+
+# ───────────────────────────── One point ────────────────────────────
+def drive_wsgi(bodies: list, n_warm: int, concurrency: int, settle) -> tuple:
+    """retell_webhook_router on a thread per request in flight, as functions-framework runs it."""
+    import router_webhook
+    from werkzeug.test import EnvironBuilder
+
+    requests = [
+        EnvironBuilder(method="POST", data=body, content_type="application/json").get_request()
+        for body in bodies
+    ]
+    for req in requests[:n_warm]:
+        router_webhook.retell_webhook_router(req)
+    base = settle()
+
+    def one(req):
+        t0 = time.perf_counter()
+        try:
+            result = router_webhook.retell_webhook_router(req)
+            status = result[1] if isinstance(result, tuple) else 200
+        except Exception:
+            status = "exception"
+        return (time.perf_counter() - t0) * 1000, status
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        timings = list(pool.map(one, requests[n_warm:]))
+    return base, timings, time.perf_counter() - t0
+
+
+def drive_asgi(bodies: list, n_warm: int, concurrency: int, settle) -> tuple:
+    """
+    router_asgi.retell_webhook_router_async in the Starlette app
+    `functions-framework --asgi` serves, on one event loop with
+    `concurrency` requests in flight (handlers on ASGI_THREADS threads).
+    """
+    import asyncio
+
+    from functions_framework.aio import create_asgi_app
+
+    app = create_asgi_app("retell_webhook_router_async", os.path.join(ROOT, "router_asgi.py"))
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/",
+        "raw_path": b"/",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"host", b"localhost")],
+        "server": ("localhost", 8080),
+        "client": ("127.0.0.1", 50000),
+    }
+
+    async def call(body):
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            sent.append(message)
+
+        await app(dict(scope), receive, send)
+        return sent[0]["status"]
+
+    async def run():
+        for body in bodies[:n_warm]:
+            await call(body)
+        base = settle()
+        gate = asyncio.Semaphore(concurrency)
+
+        async def one(body):
+            async with gate:
+                t0 = time.perf_counter()
+                try:
+                    status = await call(body)
+                except Exception:
+                    status = "exception"
+                return (time.perf_counter() - t0) * 1000, status
+
+        t0 = time.perf_counter()
+        timings = await asyncio.gather(*(one(body) for body in bodies[n_warm:]))
+        return base, timings, time.perf_counter() - t0
+
+    return asyncio.run(run())
+
+
+def run_point(point: dict) -> dict:
+    os.environ.setdefault("ROUTER_STARTUP_MODE", "lazy")
+    os.environ.setdefault("AGENT_CONFIG_URI", "")
+
+    import clients
+    import fakes
+
+    lat = point["latency"]
+    storage = fakes.FakeStorageClient(fakes.Latency(lat["gcs_ms"], lat["gcs_jitter_ms"], lat["gcs_mb_ms"], seed=1))
+    bigquery = fakes.FakeBigQueryClient(fakes.Latency(lat["bq_ms"], lat["bq_ms"] / 2, seed=2))
+    firestore = fakes.FakeFirestoreClient(fakes.Latency(lat["fs_ms"], lat["fs_ms"] / 2, seed=3))
+    logging = fakes.FakeLoggingClient(fakes.Latency(lat["log_ms"], seed=4))
+    clients.install(storage=storage, bigquery=bigquery, firestore=firestore, logging=logging)
+
+    import bq_sink
+    import gcs_csv
+    import router_webhook
+
+    mix = point["mix"]
+    if PIPELINE_AGENT in mix:
+        router_webhook.ROUTES.defaults[PIPELINE_AGENT] = PIPELINE_ROUTE
+    for agent in mix:
+        if router_webhook.ROUTES.route(agent) is None:
+            raise SystemExit(f"agent {agent!r} is not in the routing table")
+
+    # one seeded CSV per distinct target in the mix
+    seeded, fixture_bytes = set(), 0
+    for agent in mix:
+        _, handle = router_webhook.ROUTES.route(agent)
+        pipe = handle.__self__
+        if (pipe.bucket_name, pipe.csv_path) not in seeded:
+            seeded.add((pipe.bucket_name, pipe.csv_path))
+            fixture_bytes += seed_csv(storage, pipe, point["rows"])
+
+    rnd = random.Random(42)
+    agents, weights = zip(*mix.items())
+    n_warm, n = point["warmup"], point["requests"]
+    bodies = []
+    for i in range(n_warm + n):
+        agent = rnd.choices(agents, weights)[0]
+        # ~80% of calls hit a phone already in the CSV (dedupe replaces it)
+        phone = 5_550_000_000 + rnd.randrange(max(1, int(point["rows"] * 1.25)))
+        payload = make_payload(i, agent, phone, rnd)
+        firestore.docs[f"leads/{payload['call']['retell_llm_dynamic_variables']['firestore_doc_id']}"] = {
+            "disposition_history": [],
+        }
+        bodies.append(json.dumps(payload).encode())
+
+    def settle() -> dict:
+        """Finish the warm-up's background work; the meters' baseline."""
+        if router_webhook.SPOOL is not None:
+            router_webhook.SPOOL.flush(600)
+        bq_sink.get_sink(clients.bigquery).flush()
+        return {
+            "storage": storage.meter.snapshot(),
+            "bigquery": bigquery.meter.snapshot(),
+            "firestore": firestore.meter.snapshot(),
+            "logging": logging.meter.snapshot(),
+            "gcs_csv": gcs_csv.retry_stats(),
+        }
+
+    drive = drive_asgi if point["server"] == "asgi" else drive_wsgi
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull  # handlers print per request
+        try:
+            base, timings, wall = drive(bodies, n_warm, point["concurrency"], settle)
+            t1 = time.perf_counter()
+            if router_webhook.SPOOL is not None:  # WEBHOOK_ACK_MODE=spool: acked, not yet processed
+                router_webhook.SPOOL.flush(600)
+            spool_drain_ms = (time.perf_counter() - t1) * 1000
+            t1 = time.perf_counter()
+            bq_sink.get_sink(clients.bigquery).flush()
+            drain_ms = (time.perf_counter() - t1) * 1000
+        finally:
+            sys.stdout = stdout
+
+    def delta(now: dict, before: dict) -> dict:
+        return {k: v - before.get(k, 0) for k, v in now.items() if v - before.get(k, 0)}
+
+    ms = sorted(t for t, _ in timings)
+    statuses = {}
+    for _, status in timings:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    st = delta(storage.meter.snapshot(), base["storage"])
+    return {
+        "server": point["server"],
+        "rows": point["rows"],
+        "concurrency": point["concurrency"],
+        "mix": point["mix_name"],
+        "requests": n,
+        "fixture_mb": round(fixture_bytes / 1e6, 2),
+        "p50_ms": _pct(ms, 50),
+        "p95_ms": _pct(ms, 95),
+        "p99_ms": _pct(ms, 99),
+        "max_ms": round(ms[-1], 2) if ms else 0.0,
+        "mean_ms": round(sum(ms) / len(ms), 2) if ms else 0.0,
+        "throughput_rps": round(n / wall, 1) if wall else None,
+        "spool_drain_ms": round(spool_drain_ms, 1),
+        "bq_drain_ms": round(drain_ms, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "gcs_bytes_down": st.get("bytes_down", 0),
+        "gcs_bytes_up": st.get("bytes_up", 0),
+        "gcs_calls": st.get("calls", 0),
+        "bq_bytes_up": delta(bigquery.meter.snapshot(), base["bigquery"]).get("bytes_up", 0),
+        "firestore_calls": delta(firestore.meter.snapshot(), base["firestore"]).get("calls", 0),
+        "logging_bytes_up": delta(logging.meter.snapshot(), base["logging"]).get("bytes_up", 0),
+        "csv_conflicts": delta(gcs_csv.retry_stats(), base["gcs_csv"]).get("conflicts", 0),
+        "status": statuses,
+    }
+
+
+# ───────────────────────────── Driver ──────────────────────────────
+def _git_rev() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def _key(res: dict) -> tuple:
+    return (res.get("server", "wsgi"), res["rows"], res["concurrency"], res["mix"])
+
+
+def compare(results: list, path: str) -> None:
+    with open(path) as fh:
+        before = {_key(r): r for r in json.load(fh)["results"]}
+    print(f"\nvs. {path}:")
+    for res in results:
+        old = before.get(_key(res))
+        if old is None:
+            continue
+        cells = []
+        for name in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "peak_rss_mb"):
+            if old.get(name):
+                cells.append(f"{name} {100 * (res[name] - old[name]) / old[name]:+6.1f}%")
+        print(f"  {res.get('server', 'wsgi'):>4} {res['mix']:>8} rows={res['rows']:<9,} c={res['concurrency']:<3} " + "  ".join(cells))
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    ap.add_argument("--mix", nargs="+", default=["core", "mixed"])
+    ap.add_argument("--server", nargs="+", choices=["wsgi", "asgi"], default=["wsgi"])
+    ap.add_argument("--requests", type=int, default=200)
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--gcs-ms", type=float, default=25.0, help="per GCS call")
+    ap.add_argument("--gcs-jitter-ms", type=float, default=10.0)
+    ap.add_argument("--gcs-mb-ms", type=float, default=8.0, help="per MiB moved to/from GCS")
+    ap.add_argument("--bq-ms", type=float, default=40.0)
+    ap.add_argument("--fs-ms", type=float, default=15.0)
+    ap.add_argument("--log-ms", type=float, default=5.0)
+    ap.add_argument("--json", help="write the run to this file")
+    ap.add_argument("--compare", help="earlier --json file to diff against")
+    ap.add_argument("--_child", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args._child:
+        print(json.dumps(run_point(json.loads(args._child))))
+        return
+
+    latency = {
+        "gcs_ms": args.gcs_ms,
+        "gcs_jitter_ms": args.gcs_jitter_ms,
+        "gcs_mb_ms": args.gcs_mb_ms,
+        "bq_ms": args.bq_ms,
+        "fs_ms": args.fs_ms,
+        "log_ms": args.log_ms,
+    }
+    results = []
+    for server in args.server:
+        for mix_name in args.mix:
+            for rows in args.rows:
+                for conc in args.concurrency:
+                    point = {
+                        "server": server,
+                        "rows": rows,
+                        "concurrency": conc,
+                        "mix": parse_mix(mix_name),
+                        "mix_name": mix_name,
+                        "requests": args.requests,
+                        "warmup": args.warmup,
+                        "latency": latency,
+                    }
+                    proc = subprocess.run(
+                        [sys.executable, __file__, "--_child", json.dumps(point)],
+                        capture_output=True,
+                        text=True,
+                        cwd=ROOT,
+                    )
+                    if proc.returncode:
+                        print(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "child failed")
+                        continue
+                    res = json.loads(proc.stdout.strip().splitlines()[-1])
+                    results.append(res)
+                    print(
+                        f"{server:>4} {mix_name:>8} rows={rows:<9,} c={conc:<3} "
+                        f"p50 {res['p50_ms']:>8.1f}  p95 {res['p95_ms']:>8.1f}  p99 {res['p99_ms']:>8.1f} ms  "
+                        f"{res['throughput_rps']:>7.1f} req/s  RSS {res['peak_rss_mb']:>7.1f} MB  "
+                        f"GCS ↓{res['gcs_bytes_down'] / 1e6:8.1f} MB ↑{res['gcs_bytes_up'] / 1e6:8.1f} MB  "
+                        f"conflicts {res['csv_conflicts']}"
+                    )
+
+    if args.compare:
+        compare(results, args.compare)
+    if args.json:
+        run = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "git_rev": _git_rev(),
+                "python": platform.python_version(),
+                "host": platform.node(),
+                "cpus": os.cpu_count(),
+                "requests": args.requests,
+                "latency": latency,
+                "env": {k: v for k, v in os.environ.items() if k.startswith(("GCS_", "BQ_SINK_", "IDEMPOTENCY_", "WEBHOOK_", "ASGI_"))},
+            },
+            "results": results,
+        }
+        with open(args.json, "w") as fh:
+            json.dump(run, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
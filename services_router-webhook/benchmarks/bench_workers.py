@@ -0,0 +1,322 @@
+"""
+benchmarks/bench_workers.py
+─────────────────────────────────────────────────────────────
+Throughput of the multi-process profile – router_gunicorn.py under
+gunicorn.conf.py – as workers are added.
+
+Each --workers point starts gunicorn with that many workers on a free
+port.  Every worker installs the fakes from benchmarks/fakes.py, with
+storage a SharedStorageClient in a temporary directory: the workers
+write the same CSVs and the generation preconditions hold across
+processes, as they would against GCS.  BigQuery, Firestore and Cloud
+Logging are per-worker fakes.  A thread per request in flight POSTs
+call_analyzed payloads (bench_router.py's) over a keep-alive connection.
+
+Reported per point: throughput, speedup and efficiency against the
+first point, p50/p95/p99 latency, CSV write conflicts, flushes that
+waited for another worker's file lock, group-commit batches and the
+requests each worker served, all from `GET /_stats`.
+--no-file-locks runs with GROUP_COMMIT_LOCK_DIR off, so the workers
+only meet at the generation precondition.
+
+Scaling stops at the host's cores: the client shares them, and a
+target's flushes are serialised across workers by design.
+
+  python benchmarks/bench_workers.py
+  python benchmarks/bench_workers.py --workers 1 2 4 8 --concurrency 128 --rows 10000 --json workers.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import queue
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import bench_router  # noqa: E402
+
+
+# ─────────────────────────── Worker side ────────────────────────────
+def __getattr__(name):
+    """`gunicorn … bench_workers:app`: install the fakes in this worker, then load the router."""
+    if name != "app":
+        raise AttributeError(name)
+    import clients
+    import fakes
+
+    point = json.loads(os.environ["BENCH_WORKERS_POINT"])
+    lat = point["latency"]
+    firestore = fakes.FakeFirestoreClient(fakes.Latency(lat["fs_ms"], lat["fs_ms"] / 2))
+    for i in range(point["bodies"]):
+        firestore.docs[f"leads/lead{i:08d}"] = {"disposition_history": []}
+    clients.install(
+        storage=fakes.SharedStorageClient(
+            point["storage_dir"], fakes.Latency(lat["gcs_ms"], lat["gcs_jitter_ms"], lat["gcs_mb_ms"])
+        ),
+        bigquery=fakes.FakeBigQueryClient(fakes.Latency(lat["bq_ms"], lat["bq_ms"] / 2)),
+        firestore=firestore,
+        logging=fakes.FakeLoggingClient(fakes.Latency(lat["log_ms"])),
+    )
+    sys.stdout = open(os.devnull, "w")  # handlers print per request
+
+    import router_gunicorn
+
+    return router_gunicorn.app
+
+
+# ─────────────────────────── Client side ────────────────────────────
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _get_stats(port: int) -> dict:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("GET", "/_stats")
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def _wait_ready(port: int, proc: subprocess.Popen, timeout: float = 120.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"gunicorn exited with {proc.returncode}")
+        try:
+            _get_stats(port)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit("gunicorn did not come up")
+
+
+def _post_all(port: int, bodies: list, concurrency: int) -> tuple:
+    """POST every body with `concurrency` in flight; ([(ms, status)], wall seconds)."""
+    todo = queue.SimpleQueue()
+    for body in bodies:
+        todo.put(body)
+    timings = []
+    lock = threading.Lock()
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+        mine = []
+        while True:
+            try:
+                body = todo.get_nowait()
+            except queue.Empty:
+                break
+            t0 = time.perf_counter()
+            try:
+                conn.request("POST", "/", body=body, headers={"Content-Type": "application/json"})
+                resp = conn.getresponse()
+                resp.read()
+                status = resp.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+                status = "exception"
+            mine.append(((time.perf_counter() - t0) * 1000, status))
+        conn.close()
+        with lock:
+            timings.extend(mine)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return timings, time.perf_counter() - t0
+
+
+def _seed(storage_dir: str, mix: dict, rows: int, latency: dict) -> None:
+    """One `rows`-row CSV per distinct target in the mix, in the shared store."""
+    os.environ.setdefault("ROUTER_STARTUP_MODE", "lazy")
+    os.environ.setdefault("AGENT_CONFIG_URI", "")
+    import clients
+    import fakes
+
+    storage = fakes.SharedStorageClient(storage_dir)
+    clients.install(storage=storage)
+    import router_webhook
+
+    seeded = set()
+    for agent in mix:
+        route = router_webhook.ROUTES.route(agent)
+        if route is None:
+            raise SystemExit(f"agent {agent!r} is not in the routing table")
+        pipe = route[1].__self__
+        if (pipe.bucket_name, pipe.csv_path) not in seeded:
+            seeded.add((pipe.bucket_name, pipe.csv_path))
+            bench_router.seed_csv(storage, pipe, rows)
+
+
+def _delta(after: dict, before: dict) -> dict:
+    out = {}
+    for name, value in after.items():
+        if isinstance(value, dict):
+            out[name] = _delta(value, before.get(name, {}))
+        elif isinstance(value, (int, float)):
+            out[name] = value - before.get(name, 0)
+    return out
+
+
+def run_point(workers: int, args, bodies: list, latency: dict) -> dict:
+    """Warm up on the first --warmup × workers bodies, measure the last --requests."""
+    tmp = tempfile.mkdtemp(prefix="bench-workers-")
+    try:
+        storage_dir = os.path.join(tmp, "gcs")
+        _seed(storage_dir, bench_router.parse_mix(args.mix), args.rows, latency)
+        port = _free_port()
+        env = dict(
+            os.environ,
+            PORT=str(port),
+            WORKERS=str(workers),
+            THREADS=str(args.threads),
+            ROUTER_RUN_DIR=os.path.join(tmp, "run"),
+            ROUTER_STATS_S="0.5",
+            WEBHOOK_SPOOL_DIR=os.path.join(tmp, "spool"),
+            ROUTER_STARTUP_MODE="lazy",
+            AGENT_CONFIG_URI="",
+            BENCH_WORKERS_POINT=json.dumps(
+                {"storage_dir": storage_dir, "latency": latency, "bodies": len(bodies)}
+            ),
+        )
+        if args.no_file_locks:
+            env["GROUP_COMMIT_LOCK_DIR"] = ""
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+             "--chdir", HERE, "bench_workers:app"],
+            env=env,
+            cwd=ROOT,
+        )
+        try:
+            _wait_ready(port, proc)
+            n_warm = args.warmup * workers
+            _post_all(port, bodies[:n_warm], min(args.concurrency, n_warm) or 1)
+            time.sleep(1.0)
+            before = _get_stats(port)
+            timings, wall = _post_all(port, bodies[-args.requests:], args.concurrency)
+            time.sleep(1.0)  # every worker publishes again
+            after = _get_stats(port)
+        finally:
+            proc.terminate()
+            proc.wait(60)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    total = _delta(after["total"], before["total"])
+    served = {w["pid"]: w["requests"] for w in before["workers"]}
+    per_worker = sorted(w["requests"] - served.get(w["pid"], 0) for w in after["workers"])
+    ms = sorted(t for t, _ in timings)
+    statuses = {}
+    for _, status in timings:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "workers": workers,
+        "concurrency": args.concurrency,
+        "rows": args.rows,
+        "mix": args.mix,
+        "file_locks": not args.no_file_locks,
+        "requests": len(timings),
+        "throughput_rps": round(len(timings) / wall, 1) if wall else None,
+        "p50_ms": bench_router._pct(ms, 50),
+        "p95_ms": bench_router._pct(ms, 95),
+        "p99_ms": bench_router._pct(ms, 99),
+        "csv_conflicts": total.get("gcs_write", {}).get("conflicts", 0),
+        "file_lock_waits": total.get("group_commit", {}).get("file_lock_waits", 0),
+        "batches": total.get("group_commit", {}).get("batches", 0),
+        "per_worker": per_worker,
+        "status": statuses,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--workers", type=int, nargs="+",
+                    default=sorted({1, 2, max(1, (os.cpu_count() or 1) // 2), os.cpu_count() or 1}))
+    ap.add_argument("--threads", type=int, default=64, help="per worker")
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--rows", type=int, default=10_000)
+    ap.add_argument("--mix", default="mixed")
+    ap.add_argument("--requests", type=int, default=1000)
+    ap.add_argument("--warmup", type=int, default=5, help="per worker")
+    ap.add_argument("--no-file-locks", action="store_true")
+    ap.add_argument("--gcs-ms", type=float, default=25.0, help="per GCS call")
+    ap.add_argument("--gcs-jitter-ms", type=float, default=10.0)
+    ap.add_argument("--gcs-mb-ms", type=float, default=8.0, help="per MiB moved to/from GCS")
+    ap.add_argument("--bq-ms", type=float, default=40.0)
+    ap.add_argument("--fs-ms", type=float, default=15.0)
+    ap.add_argument("--log-ms", type=float, default=5.0)
+    ap.add_argument("--json", help="write the run to this file")
+    args = ap.parse_args()
+
+    latency = {
+        "gcs_ms": args.gcs_ms,
+        "gcs_jitter_ms": args.gcs_jitter_ms,
+        "gcs_mb_ms": args.gcs_mb_ms,
+        "bq_ms": args.bq_ms,
+        "fs_ms": args.fs_ms,
+        "log_ms": args.log_ms,
+    }
+    mix = bench_router.parse_mix(args.mix)
+    agents, weights = zip(*mix.items())
+    rnd = random.Random(42)
+    bodies = []
+    for i in range(args.warmup * max(args.workers) + args.requests):
+        phone = 5_550_000_000 + rnd.randrange(max(1, int(args.rows * 1.25)))
+        bodies.append(json.dumps(bench_router.make_payload(i, rnd.choices(agents, weights)[0], phone, rnd)).encode())
+
+    results = []
+    print(f"cpus {os.cpu_count()}, file locks {'off' if args.no_file_locks else 'on'}")
+    for workers in args.workers:
+        res = run_point(workers, args, bodies, latency)
+        first = results[0] if results else res
+        res["speedup"] = round(res["throughput_rps"] / first["throughput_rps"], 2)
+        res["efficiency"] = round(res["speedup"] * first["workers"] / workers, 2)
+        results.append(res)
+        print(
+            f"workers {workers:>3}  {res['throughput_rps']:>7.1f} req/s  x{res['speedup']:<5.2f} "
+            f"({100 * res['efficiency']:>3.0f}% efficiency)  "
+            f"p50 {res['p50_ms']:>7.1f}  p95 {res['p95_ms']:>7.1f}  p99 {res['p99_ms']:>7.1f} ms  "
+            f"conflicts {res['csv_conflicts']:>4}  lock waits {res['file_lock_waits']:>4}  "
+            f"batches {res['batches']:>4}  per worker {res['per_worker']}  {res['status']}"
+        )
+
+    if args.json:
+        run = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "git_rev": bench_router._git_rev(),
+                "python": platform.python_version(),
+                "host": platform.node(),
+                "cpus": os.cpu_count(),
+                "latency": latency,
+                "settings": vars(args),
+            },
+            "results": results,
+        }
+        with open(args.json, "w") as fh:
+            json.dump(run, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
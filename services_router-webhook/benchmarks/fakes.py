@@ -0,0 +1,731 @@
+"""
+benchmarks/fakes.py
+─────────────────────────────────────────────────────────────
+In-process stand-ins for the four Google clients the router uses, for
+benchmarks only – install them with clients.install(...).
+
+* FakeStorageClient   buckets / blobs with real generation semantics:
+                      if_generation_match (0 = create-only) → 412,
+                      if_generation_not_match → 304, missing → 404,
+                      gzip content_encoding transcoded unless
+                      raw_download, compose, list_blobs(prefix).
+* SharedStorageClient the same, kept in a directory so that several
+                      processes (gunicorn workers) see one store.
+* FakeBigQueryClient  insert_rows_json with insertId de-duplication.
+* FakeFirestoreClient documents, get_all, WriteBatch and transactions
+                      (optimistic: a document read in the transaction
+                      and changed before commit → Aborted, retried by
+                      @firestore.transactional), create → AlreadyExists,
+                      get_all(field_paths=…) masks, Increment /
+                      ArrayUnion / ArrayRemove and dotted field paths;
+                      reads are metered in (JSON) bytes.
+* FakeLoggingClient   logger(name).log_struct / log_text.
+
+Every client takes a `Latency` (fixed + jitter + per-MiB cost per call)
+and keeps a `Meter` of calls and bytes in each direction.
+"""
+
+import copy
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from google.api_core.exceptions import Aborted, AlreadyExists, NotFound, NotModified, PreconditionFailed
+
+
+# ─────────────────────── Latency / metering ───────────────────────
+class Latency:
+    """Per-call delay: base_ms + U(0, jitter_ms) + per_mb_ms for every MiB moved."""
+
+    def __init__(self, base_ms: float = 0.0, jitter_ms: float = 0.0, per_mb_ms: float = 0.0, seed: int = None):
+        self.base_ms = base_ms
+        self.jitter_ms = jitter_ms
+        self.per_mb_ms = per_mb_ms
+        self._rnd = random.Random(seed)
+
+    def wait(self, nbytes: int = 0) -> None:
+        ms = self.base_ms + self.per_mb_ms * nbytes / (1 << 20)
+        if self.jitter_ms:
+            ms += self._rnd.uniform(0, self.jitter_ms)
+        if ms > 0:
+            time.sleep(ms / 1000)
+
+
+NO_LATENCY = Latency()
+
+
+class Meter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+
+    def add(self, **deltas: int) -> None:
+        with self._lock:
+            for name, n in deltas.items():
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
+
+
+# ───────────────────────────── Storage ─────────────────────────────
+class _Object:
+    __slots__ = ("data", "generation", "metageneration", "content_type", "content_encoding", "metadata",
+                 "time_created")
+
+    def __init__(self, data, generation, content_type, content_encoding, metadata):
+        self.data = data
+        self.generation = generation
+        self.time_created = datetime.now(timezone.utc)
+        self.metageneration = 1
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.metadata = metadata
+
+
+class FakeStorageClient:
+    def __init__(self, latency: Latency = NO_LATENCY):
+        self.latency = latency
+        self.meter = Meter()
+        self._lock = threading.Lock()
+        self._objects: Dict[Tuple[str, str], _Object] = {}
+        self._generation = 0
+
+    def bucket(self, name: str) -> "FakeBucket":
+        return FakeBucket(self, name)
+
+    # direct access for fixtures – no latency, not metered
+    def put(self, bucket: str, name: str, data: bytes, content_type: str = None) -> int:
+        with self._lock:
+            self._generation += 1
+            self._objects[(bucket, name)] = _Object(data, self._generation, content_type, None, None)
+            return self._generation
+
+    def get(self, bucket: str, name: str) -> Optional[bytes]:
+        obj = self._objects.get((bucket, name))
+        return obj.data if obj else None
+
+    def _call(self, op: str, up: int = 0, down: int = 0) -> None:
+        self.meter.add(**{"calls": 1, f"op_{op}": 1, "bytes_up": up, "bytes_down": down})
+        self.latency.wait(up + down)
+
+
+class FakeBucket:
+    def __init__(self, client: FakeStorageClient, name: str):
+        self.client = client
+        self.name = name
+
+    def blob(self, name: str) -> "FakeBlob":
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str) -> Optional["FakeBlob"]:
+        self.client._call("get_metadata")
+        obj = self.client._objects.get((self.name, name))
+        if obj is None:
+            return None
+        blob = FakeBlob(self, name)
+        blob._load(obj)
+        return blob
+
+    def copy_blob(self, blob: "FakeBlob", destination_bucket: "FakeBucket", new_name: str = None,
+                  source_generation=None, **_) -> "FakeBlob":
+        self.client._call("copy")
+        with self.client._lock:
+            obj = self.client._objects.get(blob._key)
+            if obj is None or (source_generation is not None and obj.generation != source_generation):
+                raise NotFound(f"No such object: {self.name}/{blob.name}")
+            self.client._generation += 1
+            copied = _Object(obj.data, self.client._generation, obj.content_type, obj.content_encoding,
+                             copy.copy(obj.metadata))
+            self.client._objects[(destination_bucket.name, new_name or blob.name)] = copied
+        dest = FakeBlob(destination_bucket, new_name or blob.name)
+        dest._load(copied)
+        return dest
+
+    def list_blobs(self, prefix: str = "", start_offset: str = "") -> List["FakeBlob"]:
+        self.client._call("list")
+        out = []
+        with self.client._lock:
+            items = sorted(
+                (name, obj) for (bucket, name), obj in self.client._objects.items()
+                if bucket == self.name and name.startswith(prefix) and name >= start_offset
+            )
+        for name, obj in items:
+            blob = FakeBlob(self, name)
+            blob._load(obj)
+            out.append(blob)
+        return out
+
+
+class FakeBlob:
+    def __init__(self, bucket: FakeBucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.generation: Optional[int] = None
+        self.metageneration: Optional[int] = None
+        self.size: Optional[int] = None
+        self.content_type: Optional[str] = None
+        self.content_encoding: Optional[str] = None
+        self.metadata: Optional[Dict[str, str]] = None
+        self.time_created: Optional[datetime] = None
+
+    @property
+    def _client(self) -> FakeStorageClient:
+        return self.bucket.client
+
+    @property
+    def _key(self) -> Tuple[str, str]:
+        return (self.bucket.name, self.name)
+
+    def _load(self, obj: _Object) -> None:
+        self.generation = obj.generation
+        self.metageneration = obj.metageneration
+        self.size = len(obj.data)
+        self.content_type = obj.content_type
+        self.content_encoding = obj.content_encoding
+        self.metadata = obj.metadata
+        self.time_created = obj.time_created
+
+    def _check(
+        self, obj: Optional[_Object], if_generation_match=None, if_generation_not_match=None,
+        if_metageneration_match=None,
+    ) -> None:
+        current = obj.generation if obj else 0
+        if if_generation_match is not None and if_generation_match != current:
+            raise PreconditionFailed(f"{self.name}: generation {current} != {if_generation_match}")
+        if if_metageneration_match is not None and (obj is None or obj.metageneration != if_metageneration_match):
+            raise PreconditionFailed(f"{self.name}: metageneration != {if_metageneration_match}")
+        if if_generation_not_match is not None and obj is not None and if_generation_not_match == current:
+            raise NotModified(f"{self.name}: generation {current} unchanged")
+
+    # ─── reads ───
+    def download_as_bytes(
+        self, if_generation_match=None, if_generation_not_match=None, raw_download=False,
+        start: int = None, end: int = None, **_
+    ) -> bytes:
+        with self._client._lock:
+            obj = self._client._objects.get(self._key)
+            if obj is None:
+                missing = True
+            else:
+                missing = False
+                self._check(obj, if_generation_match, if_generation_not_match)
+                self._load(obj)
+                data = obj.data
+        if missing:
+            self._client._call("get")
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        if start is not None or end is not None:  # inclusive byte range, like the real client
+            data = data[start or 0:None if end is None else end + 1]
+        self._client._call("get", down=len(data))
+        if self.content_encoding == "gzip" and not raw_download:
+            data = gzip.decompress(data)
+        return data
+
+    def download_as_text(self, encoding: str = "utf-8", **kw) -> str:
+        return self.download_as_bytes(**kw).decode(encoding)
+
+    def download_to_file(self, fh, **kw) -> None:
+        fh.write(self.download_as_bytes(**kw))
+
+    def reload(self, **_) -> None:
+        self._client._call("get_metadata")
+        obj = self._client._objects.get(self._key)
+        if obj is None:
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        self._load(obj)
+
+    def exists(self, **_) -> bool:
+        self._client._call("get_metadata")
+        return self._key in self._client._objects
+
+    # ─── writes ───
+    def upload_from_string(
+        self, data, content_type: str = None, if_generation_match=None, if_metageneration_match=None, **_
+    ) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._client._call("put", up=len(data))
+        with self._client._lock:
+            self._check(self._client._objects.get(self._key), if_generation_match, None, if_metageneration_match)
+            self._client._generation += 1
+            obj = _Object(
+                bytes(data),
+                self._client._generation,
+                content_type or self.content_type,
+                self.content_encoding,
+                copy.copy(self.metadata),
+            )
+            self._client._objects[self._key] = obj
+            self._load(obj)
+
+    def upload_from_file(
+        self, fh, size: int = None, content_type: str = None, if_generation_match=None, if_metageneration_match=None, **_
+    ) -> None:
+        data = fh.read() if size is None else fh.read(size)
+        self.upload_from_string(
+            data,
+            content_type=content_type,
+            if_generation_match=if_generation_match,
+            if_metageneration_match=if_metageneration_match,
+        )
+
+    def patch(self, if_generation_match=None, if_metageneration_match=None, **_) -> None:
+        """Metadata-only update: same generation, metageneration + 1."""
+        self._client._call("patch")
+        with self._client._lock:
+            obj = self._client._objects.get(self._key)
+            if obj is None:
+                raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+            self._check(obj, if_generation_match, None, if_metageneration_match)
+            obj.metadata = {**(obj.metadata or {}), **(self.metadata or {})}
+            obj.metageneration += 1
+            self._load(obj)
+
+    def compose(self, sources: Iterable["FakeBlob"], if_generation_match=None, **_) -> None:
+        self._client._call("compose")
+        with self._client._lock:
+            parts = []
+            for src in sources:
+                obj = self._client._objects.get(src._key)
+                if obj is None:
+                    raise NotFound(f"No such object: {src.bucket.name}/{src.name}")
+                parts.append(obj.data)
+            self._check(self._client._objects.get(self._key), if_generation_match)
+            self._client._generation += 1
+            obj = _Object(b"".join(parts), self._client._generation, self.content_type, None,
+                          copy.copy(self.metadata))
+            self._client._objects[self._key] = obj
+            self._load(obj)
+
+    def delete(self, if_generation_match=None, **_) -> None:
+        self._client._call("delete")
+        with self._client._lock:
+            obj = self._client._objects.get(self._key)
+            if obj is None:
+                raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+            self._check(obj, if_generation_match)
+            del self._client._objects[self._key]
+
+
+class _HostLock:
+    """A lock held by one thread of one process: a thread lock plus an flock."""
+
+    def __init__(self, path: str):
+        self._thread_lock = threading.Lock()
+        self._fh = open(path, "a")
+        self._local = threading.local()
+
+    @property
+    def held(self) -> bool:
+        return getattr(self._local, "held", False)
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        fcntl.flock(self._fh, fcntl.LOCK_EX)
+        self._local.held = True
+        return self
+
+    def __exit__(self, *exc):
+        self._local.held = False
+        fcntl.flock(self._fh, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+
+class _DiskObjects:
+    """
+    The `_objects` mapping of FakeStorageClient as one pickle per object
+    (written with rename, so unlocked readers see whole objects).
+    Objects read under the lock and changed in place – patch() – are
+    written back when it is released.
+    """
+
+    def __init__(self, directory: str, lock: _HostLock):
+        self.directory = directory
+        self.lock = lock
+        self._touched = threading.local()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: Tuple[str, str]) -> str:
+        return os.path.join(self.directory, hashlib.sha1("\0".join(key).encode("utf-8")).hexdigest())
+
+    def _write(self, key: Tuple[str, str], obj: _Object) -> None:
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as fh:
+            pickle.dump((key, obj), fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def get(self, key: Tuple[str, str], default=None) -> Optional[_Object]:
+        try:
+            with open(self._path(key), "rb") as fh:
+                _, obj = pickle.load(fh)
+        except FileNotFoundError:
+            return default
+        if self.lock.held:
+            touched = getattr(self._touched, "objs", None)
+            if touched is None:
+                touched = self._touched.objs = []
+            touched.append((key, obj, obj.metageneration))
+        return obj
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return os.path.exists(self._path(key))
+
+    def __setitem__(self, key: Tuple[str, str], obj: _Object) -> None:
+        self._write(key, obj)
+
+    def __delitem__(self, key: Tuple[str, str]) -> None:
+        os.remove(self._path(key))
+
+    def items(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "rb") as fh:
+                    yield pickle.load(fh)
+            except FileNotFoundError:
+                continue
+
+    def write_back(self) -> None:
+        for key, obj, metageneration in getattr(self._touched, "objs", None) or []:
+            if obj.metageneration != metageneration and key in self:
+                self._write(key, obj)
+        self._touched.objs = []
+
+
+class _SharedStoreLock:
+    def __init__(self, lock: _HostLock, objects: _DiskObjects):
+        self._lock = lock
+        self._objects = objects
+
+    def __enter__(self):
+        self._lock.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self._objects.write_back()
+        finally:
+            self._lock.__exit__(*exc)
+
+
+class SharedStorageClient(FakeStorageClient):
+    """FakeStorageClient whose objects and generation counter live in `directory`."""
+
+    def __init__(self, directory: str, latency: Latency = NO_LATENCY):
+        super().__init__(latency)
+        os.makedirs(directory, exist_ok=True)
+        host_lock = _HostLock(os.path.join(directory, "lock"))
+        self._objects = _DiskObjects(os.path.join(directory, "objects"), host_lock)
+        self._lock = _SharedStoreLock(host_lock, self._objects)
+        self._counter = os.path.join(directory, "generation")
+
+    @property
+    def _generation(self) -> int:
+        try:
+            with open(self._counter) as fh:
+                return int(fh.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    @_generation.setter
+    def _generation(self, value: int) -> None:
+        if not hasattr(self, "_counter"):
+            return  # FakeStorageClient.__init__
+        with open(self._counter, "w") as fh:
+            fh.write(str(value))
+
+
+# ───────────────────────────── BigQuery ────────────────────────────
+class FakeBigQueryClient:
+    def __init__(self, latency: Latency = NO_LATENCY):
+        self.latency = latency
+        self.meter = Meter()
+        self._lock = threading.Lock()
+        self.tables: Dict[str, List[dict]] = {}
+        self._seen_ids: Dict[str, set] = {}
+
+    def insert_rows_json(self, table, json_rows: List[dict], row_ids: List[str] = None, **_) -> List[dict]:
+        table = str(table)
+        body = json.dumps(json_rows, default=str)
+        self.meter.add(calls=1, rows=len(json_rows), bytes_up=len(body))
+        self.latency.wait(len(body))
+        with self._lock:
+            rows = self.tables.setdefault(table, [])
+            seen = self._seen_ids.setdefault(table, set())
+            for i, row in enumerate(json_rows):
+                insert_id = row_ids[i] if row_ids else None
+                if insert_id is not None:
+                    if insert_id in seen:
+                        continue  # best-effort dedupe, like insertId
+                    seen.add(insert_id)
+                rows.append(row)
+        return []
+
+
+# ───────────────────────────── Firestore ───────────────────────────
+def _apply(doc: Dict[str, Any], updates: Dict[str, Any]) -> None:
+    """Apply an update() mapping (dotted paths, transforms) to `doc` in place."""
+    from google.cloud.firestore_v1 import transforms
+
+    for path, value in updates.items():
+        *parents, leaf = path.split(".")
+        target = doc
+        for part in parents:
+            target = target.setdefault(part, {})
+        if isinstance(value, transforms.Increment):
+            target[leaf] = target.get(leaf, 0) + value.value
+        elif isinstance(value, transforms.ArrayUnion):
+            current = list(target.get(leaf, []))
+            current.extend(v for v in value.values if v not in current)
+            target[leaf] = current
+        elif isinstance(value, transforms.ArrayRemove):
+            target[leaf] = [v for v in target.get(leaf, []) if v not in value.values]
+        elif value is transforms.DELETE_FIELD:
+            target.pop(leaf, None)
+        elif value is transforms.SERVER_TIMESTAMP:
+            target[leaf] = time.time()
+        else:
+            target[leaf] = copy.deepcopy(value)
+
+
+def _masked(doc: Optional[dict], field_paths: Optional[List[str]]) -> Optional[dict]:
+    """A copy of `doc` with only `field_paths` (dotted) kept, like a DocumentMask."""
+    if doc is None or field_paths is None:
+        return copy.deepcopy(doc)
+    out: Dict[str, Any] = {}
+    for path in field_paths:
+        *parents, leaf = path.split(".")
+        src, dst = doc, out
+        for part in parents:
+            src = src.get(part) if isinstance(src, dict) else None
+            dst = dst.setdefault(part, {})
+        if isinstance(src, dict) and leaf in src:
+            dst[leaf] = copy.deepcopy(src[leaf])
+    return out
+
+
+def _doc_size(doc: Optional[dict]) -> int:
+    """Rough wire size of a document (JSON bytes) for the meter and per-MiB latency."""
+    return len(json.dumps(doc, default=str)) if doc else 0
+
+
+class FakeSnapshot:
+    def __init__(self, reference: "FakeDocumentRef", data: Optional[dict]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[dict]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str) -> Any:
+        value = self._data or {}
+        for part in field.split("."):
+            value = value[part]
+        return value
+
+
+class FakeDocumentRef:
+    def __init__(self, client: "FakeFirestoreClient", path: str):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str) -> "FakeCollection":
+        return FakeCollection(self._client, f"{self.path}/{name}")
+
+    def get(self, transaction: "FakeTransaction" = None, **_) -> FakeSnapshot:
+        snap = self._client._read(self)
+        if transaction is not None:
+            transaction._seen[self.path] = self._client._versions.get(self.path, 0)
+        return snap
+
+    def set(self, data: dict, merge: bool = False) -> None:
+        self._client._write([("set_merge" if merge else "set", self, data)])
+
+    def update(self, data: dict) -> None:
+        self._client._write([("update", self, data)])
+
+    def delete(self) -> None:
+        self._client._write([("delete", self, None)])
+
+
+class FakeCollection:
+    def __init__(self, client: "FakeFirestoreClient", path: str):
+        self._client = client
+        self.path = path
+
+    def document(self, doc_id: str = None) -> FakeDocumentRef:
+        return FakeDocumentRef(self._client, f"{self.path}/{doc_id or uuid.uuid4().hex[:20]}")
+
+
+class FakeWriteBatch:
+    def __init__(self, client: "FakeFirestoreClient"):
+        self._client = client
+        self._writes: List[tuple] = []
+
+    def create(self, ref: FakeDocumentRef, data: dict) -> None:
+        self._writes.append(("create", ref, data))
+
+    def set(self, ref: FakeDocumentRef, data: dict, merge: bool = False) -> None:
+        self._writes.append(("set_merge" if merge else "set", ref, data))
+
+    def update(self, ref: FakeDocumentRef, data: dict) -> None:
+        self._writes.append(("update", ref, data))
+
+    def delete(self, ref: FakeDocumentRef) -> None:
+        self._writes.append(("delete", ref, None))
+
+    def commit(self) -> list:
+        if len(self._writes) > 500:
+            raise ValueError("a WriteBatch holds at most 500 writes")
+        self._client._write(self._writes)
+        return []
+
+
+class FakeTransaction(FakeWriteBatch):
+    """Just enough of firestore.Transaction for @firestore.transactional."""
+
+    def __init__(self, client: "FakeFirestoreClient", max_attempts: int = 5):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = False
+        self._id = None
+        self._seen: Dict[str, int] = {}
+
+    def _clean_up(self) -> None:
+        self._writes = []
+        self._seen = {}
+        self._id = None
+
+    def _begin(self, retry_id=None) -> None:
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self) -> None:
+        self._clean_up()
+
+    def _commit(self) -> list:
+        try:
+            self._client._write(self._writes, expect=self._seen)
+        finally:
+            self._clean_up()
+        return []
+
+    def get(self, ref: FakeDocumentRef) -> FakeSnapshot:
+        return ref.get(transaction=self)
+
+
+class FakeFirestoreClient:
+    def __init__(self, latency: Latency = NO_LATENCY):
+        self.latency = latency
+        self.meter = Meter()
+        self._lock = threading.Lock()
+        self.docs: Dict[str, dict] = {}
+        self._versions: Dict[str, int] = {}
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self, name)
+
+    def document(self, path: str) -> FakeDocumentRef:
+        return FakeDocumentRef(self, path)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5, **_) -> FakeTransaction:
+        return FakeTransaction(self, max_attempts)
+
+    def get_all(self, refs: Iterable[FakeDocumentRef], field_paths: List[str] = None, **_) -> List[FakeSnapshot]:
+        refs = list(refs)
+        with self._lock:
+            docs = [_masked(self.docs.get(ref.path), field_paths) for ref in refs]
+        size = sum(_doc_size(doc) for doc in docs)
+        self.meter.add(calls=1, reads=len(refs), bytes_down=size)
+        self.latency.wait(size)
+        return [FakeSnapshot(ref, doc) for ref, doc in zip(refs, docs)]
+
+    def _read(self, ref: FakeDocumentRef) -> FakeSnapshot:
+        with self._lock:
+            doc = copy.deepcopy(self.docs.get(ref.path))
+        size = _doc_size(doc)
+        self.meter.add(calls=1, reads=1, bytes_down=size)
+        self.latency.wait(size)
+        return FakeSnapshot(ref, doc)
+
+    def _write(self, writes: List[tuple], expect: Dict[str, int] = None) -> None:
+        self.meter.add(calls=1, commits=1, writes=len(writes))
+        self.latency.wait()
+        with self._lock:
+            for path, version in (expect or {}).items():
+                if self._versions.get(path, 0) != version:
+                    self.meter.add(aborted=1)
+                    raise Aborted(f"{path} changed during the transaction")
+            staged = {}
+            for op, ref, data in writes:
+                doc = staged.get(ref.path, self.docs.get(ref.path))
+                if op == "update":
+                    if doc is None:
+                        raise NotFound(f"No document to update: {ref.path}")
+                    doc = copy.deepcopy(doc)
+                    _apply(doc, data)
+                elif op in ("set", "create"):
+                    if op == "create" and doc is not None:
+                        raise AlreadyExists(f"Document already exists: {ref.path}")
+                    doc = {}
+                    _apply(doc, data)
+                elif op == "set_merge":
+                    doc = copy.deepcopy(doc) if doc is not None else {}
+                    _apply(doc, data)
+                else:
+                    doc = None
+                staged[ref.path] = doc
+            for path, doc in staged.items():
+                if doc is None:
+                    self.docs.pop(path, None)
+                else:
+                    self.docs[path] = doc
+                self._versions[path] = self._versions.get(path, 0) + 1
+
+
+# ───────────────────────────── Logging ─────────────────────────────
+class FakeLogger:
+    def __init__(self, client: "FakeLoggingClient", name: str):
+        self._client = client
+        self.name = name
+
+    def log_struct(self, info: dict, severity: str = None, **_) -> None:
+        self._client._emit(severity, json.dumps(info, default=str))
+
+    def log_text(self, text: str, severity: str = None, **_) -> None:
+        self._client._emit(severity, text)
+
+
+class FakeLoggingClient:
+    def __init__(self, latency: Latency = NO_LATENCY, keep: int = 1000):
+        self.latency = latency
+        self.meter = Meter()
+        self.keep = keep
+        self.entries: List[Tuple[Optional[str], str]] = []
+
+    def logger(self, name: str) -> FakeLogger:
+        return FakeLogger(self, name)
+
+    def _emit(self, severity: Optional[str], body: str) -> None:
+        self.meter.add(calls=1, bytes_up=len(body))
+        self.latency.wait(len(body))
+        if len(self.entries) < self.keep:
+            self.entries.append((severity, body))
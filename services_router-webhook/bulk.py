@@ -0,0 +1,175 @@
+"""
+bulk.py
+─────────────────────────────────────────────────────────────
+Bulk ingestion of call_analyzed events – backfills and re-sends after
+an outage without one HTTP request (and one CSV round-trip) per call.
+
+Input is a JSON array of webhook payloads, or NDJSON (one payload per
+line; a single payload object also works).  Events are routed exactly
+like retell_webhook_router does, then grouped per routed target – one
+group per compiled pipeline, i.e. per (bucket_name, csv_path) and
+schema – and each group gets one merged CSV write, one BigQuery
+hand-off and one Firestore batch (Pipeline.handle_batch).  Routes that
+are not pipeline-backed fall back to their handle() one event at a time.
+
+Every event gets a result:
+
+    {"index": 3, "call_id": "call_…", "agent_id": "agent_…",
+     "status": "ok" | "duplicate" | "skipped" | "ignored" |
+               "not_routed" | "error",
+     "error": "…"}                        # only when there is one
+
+HTTP:  retell_webhook_bulk in router_webhook.py (POST the body).
+CLI:   python bulk.py events.ndjson [--json report.json]
+       python bulk.py - < events.json
+"""
+
+import argparse
+import json
+import os
+import sys
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import pipeline
+
+Route = Optional[Tuple[Dict[str, Any], Any]]
+
+
+class BadEvent(ValueError):
+    """An NDJSON line that did not decode; reported as that event's error."""
+
+
+# ───────────────────────────── Parsing ─────────────────────────────
+def parse_events(body: Union[bytes, str]) -> List[Any]:
+    """
+    Decode a JSON array or NDJSON body into a list of payloads.
+    Raises ValueError if a JSON array body does not decode; a bad NDJSON
+    line becomes a BadEvent in its slot instead.
+    """
+    text = body.decode("utf-8") if isinstance(body, bytes) else body
+    text = text.strip()
+    if not text:
+        return []
+    if text.startswith("["):
+        events = json.loads(text)
+        if not isinstance(events, list):
+            raise ValueError("expected a JSON array of events")
+        return events
+
+    events: List[Any] = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            events.append(json.loads(line))
+        except ValueError as exc:
+            events.append(BadEvent(f"line {lineno}: {exc}"))
+    return events
+
+
+# ───────────────────────────── Ingest ──────────────────────────────
+def _result(index: int, call: dict, status: str, error: Optional[str] = None) -> Dict[str, Any]:
+    out = {
+        "index": index,
+        "call_id": call.get("call_id"),
+        "agent_id": call.get("agent_id"),
+        "status": status,
+    }
+    if error:
+        out["error"] = error
+    return out
+
+
+def ingest(events: List[Any], route: Callable[[str], Route]) -> List[Dict[str, Any]]:
+    """Route, group and process `events`; one result dict per event, in order."""
+    results: List[Optional[Dict[str, Any]]] = [None] * len(events)
+    groups: Dict[pipeline.Pipeline, List[Tuple[int, dict, dict]]] = {}
+    singles: List[Tuple[int, dict, dict, dict, Any]] = []
+
+    for i, payload in enumerate(events):
+        if isinstance(payload, BadEvent):
+            results[i] = _result(i, {}, "error", f"invalid JSON ({payload})")
+            continue
+        if not isinstance(payload, dict):
+            results[i] = _result(i, {}, "error", "event is not a JSON object")
+            continue
+        if payload.get("event") != "call_analyzed":
+            results[i] = _result(i, {}, "ignored")
+            continue
+        call = payload.get("data") or payload.get("call", {})
+        agent_id = call.get("agent_id", "")
+        if not agent_id:
+            results[i] = _result(i, call, "error", "missing agent_id")
+            continue
+        found = route(agent_id)
+        if found is None:
+            results[i] = _result(i, call, "not_routed")
+            continue
+        config, handle = found
+        if isinstance(handle, Exception):
+            results[i] = _result(i, call, "error", f"route failed to load: {handle}")
+            continue
+        target = getattr(handle, "__self__", None)
+        if isinstance(target, pipeline.Pipeline):
+            groups.setdefault(target, []).append((i, payload, call))
+        else:
+            singles.append((i, payload, call, config, handle))
+
+    for target, members in groups.items():
+        try:
+            outcomes = target.handle_batch([(payload, call) for _, payload, call in members])
+        except Exception as exc:
+            outcomes = [("error", str(exc))] * len(members)
+        for (i, _, call), (status, error) in zip(members, outcomes):
+            results[i] = _result(i, call, status, error)
+
+    for i, payload, call, config, handle in singles:
+        try:
+            handle(payload, call, config)
+            results[i] = _result(i, call, "ok")
+        except Exception as exc:
+            results[i] = _result(i, call, "error", str(exc))
+
+    print(
+        f"bulk: {len(events)} event(s) in {len(groups)} group(s)"
+        f" + {len(singles)} single(s): {dict(summarize(results))}"
+    )
+    return results
+
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, int]:
+    return dict(Counter(r["status"] for r in results))
+
+
+# ─────────────────────────────── CLI ───────────────────────────────
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Bulk-ingest call_analyzed events (JSON array or NDJSON).")
+    ap.add_argument("path", help="events file, or - for stdin")
+    ap.add_argument("--json", help="write the per-event report to this file")
+    args = ap.parse_args(argv)
+
+    # routes are resolved on demand; no need for the prewarm thread here
+    os.environ.setdefault("ROUTER_STARTUP_MODE", "lazy")
+    import bq_sink
+    import clients
+    import router_webhook
+
+    with (sys.stdin.buffer if args.path == "-" else open(args.path, "rb")) as fh:
+        events = parse_events(fh.read())
+    results = ingest(events, router_webhook.ROUTES.route)
+    bq_sink.get_sink(clients.bigquery).flush()
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+    failed = [r for r in results if r["status"] == "error"]
+    for r in failed:
+        print(f"  #{r['index']} {r['call_id']}: {r['error']}")
+    print(json.dumps(summarize(results)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
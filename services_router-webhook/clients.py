@@ -0,0 +1,131 @@
+"""
+clients.py
+─────────────────────────────────────────────────────────────
+Process-wide registry of Google Cloud clients.
+
+Every handler and the router obtain their clients from here, so a
+warm instance that has served several campaigns holds exactly one
+storage, BigQuery, Firestore and Cloud Logging client – instead of
+one set per handler module.
+
+* Lazy: nothing is imported or constructed until first use.
+* Storage, BigQuery and Logging share one authorised keep-alive
+  HTTP session whose connection pool size is GCP_HTTP_POOL_SIZE.
+* Test seam: `install(storage=fake, bigquery=fake, ...)` swaps in
+  local stand-ins; `reset()` drops everything.
+
+Getters return None (and print why) when a client cannot be built,
+matching the handlers' previous "client missing – aborting" checks.
+"""
+
+import os
+import threading
+from typing import Any, Dict, Optional
+
+PROJECT_ID = os.getenv("GCP_PROJECT", "retell-calling")
+POOL_SIZE = int(os.getenv("GCP_HTTP_POOL_SIZE", "32"))
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+_lock = threading.RLock()
+_clients: Dict[str, Any] = {}
+_session = None
+
+
+def _http_session():
+    """One authorised requests session with a widened keep-alive pool."""
+    global _session
+    if _session is None:
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+        from requests.adapters import HTTPAdapter
+
+        credentials, _ = google.auth.default(scopes=SCOPES)
+        session = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        session.mount("https://", adapter)
+        _session = session
+    return _session
+
+
+def _build_storage():
+    from google.cloud import storage
+
+    return storage.Client(project=PROJECT_ID, _http=_http_session())
+
+
+def _build_bigquery():
+    from google.cloud import bigquery
+
+    return bigquery.Client(project=PROJECT_ID, _http=_http_session())
+
+
+def _build_firestore():
+    from google.cloud import firestore  # gRPC – keeps its own channel
+
+    return firestore.Client(project=PROJECT_ID)
+
+
+def _build_logging():
+    from google.cloud import logging
+
+    return logging.Client(project=PROJECT_ID, _http=_http_session(), _use_grpc=False)
+
+
+_BUILDERS = {
+    "storage": _build_storage,
+    "bigquery": _build_bigquery,
+    "firestore": _build_firestore,
+    "logging": _build_logging,
+}
+
+
+def _get(kind: str) -> Optional[Any]:
+    client = _clients.get(kind)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(kind)
+        if client is None:
+            try:
+                client = _BUILDERS[kind]()
+            except Exception as exc:
+                print(f"clients: failed to initialise {kind} client – {exc}")
+                return None
+            _clients[kind] = client
+            print(f"clients: {kind} client initialised (pool={POOL_SIZE}).")
+    return client
+
+
+def storage():
+    return _get("storage")
+
+
+def bigquery():
+    return _get("bigquery")
+
+
+def firestore():
+    return _get("firestore")
+
+
+def logger(name: str):
+    client = _get("logging")
+    return client.logger(name) if client is not None else None
+
+
+# ───────────────────────── Test seam ──────────────────────────
+def install(**fakes: Any) -> None:
+    """Register pre-built clients, e.g. install(storage=FakeStorageClient())."""
+    unknown = set(fakes) - set(_BUILDERS)
+    if unknown:
+        raise ValueError(f"unknown client kind(s): {sorted(unknown)}")
+    with _lock:
+        _clients.update(fakes)
+
+
+def reset() -> None:
+    """Forget every client (and the shared session)."""
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
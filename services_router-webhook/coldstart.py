@@ -0,0 +1,97 @@
+"""
+coldstart.py
+─────────────────────────────────────────────────────────────
+Cold-start budget helpers for router_webhook.py.
+
+* `timed(step)`          – context manager recording a named startup step.
+* `import_module(path)`  – importlib.import_module with per-module timing
+                           (only the first, real import is recorded).
+* `prewarm(*loaders)`    – run loaders on a daemon thread so the first
+                           request does not pay for them.
+* `report()`             – the breakdown as a dict, ready for _log_struct.
+
+Timings are wall-clock milliseconds measured from when this module was
+first imported (≈ process start for the router).
+"""
+
+import importlib
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+_T0 = time.perf_counter()
+_lock = threading.Lock()
+_steps: List[Dict] = []
+_warm_done = threading.Event()
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 1)
+
+
+@contextmanager
+def timed(step: str, **extra):
+    start = time.perf_counter()
+    modules_before = len(sys.modules)
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        with _lock:
+            _steps.append(
+                {
+                    "step": step,
+                    "ms": _ms(end - start),
+                    "at_ms": _ms(start - _T0),
+                    "new_modules": len(sys.modules) - modules_before,
+                    "thread": threading.current_thread().name,
+                    **extra,
+                }
+            )
+
+
+def import_module(modpath: str):
+    """Import `modpath`, recording how long the first import took."""
+    if modpath in sys.modules:
+        # may still be initialising on the prewarm thread – importlib waits
+        return importlib.import_module(modpath)
+    with timed(f"import {modpath}", kind="import"):
+        return importlib.import_module(modpath)
+
+
+def prewarm(*loaders: Callable[[], None]) -> threading.Thread:
+    """Run `loaders` in order on a background daemon thread."""
+
+    def _run():
+        for loader in loaders:
+            try:
+                loader()
+            except Exception as exc:  # pragma: no cover - best effort
+                print(f"coldstart: prewarm step {loader.__name__} failed: {exc}")
+        _warm_done.set()
+
+    thread = threading.Thread(target=_run, name="router-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+def mark_warm() -> None:
+    _warm_done.set()
+
+
+def is_warm() -> bool:
+    return _warm_done.is_set()
+
+
+def report() -> Dict:
+    """Startup breakdown: every recorded step plus import subtotal."""
+    with _lock:
+        steps = list(_steps)
+    return {
+        "uptime_ms": _ms(time.perf_counter() - _T0),
+        "warm": _warm_done.is_set(),
+        "import_ms_total": round(sum(s["ms"] for s in steps if s.get("kind") == "import"), 1),
+        "steps": steps,
+    }
@@ -0,0 +1,471 @@
+"""
+gcs_keyindex.py
+─────────────────────────────────────────────────────────────
+Persistent dedupe-key index for the webhook CSVs, so an append does not
+download and re-parse the whole file just to apply last-write-wins.
+
+    raw_leads/inbound_webhook.csv          the CSV (canonical QUOTE_ALL rows)
+    raw_leads/inbound_webhook.csv.keyidx   sorted 64-bit key hashes → row byte range
+
+Each key_column value is hashed (blake2b, 8 bytes).  The sidecar stores the
+hashes sorted, with each row's offset and length, so looking up a key is a
+binary search.  An append then goes one of two ways:
+
+  * new keys only (the usual case): upload the new rows as a temporary
+    object and `compose` [CSV, rows] onto the CSV, guarded by
+    if_generation_match.  Only the new rows' bytes are moved; the CSV is
+    neither downloaded nor parsed.
+  * a key that already exists: download the CSV, check the indexed row
+    really has that key, and copy the file byte-for-byte around the
+    superseded rows before appending.  There is no csv parse.
+
+Either way the result is byte-identical to gcs_csv.merge_csv_stream.
+
+An index is valid for one "epoch" of the CSV, meaning the run of
+generations built by composes since the last full rewrite.  The epoch
+token is stored in the CSV's `keyidx_epoch` metadata.  Instances cache the
+index in memory together with the generation it covers:
+
+  * same generation         → use it as is;
+  * same epoch, file grew   → ranged GET of the new tail, index only that;
+  * anything else           → load the sidecar (then catch up its tail),
+                              or rebuild it with one scan of the CSV.
+
+The sidecar is uploaded after a rebuild, after every rewrite, and every
+GCS_KEY_INDEX_FLUSH_ROWS composed rows.  It is only a cache: losing it,
+or having it overwritten by a stale one, costs one rebuild.
+
+Anything this path cannot copy byte-for-byte goes through
+gcs_csv.read_modify_write once.  That covers a missing or gzip-encoded
+CSV, header drift, non-canonical rows, duplicate keys written by another
+tool, and a hash collision.  The merge canonicalises the file, and the
+next append rebuilds the index from it.
+
+Tunables (environment):
+  GCS_KEY_INDEX              "on" / "off"                    (default on)
+  GCS_KEY_INDEX_FLUSH_ROWS   composed rows per sidecar upload (default 500)
+"""
+
+import bisect
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+import gcs_csv
+import spans
+
+ENABLED = os.getenv("GCS_KEY_INDEX", "on").lower() not in ("0", "off", "false", "no")
+FLUSH_ROWS = int(os.getenv("GCS_KEY_INDEX_FLUSH_ROWS", "500"))
+
+SIDECAR_SUFFIX = ".keyidx"
+TMP_SUFFIX = ".keyidx.tmp/"
+EPOCH_KEY = "keyidx_epoch"
+MAGIC = b"KEYIDX1\n"
+FOLD_AT = 4096  # appended entries kept in a dict before merging into the arrays
+
+Entry = Tuple[int, int, int]  # (key hash, row offset, row length)
+
+# ───────────────────────── Counters ──────────────────────────
+_stats_lock = threading.Lock()
+_stats: Dict[str, int] = {
+    "composes": 0,     # appends of new keys only (no download)
+    "rewrites": 0,     # appends that replaced existing keys
+    "catch_ups": 0,    # index extended from the CSV tail
+    "loads": 0,        # index read from the sidecar
+    "builds": 0,       # index rebuilt from a full scan
+    "flushes": 0,      # sidecar uploads
+    "fallbacks": 0,    # writes handed to gcs_csv.read_modify_write
+}
+
+
+def _bump(name: str, n: int = 1) -> None:
+    with _stats_lock:
+        _stats[name] += n
+
+
+def stats() -> Dict[str, int]:
+    """Snapshot of the process-wide index counters."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def sidecar_name(csv_path: str) -> str:
+    return f"{csv_path}{SIDECAR_SUFFIX}"
+
+
+def _hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def _signature(headers: List[str], key_column: str) -> str:
+    """An index only applies to the header layout and key it was built for."""
+    return hashlib.blake2b(json.dumps([headers, key_column]).encode("utf-8"), digest_size=8).hexdigest()
+
+
+class _Unindexable(Exception):
+    """The CSV (or a row in it) cannot be handled byte-for-byte – use the merge."""
+
+
+# ─────────────────────────── Index ───────────────────────────
+class KeyIndex:
+    """Sorted key hashes → (offset, length) of every row of one CSV generation."""
+
+    def __init__(self, sig: str, epoch: str, generation: int, size: int, entries: List[Entry] = ()):
+        self.sig = sig
+        self.epoch = epoch
+        self.generation = generation
+        self.size = size            # CSV bytes covered
+        self.unflushed = 0          # rows added since the sidecar was written
+        self._set(entries)
+
+    def _set(self, entries: List[Entry]) -> None:
+        self.hashes = array("Q", (e[0] for e in entries))
+        self.offsets = array("Q", (e[1] for e in entries))
+        self.lengths = array("Q", (e[2] for e in entries))
+        self.delta: Dict[int, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.hashes) + len(self.delta)
+
+    def find(self, h: int) -> Optional[Tuple[int, int]]:
+        hit = self.delta.get(h)
+        if hit is not None:
+            return hit
+        i = bisect.bisect_left(self.hashes, h)
+        if i < len(self.hashes) and self.hashes[i] == h:
+            return self.offsets[i], self.lengths[i]
+        return None
+
+    def add(self, h: int, offset: int, length: int) -> None:
+        self.delta[h] = (offset, length)
+        if len(self.delta) >= FOLD_AT:
+            self.fold()
+
+    def entries(self) -> Iterator[Entry]:
+        yield from zip(self.hashes, self.offsets, self.lengths)
+        for h, (offset, length) in self.delta.items():
+            yield h, offset, length
+
+    def fold(self) -> None:
+        if self.delta:
+            self._set(sorted(self.entries()))
+
+    def without(self, dropped: Dict[int, Tuple[int, int]]) -> List[Entry]:
+        """Entries minus `dropped` {hash: (offset, length)}, offsets closed up."""
+        cuts = sorted(dropped.values())
+        starts = [offset for offset, _ in cuts]
+        removed = [0]
+        for _, length in cuts:
+            removed.append(removed[-1] + length)
+        return [
+            (h, offset - removed[bisect.bisect_right(starts, offset)], length)
+            for h, offset, length in self.entries()
+            if h not in dropped
+        ]
+
+    def serialize(self) -> bytes:
+        self.fold()
+        head = {"sig": self.sig, "epoch": self.epoch, "generation": self.generation,
+                "size": self.size, "n": len(self.hashes)}
+        return b"".join([MAGIC, json.dumps(head).encode("utf-8"), b"\n",
+                         self.hashes.tobytes(), self.offsets.tobytes(), self.lengths.tobytes()])
+
+    @classmethod
+    def parse(cls, data: bytes) -> Optional["KeyIndex"]:
+        if not data.startswith(MAGIC):
+            return None
+        nl = data.find(b"\n", len(MAGIC))
+        head = json.loads(data[len(MAGIC):nl])
+        idx = cls(head["sig"], head["epoch"], head["generation"], head["size"])
+        width = head["n"] * idx.hashes.itemsize
+        body = memoryview(data)[nl + 1:]
+        if len(body) != 3 * width:
+            return None
+        for i, arr in enumerate((idx.hashes, idx.offsets, idx.lengths)):
+            arr.frombytes(body[i * width:(i + 1) * width])
+        return idx
+
+
+# ──────────────────────────── Scan ────────────────────────────
+def _row_key(raw: bytes, width: int, key_i: int, codec: gcs_csv._Codec) -> bytes:
+    """
+    Key of a row the merge would copy unchanged, or _Unindexable.  A row
+    that is not canonical still qualifies if re-serialising it gives the
+    same bytes (cells with quotes written by this codec).
+    """
+    parts = gcs_csv._split_canonical(raw, width)
+    if parts is not None:
+        return parts[key_i]
+    rec = codec.parse(raw)
+    if len(rec) != width or codec.format(rec) != raw:
+        raise _Unindexable("row is not in canonical form")
+    return rec[key_i].encode("utf-8")
+
+
+def _scan(fh: BinaryIO, pos: int, width: int, key_i: int, codec: gcs_csv._Codec,
+          header: bytes = None) -> Tuple[List[Entry], int]:
+    """Index the records of `fh`, which starts at byte `pos` of the CSV; returns (entries, end)."""
+    raws = gcs_csv._raw_records(fh)
+    if header is not None:
+        if next(raws, None) != header:
+            raise _Unindexable("header differs from HEADERS")
+        pos += len(header)
+    entries = []
+    for raw in raws:
+        entries.append((_hash(_row_key(raw, width, key_i, codec)), pos, len(raw)))
+        pos += len(raw)
+    return entries, pos
+
+
+def _build(live, sig: str, headers: List[str], key_i: int, codec: gcs_csv._Codec) -> KeyIndex:
+    with tempfile.SpooledTemporaryFile(gcs_csv.SPOOL_MAX_BYTES) as src:
+        with spans.span("gcs_download") as s:
+            live.download_to_file(src, if_generation_match=live.generation)
+            s.add_bytes(src.tell())
+        with spans.span("keyidx_build"):
+            entries, size = _scan(src, 0, len(headers), key_i, codec, header=codec.format(headers))
+            entries.sort()
+    if any(entries[i][0] == entries[i - 1][0] for i in range(1, len(entries))):
+        raise _Unindexable("duplicate keys")
+    _bump("builds")
+    epoch = (live.metadata or {}).get(EPOCH_KEY) or uuid.uuid4().hex
+    return KeyIndex(sig, epoch, live.generation, size, entries)
+
+
+def _catch_up(idx: KeyIndex, live, width: int, key_i: int, codec: gcs_csv._Codec) -> bool:
+    """Extend `idx` to `live` if it only grew by composes since; False if it did not."""
+    if idx.epoch != (live.metadata or {}).get(EPOCH_KEY) or live.size < idx.size:
+        return False
+    entries: List[Entry] = []
+    if live.size > idx.size:
+        with spans.span("gcs_download") as s:
+            tail = live.download_as_bytes(start=idx.size, if_generation_match=live.generation)
+            s.add_bytes(len(tail))
+        try:
+            entries, _ = _scan(io.BytesIO(tail), idx.size, width, key_i, codec)
+        except _Unindexable:
+            return False
+        if len({h for h, _, _ in entries}) != len(entries) or any(idx.find(h) for h, _, _ in entries):
+            return False
+    for entry in entries:
+        idx.add(*entry)
+    idx.generation, idx.size = live.generation, live.size
+    idx.unflushed += len(entries)
+    _bump("catch_ups")
+    return True
+
+
+# ──────────────────────────── Cache ────────────────────────────
+_cache_lock = threading.Lock()
+_cache: Dict[Tuple[str, str], KeyIndex] = {}
+
+
+def _load_sidecar(bucket, csv_path: str) -> Optional[KeyIndex]:
+    try:
+        with spans.span("gcs_download") as s:
+            data = bucket.blob(sidecar_name(csv_path)).download_as_bytes()
+            s.add_bytes(len(data))
+    except NotFound:
+        return None
+    try:
+        idx = KeyIndex.parse(data)
+    except Exception as e:
+        print(f"gcs_keyindex: unreadable {sidecar_name(csv_path)}: {e}")
+        return None
+    if idx is not None:
+        _bump("loads")
+    return idx
+
+
+def _flush(bucket, csv_path: str, idx: KeyIndex) -> None:
+    data = idx.serialize()
+    try:
+        with spans.span("gcs_upload", len(data)):
+            bucket.blob(sidecar_name(csv_path)).upload_from_string(data, content_type="application/octet-stream")
+    except Exception as e:
+        print(f"gcs_keyindex: could not write {sidecar_name(csv_path)}: {e}")
+        return
+    idx.unflushed = 0
+    _bump("flushes")
+
+
+def _index_for(bucket, csv_path: str, live, sig: str, headers: List[str], key_i: int,
+               codec: gcs_csv._Codec) -> KeyIndex:
+    """The index for generation `live` of the CSV, from cache, sidecar or a scan."""
+    with _cache_lock:
+        idx = _cache.get((bucket.name, csv_path))
+    if idx is not None and idx.sig == sig:
+        if idx.generation == live.generation or _catch_up(idx, live, len(headers), key_i, codec):
+            return idx
+
+    idx = _load_sidecar(bucket, csv_path)
+    if idx is not None and idx.sig == sig:
+        if idx.generation == live.generation or _catch_up(idx, live, len(headers), key_i, codec):
+            return idx
+
+    idx = _build(live, sig, headers, key_i, codec)
+    _flush(bucket, csv_path, idx)
+    return idx
+
+
+def forget(bucket_name: str, csv_path: str) -> None:
+    with _cache_lock:
+        _cache.pop((bucket_name, csv_path), None)
+
+
+# ──────────────────────────── Writes ───────────────────────────
+def _compose(bucket, csv_path: str, live, idx: KeyIndex, lines: List[bytes], hashes: List[int]) -> None:
+    body = b"".join(lines)
+    tmp = bucket.blob(f"{csv_path}{TMP_SUFFIX}{uuid.uuid4().hex}")
+    with spans.span("gcs_upload", len(body)):
+        tmp.upload_from_string(body, content_type="text/csv", if_generation_match=0)
+    dest = bucket.blob(csv_path)
+    dest.content_type = "text/csv"
+    dest.metadata = {EPOCH_KEY: idx.epoch}
+    try:
+        with spans.span("gcs_compose"):
+            dest.compose([live, tmp], if_generation_match=live.generation)
+    finally:
+        try:
+            tmp.delete()
+        except NotFound:
+            pass
+
+    pos = idx.size
+    for h, line in zip(hashes, lines):
+        idx.add(h, pos, len(line))
+        pos += len(line)
+    idx.generation, idx.size = dest.generation, pos
+    idx.unflushed += len(lines)
+    _bump("composes")
+
+
+def _copy_range(src: BinaryIO, out: BinaryIO, start: int, stop: int) -> None:
+    src.seek(start)
+    left = stop - start
+    while left > 0:
+        chunk = src.read(min(left, 1 << 20))
+        if not chunk:
+            break
+        out.write(chunk)
+        left -= len(chunk)
+
+
+def _rewrite(bucket, csv_path: str, live, idx: KeyIndex, hits: List[Optional[Tuple[int, int]]],
+             lines: List[bytes], keys: List[bytes], hashes: List[int], width: int, key_i: int,
+             codec: gcs_csv._Codec) -> KeyIndex:
+    """Copy the CSV without the rows `hits` point at, append `lines`; a new epoch."""
+    dropped = {h: hit for h, hit in zip(hashes, hits) if hit is not None}
+    epoch = uuid.uuid4().hex
+    with tempfile.SpooledTemporaryFile(gcs_csv.SPOOL_MAX_BYTES) as src, \
+            tempfile.SpooledTemporaryFile(gcs_csv.SPOOL_MAX_BYTES) as out:
+        with spans.span("gcs_download") as s:
+            live.download_to_file(src, if_generation_match=live.generation)
+            s.add_bytes(src.tell())
+
+        with spans.span("keyidx_splice"):
+            for key, hit in zip(keys, hits):
+                if hit is not None:
+                    src.seek(hit[0])
+                    if _row_key(src.read(hit[1]), width, key_i, codec) != key:
+                        raise _Unindexable("key hash collision")
+            prev = 0
+            for offset, length in sorted(dropped.values()):
+                _copy_range(src, out, prev, offset)
+                prev = offset + length
+            _copy_range(src, out, prev, idx.size)
+            base = out.tell()
+            out.write(b"".join(lines))
+            size = out.tell()
+            out.seek(0)
+
+        blob = bucket.blob(csv_path)
+        blob.metadata = {EPOCH_KEY: epoch}
+        with spans.span("gcs_upload", size):
+            blob.upload_from_file(out, size=size, content_type="text/csv", if_generation_match=live.generation)
+
+    new = KeyIndex(idx.sig, epoch, blob.generation, size, idx.without(dropped))
+    pos = base
+    for h, line in zip(hashes, lines):
+        new.add(h, pos, len(line))
+        pos += len(line)
+    _bump("rewrites")
+    return new
+
+
+def _merge(bucket, csv_path: str, new_rows: List[Dict[str, Any]], headers: List[str], key_column: str) -> int:
+    _bump("fallbacks")
+    forget(bucket.name, csv_path)
+    return gcs_csv.read_modify_write(
+        bucket,
+        csv_path,
+        lambda existing, out: gcs_csv.merge_csv_stream(existing, out, new_rows, headers, key_column),
+    )
+
+
+def append(bucket, csv_path: str, new_rows: List[Dict[str, Any]], headers: List[str], key_column: str) -> int:
+    """
+    Same contract as gcs_csv.read_modify_write + merge_csv_stream: merge
+    `new_rows` into the CSV with last-write-wins on `key_column` and return
+    the resulting row count.  Retries 412 conflicts with the same backoff
+    and counts them in gcs_csv.retry_stats().
+    """
+    codec = gcs_csv._Codec()
+    width, key_i = len(headers), headers.index(key_column)
+    fresh = [[gcs_csv._cell(r.get(h, "")) for h in headers] for r in new_rows]
+    last = {rec[key_i]: i for i, rec in enumerate(fresh)}
+    fresh = [rec for i, rec in enumerate(fresh) if last[rec[key_i]] == i]
+    lines = [codec.format(rec) for rec in fresh]
+    keys = [rec[key_i].encode("utf-8") for rec in fresh]
+    hashes = [_hash(k) for k in keys]
+    sig = _signature(headers, key_column)
+
+    for attempt in range(1, gcs_csv.MAX_ATTEMPTS + 1):
+        live = None
+        try:
+            if len(set(hashes)) != len(hashes):
+                raise _Unindexable("key hash collision")
+            live = bucket.get_blob(csv_path)
+            if live is None or live.content_encoding:
+                raise _Unindexable("missing or encoded CSV")
+            idx = _index_for(bucket, csv_path, live, sig, headers, key_i, codec)
+            if not lines:
+                return len(idx)
+            hits = [idx.find(h) for h in hashes]
+            gcs_csv._bump("attempts")
+            if any(hit is not None for hit in hits):
+                idx = _rewrite(bucket, csv_path, live, idx, hits, lines, keys, hashes, width, key_i, codec)
+                flush = True
+            else:
+                _compose(bucket, csv_path, live, idx, lines, hashes)
+                flush = idx.unflushed >= FLUSH_ROWS
+        except _Unindexable as e:
+            if live is not None:
+                print(f"gcs_keyindex: gs://{bucket.name}/{csv_path}: {e} – full merge.")
+            return _merge(bucket, csv_path, new_rows, headers, key_column)
+        except (NotFound, PreconditionFailed):
+            # the CSV changed (or was rotated away) between the read and the write
+            gcs_csv._bump("conflicts")
+            if attempt == gcs_csv.MAX_ATTEMPTS:
+                gcs_csv._bump("exhausted")
+                print(f"gcs_keyindex: gave up on gs://{bucket.name}/{csv_path} after {attempt} conflicting attempts")
+                raise
+            with spans.span("gcs_backoff"):
+                time.sleep(gcs_csv._backoff(attempt))
+            continue
+
+        gcs_csv._bump("writes")
+        with _cache_lock:
+            _cache[(bucket.name, csv_path)] = idx
+        if flush:
+            _flush(bucket, csv_path, idx)
+        return len(idx)
@@ -0,0 +1,440 @@
+"""
+gcs_parquet.py
+─────────────────────────────────────────────────────────────
+Date-partitioned Parquet copy of a campaign's rows, next to its CSV.
+
+Each webhook (or bulk group) writes one small immutable part per day
+it touches:
+
+    <parquet_prefix>/dt=2025-06-01/part-<epoch_ms>-<token>.parquet
+
+and compaction periodically folds a day's parts into one file
+(`part-<newest epoch_ms>-<token>-c.parquet`), keeping the last row per
+key_column like the CSV does – so reporting and backfills read typed
+columns for the days they need instead of parsing the whole CSV.
+
+The Arrow schema comes from the pipeline's columns (row_schema.Column
+dtype): "datetime" columns → timestamp[s] (local wall time, as in the
+CSV), "int" / "float" → int64 / float64, "bool" → true/yes/y/1 and
+false/no/n/0 (anything else → null), the rest strings.  Rows are
+partitioned on the first timestamp column ("Date" in the presets).
+Parts written under an older column set are conformed to the current
+one on read/compaction (missing columns → null).
+
+Enable per agent in agent_config.json with:
+    "parquet_prefix": "parquet/inbound_webhook"
+
+Compaction: retell_parquet_compact in router_webhook.py (point Cloud
+Scheduler at it) or `python gcs_parquet.py compact`.  A day is compacted
+once it has PARQUET_COMPACT_MIN_PARTS parts; a `_compacting` marker
+object (create-if-absent) keeps two compactors off the same day.
+
+pyarrow is optional: it is imported on first use, and without it the
+sink logs once and is skipped (the CSV is unaffected).
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+import coldstart
+import spans
+from row_schema import Column
+
+COMPACT_MIN_PARTS = int(os.getenv("PARQUET_COMPACT_MIN_PARTS", "8"))
+LOCK_STALE_S = float(os.getenv("PARQUET_LOCK_STALE_S", "600"))
+COMPRESSION = os.getenv("PARQUET_COMPRESSION", "snappy")
+
+PART_PREFIX = "part-"
+PART_SUFFIX = ".parquet"
+LOCK_NAME = "_compacting"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"  # row_schema "datetime" cells
+
+_TRUE = {"true", "yes", "y", "1"}
+_FALSE = {"false", "no", "n", "0"}
+
+_arrow_lock = threading.Lock()
+_arrow: Optional[Tuple[Any, Any]] = None
+_arrow_missing = False
+
+
+def arrow():
+    """(pyarrow, pyarrow.parquet), or None when pyarrow is not installed."""
+    global _arrow, _arrow_missing
+    if _arrow is not None or _arrow_missing:
+        return _arrow
+    with _arrow_lock:
+        if _arrow is None and not _arrow_missing:
+            try:
+                with coldstart.timed("import pyarrow", kind="import"):
+                    import pyarrow
+                    import pyarrow.parquet
+                _arrow = (pyarrow, pyarrow.parquet)
+            except ImportError as e:
+                print(f"gcs_parquet: pyarrow unavailable – Parquet sink disabled ({e})")
+                _arrow_missing = True
+    return _arrow
+
+
+# ───────────────────────────── Schema ──────────────────────────────
+def dtype_of(col: Column) -> str:
+    if col.dtype:
+        return col.dtype
+    return "timestamp" if col.transform == "datetime" else "string"
+
+
+def partition_column(columns: Sequence[Column]) -> str:
+    """The column rows are partitioned on – the first timestamp column."""
+    for col in columns:
+        if dtype_of(col) == "timestamp":
+            return col.header
+    raise ValueError("parquet_prefix needs a datetime/timestamp column to partition on")
+
+
+def _to_int(value: Any) -> Optional[int]:
+    try:
+        return int(float(value)) if value not in ("", None) else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value: Any) -> Optional[float]:
+    try:
+        return float(value) if value not in ("", None) else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_bool(value: Any) -> Optional[bool]:
+    text = str(value).strip().lower()
+    if text in _TRUE:
+        return True
+    if text in _FALSE:
+        return False
+    return None
+
+
+def _to_timestamp(value: Any) -> Optional[datetime]:
+    try:
+        return datetime.strptime(value, DATE_FORMAT) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_string(value: Any) -> str:
+    return "" if value is None else str(value)
+
+
+_CONVERT = {
+    "int": _to_int,
+    "float": _to_float,
+    "bool": _to_bool,
+    "timestamp": _to_timestamp,
+    "string": _to_string,
+}
+
+
+def arrow_schema(columns: Sequence[Column]):
+    pa, _ = arrow()
+    types = {
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+        "timestamp": pa.timestamp("s"),
+        "string": pa.string(),
+    }
+    fields = []
+    for col in columns:
+        dtype = dtype_of(col)
+        if dtype not in types:
+            raise ValueError(f"{col.header!r}: unknown dtype {dtype!r}")
+        fields.append(pa.field(col.header, types[dtype]))
+    return pa.schema(fields)
+
+
+def to_table(rows: Sequence[Dict[str, Any]], columns: Sequence[Column]):
+    """build_row() dicts → an Arrow table with the typed schema."""
+    pa, _ = arrow()
+    schema = arrow_schema(columns)
+    arrays = []
+    for col, field in zip(columns, schema):
+        convert = _CONVERT[dtype_of(col)]
+        arrays.append(pa.array([convert(r.get(col.header, "")) for r in rows], type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _conform(table, schema):
+    """Project a part written under another column set onto `schema`."""
+    if table.schema.equals(schema):
+        return table
+    pa, _ = arrow()
+    arrays = []
+    for field in schema:
+        if field.name in table.column_names:
+            col = table[field.name]
+            try:
+                arrays.append(col if col.type == field.type else col.cast(field.type))
+                continue
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                pass
+        arrays.append(pa.nulls(table.num_rows, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _keep_last(table, key_column: Optional[str]):
+    """drop_duplicates(keep="last") on `key_column`, like the CSV merge."""
+    if not key_column or key_column not in table.column_names:
+        return table
+    last = {k: i for i, k in enumerate(table[key_column].to_pylist())}
+    if len(last) == table.num_rows:
+        return table
+    return table.take(sorted(last.values()))
+
+
+# ───────────────────────────── Layout ──────────────────────────────
+def partition_prefix(prefix: str, dt: str) -> str:
+    return f"{prefix.rstrip('/')}/dt={dt}/"
+
+
+def _part_name(prefix: str, dt: str, epoch_ms: int, compacted: bool = False) -> str:
+    tail = "-c" if compacted else ""
+    return (
+        f"{partition_prefix(prefix, dt)}{PART_PREFIX}"
+        f"{epoch_ms:013d}-{uuid.uuid4().hex[:12]}{tail}{PART_SUFFIX}"
+    )
+
+
+def _part_ms(name: str) -> int:
+    return int(name.rsplit("/", 1)[-1][len(PART_PREFIX):].split("-", 1)[0])
+
+
+def list_parts(bucket, prefix: str, dt: str) -> list:
+    """The parts of one day, oldest first (a compacted part sorts as its newest source)."""
+    blobs = [
+        b
+        for b in bucket.list_blobs(prefix=partition_prefix(prefix, dt))
+        if b.name.rsplit("/", 1)[-1].startswith(PART_PREFIX) and b.name.endswith(PART_SUFFIX)
+    ]
+    return sorted(blobs, key=lambda b: b.name)
+
+
+def partitions(bucket, prefix: str) -> List[str]:
+    """Every dt=… value under `prefix`, ascending."""
+    days = set()
+    root = prefix.rstrip("/") + "/dt="
+    for blob in bucket.list_blobs(prefix=root):
+        days.add(blob.name[len(root):].split("/", 1)[0])
+    return sorted(days)
+
+
+# ───────────────────────────── Writing ─────────────────────────────
+def _serialize(table) -> bytes:
+    _, pq = arrow()
+    buf = io.BytesIO()
+    pq.write_table(table, buf, compression=COMPRESSION)
+    return buf.getvalue()
+
+
+def write_rows(
+    storage_client,
+    bucket_name: str,
+    prefix: str,
+    rows: Sequence[Dict[str, Any]],
+    columns: Sequence[Column],
+) -> List[str]:
+    """
+    Write `rows` as one new part per day they fall on; returns the object
+    names ([] when pyarrow is unavailable).
+    """
+    if not rows or arrow() is None:
+        return []
+    dt_col = partition_column(columns)
+    by_day: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        stamp = _to_timestamp(row.get(dt_col))
+        by_day.setdefault(stamp.strftime("%Y-%m-%d") if stamp else "unknown", []).append(row)
+
+    bucket = storage_client.bucket(bucket_name)
+    names = []
+    now_ms = int(time.time() * 1000)
+    for dt, day_rows in sorted(by_day.items()):
+        with spans.span("parquet_write") as s:
+            body = _serialize(to_table(day_rows, columns))
+            s.add_bytes(len(body))
+            name = _part_name(prefix, dt, now_ms)
+            bucket.blob(name).upload_from_string(
+                body, content_type="application/vnd.apache.parquet", if_generation_match=0
+            )
+        names.append(name)
+    return names
+
+
+# ───────────────────────────── Reading ─────────────────────────────
+def _read_parts(blobs, schema):
+    pa, pq = arrow()
+    tables = []
+    for blob in blobs:
+        try:
+            body = blob.download_as_bytes()
+        except NotFound:
+            continue  # compacted away since the listing
+        tables.append(_conform(pq.read_table(io.BytesIO(body)), schema))
+    return pa.concat_tables(tables) if tables else schema.empty_table()
+
+
+def read_days(
+    storage_client,
+    bucket_name: str,
+    prefix: str,
+    columns: Sequence[Column],
+    key_column: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+):
+    """
+    One Arrow table for the days in [start, end] ("YYYY-MM-DD", inclusive;
+    None = open), last row per key_column within each day.
+    """
+    pa, _ = arrow()
+    schema = arrow_schema(columns)
+    bucket = storage_client.bucket(bucket_name)
+    tables = []
+    for dt in partitions(bucket, prefix):
+        if (start and dt < start) or (end and dt > end):
+            continue
+        table = _read_parts(list_parts(bucket, prefix, dt), schema)
+        tables.append(_keep_last(table, key_column))
+    return pa.concat_tables(tables) if tables else schema.empty_table()
+
+
+# ──────────────────────────── Compaction ───────────────────────────
+def _acquire(bucket, prefix: str, dt: str):
+    """Create the day's compaction marker; returns it, or None if another compactor holds it."""
+    lock = bucket.blob(partition_prefix(prefix, dt) + LOCK_NAME)
+    for _ in range(2):
+        try:
+            lock.upload_from_string(str(time.time()), if_generation_match=0)
+            return lock
+        except PreconditionFailed:
+            pass
+        try:
+            held = bucket.get_blob(lock.name)
+            if held is None:
+                continue
+            since = float(held.download_as_bytes(if_generation_match=held.generation))
+        except (NotFound, PreconditionFailed, ValueError):
+            continue
+        if time.time() - since < LOCK_STALE_S:
+            return None
+        print(f"gcs_parquet: breaking stale compaction marker gs://{bucket.name}/{lock.name}")
+        try:
+            held.delete(if_generation_match=held.generation)
+        except (NotFound, PreconditionFailed):
+            pass
+    return None
+
+
+def _release(lock) -> None:
+    try:
+        lock.delete(if_generation_match=lock.generation)
+    except (NotFound, PreconditionFailed):
+        pass  # broken as stale and taken over – not ours any more
+
+
+def compact_day(
+    storage_client,
+    bucket_name: str,
+    prefix: str,
+    dt: str,
+    columns: Sequence[Column],
+    key_column: Optional[str] = None,
+    min_parts: int = COMPACT_MIN_PARTS,
+) -> int:
+    """
+    Fold one day's parts into a single file; returns the number of parts
+    folded (0 when below `min_parts` or another compactor holds the day).
+    """
+    if arrow() is None:
+        return 0
+    bucket = storage_client.bucket(bucket_name)
+    if len(list_parts(bucket, prefix, dt)) < max(min_parts, 2):
+        return 0
+    lock = _acquire(bucket, prefix, dt)
+    if lock is None:
+        print(f"gcs_parquet: {prefix} dt={dt} is being compacted elsewhere – skipping.")
+        return 0
+    try:
+        # re-list under the marker: a compactor that just finished
+        # has already replaced what the first listing saw
+        parts = list_parts(bucket, prefix, dt)
+        if len(parts) < max(min_parts, 2):
+            return 0
+        with spans.span("parquet_compact") as s:
+            table = _keep_last(_read_parts(parts, arrow_schema(columns)), key_column)
+            body = _serialize(table)
+            s.add_bytes(len(body))
+            name = _part_name(prefix, dt, max(_part_ms(b.name) for b in parts), compacted=True)
+            bucket.blob(name).upload_from_string(
+                body, content_type="application/vnd.apache.parquet", if_generation_match=0
+            )
+        # a crash before these deletes only leaves duplicates that
+        # _keep_last drops on read and on the next compaction
+        for blob in parts:
+            try:
+                blob.delete()
+            except NotFound:
+                pass
+        print(
+            f"gcs_parquet: compacted {len(parts)} part(s) of gs://{bucket_name}/"
+            f"{partition_prefix(prefix, dt)} into {table.num_rows} row(s)."
+        )
+        return len(parts)
+    finally:
+        _release(lock)
+
+
+def compact(
+    storage_client,
+    bucket_name: str,
+    prefix: str,
+    columns: Sequence[Column],
+    key_column: Optional[str] = None,
+    min_parts: int = COMPACT_MIN_PARTS,
+) -> Dict[str, int]:
+    """compact_day() for every day under `prefix`; {dt: parts folded} for the days touched."""
+    bucket = storage_client.bucket(bucket_name)
+    folded = {}
+    for dt in partitions(bucket, prefix):
+        n = compact_day(storage_client, bucket_name, prefix, dt, columns, key_column, min_parts)
+        if n:
+            folded[dt] = n
+    return folded
+
+
+# ─────────────────────────────── CLI ───────────────────────────────
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Compact the Parquet parts of every routed target.")
+    ap.add_argument("command", choices=["compact"])
+    ap.add_argument("--min-parts", type=int, default=COMPACT_MIN_PARTS)
+    args = ap.parse_args(argv)
+
+    os.environ.setdefault("ROUTER_STARTUP_MODE", "lazy")
+    import pipeline
+    import router_webhook
+
+    report = pipeline.compact_parquet(router_webhook.ROUTES.snapshot().routes, args.min_parts)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+"""
+gunicorn.conf.py
+─────────────────────────────────────────────────────────────
+Multi-worker profile for router_gunicorn.py:
+
+  gunicorn -c gunicorn.conf.py router_gunicorn:app
+
+Tunables (environment):
+  PORT                listen port                        (default 8080)
+  WORKERS             worker processes                   (default CPUs)
+  THREADS             threads per worker                 (default 64)
+  GUNICORN_TIMEOUT    seconds a silent worker may live   (default 120)
+  GUNICORN_LOG_LEVEL                                     (default error)
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WORKERS", str(os.cpu_count() or 1)))
+worker_class = "gthread"
+threads = int(os.getenv("THREADS", "64"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30  # atexit: the spool checkpoints, the sinks flush
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "error")
+limit_request_line = 0
+
+# Each worker imports the router itself: its clients, its spool slot and
+# its sink threads are its own, never inherited across fork.
+preload_app = False
@@ -0,0 +1,307 @@
+"""
+idempotency.py
+─────────────────────────────────────────────────────────────
+call_id-keyed idempotency for Retell redeliveries.
+
+A handler failure returns 500 so Retell retries – and the retry used
+to redo every side effect (BigQuery row, CSV read-modify-write,
+Firestore read).  Handlers now run inside an execution:
+
+    with guard().execution(call_id) as ex:
+        if ex.complete:
+            return "duplicate"
+        if ex.needs("bigquery"):
+            log_to_bigquery(...); ex.mark("bigquery")
+        if ex.needs("csv"):
+            append(...);          ex.mark("csv")
+
+* LRU – the last IDEMPOTENCY_LRU_SIZE call_ids and their completed
+  stages are kept in-process; a redelivery of a finished call never
+  leaves memory.
+* Durable marker – with IDEMPOTENCY_MODE=gcs (or =local, a filesystem
+  stand-in for tests and the Procfile server) the stage bits are also
+  written to <prefix>/<call_id>.json, create-only for the first write
+  and generation-guarded after, so they survive instance restarts.
+  One GET on a call's first delivery, one write when it settles.
+* Stage bits – a retry re-runs only the stages that did not complete.
+  Leaving the block normally marks the call complete (stages that
+  failed *without* raising are deliberately not retried, as before);
+  an exception or `ex.fail()` leaves it open for the next delivery.
+* Single flight – concurrent deliveries of the same call_id in one
+  instance wait for the in-flight execution and then see its result.
+
+IDEMPOTENCY_MODE: off | memory (default) | local | gcs.
+Markers are small; expire them with a bucket lifecycle rule on the prefix.
+"""
+
+import collections
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Optional, Set, Tuple
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+import spans
+
+MODE = os.getenv("IDEMPOTENCY_MODE", "memory").lower()
+LRU_SIZE = int(os.getenv("IDEMPOTENCY_LRU_SIZE", "10000"))
+BUCKET_NAME = os.getenv("IDEMPOTENCY_BUCKET", "retell-calling-reference-data")
+PREFIX = os.getenv("IDEMPOTENCY_PREFIX", "idempotency").strip("/")
+LOCAL_DIR = os.getenv("IDEMPOTENCY_DIR", "/tmp/retell-idempotency")
+MAX_ATTEMPTS = 5
+
+COMPLETE = "_complete"  # pseudo-stage: every stage of the call has settled
+
+_SAFE = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def _object_name(call_id: str) -> str:
+    return _SAFE.sub("_", call_id) + ".json"
+
+
+# ───────────────────────── Durable stores ──────────────────────────
+class GCSMarkerStore:
+    """One JSON marker object per call_id: {"stages": [...]}."""
+
+    def __init__(self, storage_factory: Callable[[], Any], bucket_name: str = BUCKET_NAME, prefix: str = PREFIX):
+        self._storage_factory = storage_factory
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+
+    def _blob(self, call_id: str):
+        client = self._storage_factory()
+        if client is None:
+            raise RuntimeError("storage client unavailable")
+        return client.bucket(self.bucket_name).blob(f"{self.prefix}/{_object_name(call_id)}")
+
+    def _read(self, blob) -> Tuple[Set[str], int]:
+        try:
+            body = blob.download_as_bytes()
+        except NotFound:
+            return set(), 0
+        return set(json.loads(body).get("stages", [])), blob.generation
+
+    def load(self, call_id: str) -> Set[str]:
+        return self._read(self._blob(call_id))[0]
+
+    def merge(self, call_id: str, stages: Iterable[str]) -> None:
+        stages = set(stages)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            blob = self._blob(call_id)
+            current, generation = self._read(blob)
+            if stages <= current:
+                return
+            body = json.dumps({"call_id": call_id, "stages": sorted(current | stages)})
+            try:
+                # generation 0 → create-only: two instances racing on a new
+                # call_id cannot overwrite each other's first marker
+                blob.upload_from_string(
+                    body, content_type="application/json", if_generation_match=generation
+                )
+                return
+            except PreconditionFailed:
+                if attempt == MAX_ATTEMPTS:
+                    raise
+
+
+class LocalMarkerStore:
+    """Filesystem stand-in: O_EXCL create, flock-guarded merge."""
+
+    def __init__(self, root: str = LOCAL_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, call_id: str) -> str:
+        return os.path.join(self.root, _object_name(call_id))
+
+    def load(self, call_id: str) -> Set[str]:
+        try:
+            with open(self._path(call_id), "rb") as fh:
+                body = fh.read()
+        except FileNotFoundError:
+            return set()
+        return set(json.loads(body).get("stages", [])) if body else set()
+
+    def merge(self, call_id: str, stages: Iterable[str]) -> None:
+        import fcntl
+
+        path = self._path(call_id)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o644)  # create-only
+        except FileExistsError:
+            fd = os.open(path, os.O_RDWR)
+        with os.fdopen(fd, "r+b") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            body = fh.read()
+            current = set(json.loads(body).get("stages", [])) if body else set()
+            fh.seek(0)
+            fh.truncate()
+            fh.write(json.dumps({"call_id": call_id, "stages": sorted(current | set(stages))}).encode())
+            fh.flush()
+            os.fsync(fh.fileno())
+
+
+# ───────────────────────────── Guard ───────────────────────────────
+class Execution:
+    """Stage bookkeeping for one delivery of one call_id."""
+
+    def __init__(self, call_id: Optional[str], done: FrozenSet[str]):
+        self.call_id = call_id
+        self.done = done
+        self.new: Set[str] = set()
+        self.failed = False
+
+    @property
+    def complete(self) -> bool:
+        return COMPLETE in self.done
+
+    def needs(self, stage: str) -> bool:
+        return stage not in self.done and stage not in self.new
+
+    def mark(self, stage: str) -> None:
+        self.new.add(stage)
+
+    def fail(self) -> None:
+        """Leave the call open for the next delivery without raising."""
+        self.failed = True
+
+
+class _Flight:
+    __slots__ = ("done",)
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class IdempotencyGuard:
+    def __init__(self, store=None, lru_size: int = LRU_SIZE, enabled: bool = True):
+        self.store = store
+        self.lru_size = lru_size
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._lru: "collections.OrderedDict[str, FrozenSet[str]]" = collections.OrderedDict()
+        self._flights: Dict[str, _Flight] = {}
+        self._stats = {
+            "executions": 0,
+            "duplicates": 0,
+            "resumed": 0,
+            "waited": 0,
+            "store_errors": 0,
+        }
+
+    def _lru_get(self, call_id: str) -> Optional[FrozenSet[str]]:
+        with self._lock:
+            done = self._lru.get(call_id)
+            if done is not None:
+                self._lru.move_to_end(call_id)
+            return done
+
+    def _lru_put(self, call_id: str, done: FrozenSet[str]) -> None:
+        with self._lock:
+            self._lru[call_id] = done
+            self._lru.move_to_end(call_id)
+            while len(self._lru) > self.lru_size:
+                self._lru.popitem(last=False)
+
+    def _acquire(self, call_id: str) -> _Flight:
+        while True:
+            with self._lock:
+                flight = self._flights.get(call_id)
+                if flight is None:
+                    flight = self._flights[call_id] = _Flight()
+                    return flight
+                self._stats["waited"] += 1
+            flight.done.wait()
+
+    def _release(self, call_id: str, flight: _Flight) -> None:
+        with self._lock:
+            if self._flights.get(call_id) is flight:
+                del self._flights[call_id]
+        flight.done.set()
+
+    def _load(self, call_id: str) -> FrozenSet[str]:
+        done = self._lru_get(call_id)
+        if done is None and self.store is not None:
+            try:
+                with spans.span("idempotency_read"):
+                    done = frozenset(self.store.load(call_id))
+            except Exception as exc:
+                self._bump("store_errors")
+                print(f"idempotency: marker read failed for {call_id}: {exc}")
+        return done or frozenset()
+
+    def _settle(self, ex: Execution) -> None:
+        new = set(ex.new)
+        if not ex.failed:
+            new.add(COMPLETE)
+        done = ex.done | new
+        self._lru_put(ex.call_id, frozenset(done))
+        if self.store is not None and not new <= ex.done:
+            try:
+                with spans.span("idempotency_write"):
+                    self.store.merge(ex.call_id, done)
+            except Exception as exc:
+                self._bump("store_errors")
+                print(f"idempotency: marker write failed for {ex.call_id}: {exc}")
+
+    def _bump(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    @contextmanager
+    def execution(self, call_id: Optional[str]):
+        if not (call_id and self.enabled):
+            yield Execution(None, frozenset())  # nothing to key on – run everything
+            return
+
+        done = self._lru_get(call_id)
+        if done is not None and COMPLETE in done:
+            self._bump("duplicates")
+            yield Execution(call_id, done)
+            return
+
+        flight = self._acquire(call_id)
+        try:
+            ex = Execution(call_id, self._load(call_id))
+            self._bump("duplicates" if ex.complete else "resumed" if ex.done else "executions")
+            if ex.complete:
+                self._lru_put(call_id, ex.done)
+                yield ex
+                return
+            try:
+                yield ex
+            except BaseException:
+                ex.failed = True
+                raise
+            finally:
+                self._settle(ex)
+        finally:
+            self._release(call_id, flight)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "lru": len(self._lru), "in_flight": len(self._flights)}
+
+
+# ─────────────────────── Process-wide guard ───────────────────────
+_guard: Optional[IdempotencyGuard] = None
+_guard_lock = threading.Lock()
+
+
+def guard(storage_factory: Callable[[], Any] = None) -> IdempotencyGuard:
+    """The shared guard for IDEMPOTENCY_MODE (store built on first use)."""
+    global _guard
+    if _guard is None:
+        with _guard_lock:
+            if _guard is None:
+                if MODE == "gcs":
+                    store = GCSMarkerStore(storage_factory)
+                elif MODE == "local":
+                    store = LocalMarkerStore()
+                else:
+                    store = None
+                _guard = IdempotencyGuard(store, enabled=MODE != "off")
+    return _guard
@@ -0,0 +1,136 @@
+"""
+leads.py
+─────────────────────────────────────────────────────────────
+Recording a call on its Firestore lead: leads/{firestore_doc_id}.
+
+Every recorded call gets a marker document
+
+    leads/{lead}/calls/{call_id}   {"call_id", "timestamp", "disposition"}
+
+so "was this call already recorded?" is a point lookup of one small
+document.  It no longer reads the whole lead and scans its
+disposition_history array, which grows with every attempt.
+`record_call` does the lookup, the marker create and the lead update in
+one transaction.  That is one read RPC and one commit, and the size of
+the lead does not matter.  A concurrent delivery of the same call
+aborts on the marker read and is retried into "duplicate".
+
+disposition_history is still appended with ArrayUnion, a server-side
+transform, for anything that reads it; nothing here reads it any more.
+Calls recorded before the markers existed exist only in that array, so
+a redelivery of one of them is not caught here.
+
+`add_call` queues the same two writes on a WriteBatch, for the bulk
+path (pipeline.Pipeline.update_leads).  `add_calls` / `record_calls`
+take several calls for one lead and fold them into a single lead update
+(Increment(n), one ArrayUnion, the fields of the latest call), for the
+write-behind sink (lead_sink.py).
+"""
+
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+import spans
+
+LEADS_COLLECTION = "leads"
+CALLS_COLLECTION = "calls"
+WRITES_PER_CALL = 2  # marker create + lead update
+
+UPDATED = "updated"
+DUPLICATE = "duplicate"
+MISSING = "missing"
+QUEUED = "queued"  # lead_sink.py: spooled, written behind
+
+Call = Tuple[str, Dict[str, Any], datetime]  # (call_id, row, when it was processed)
+
+
+def lead_ref(db, doc_id: str):
+    return db.collection(LEADS_COLLECTION).document(doc_id)
+
+
+def marker_ref(lead, call_id: str):
+    return lead.collection(CALLS_COLLECTION).document(call_id)
+
+
+def history_entry(call_id: str, row: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+    return {"call_id": call_id, "timestamp": now, "disposition": str(row.get("Correct Name", "")).strip()}
+
+
+def lead_update(firestore, call_id: str, row: Dict[str, Any], now: datetime) -> Dict[str, Any]:
+    entry = history_entry(call_id, row, now)
+    disposition = entry["disposition"]
+    return {
+        "call_attempts": firestore.Increment(1),
+        "last_call_timestamp": now,
+        "disposition_history": firestore.ArrayUnion([entry]),
+        "disposition": disposition,
+        "Status": "Called",
+        "analysis_email": row.get("Email Given"),
+        "analysis_state": row.get("State Given"),
+        "analysis_accredited": row.get("Accredited"),
+        "analysis_new_investments": row.get("New Investments"),
+        "analysis_sectors": row.get("Sectors"),
+        "analysis_dnc": row.get("DNC"),
+        "analysis_summary": row.get("Summery", row.get("Summary")),
+        "analysis_quality": row.get("Quality"),
+        "call_duration_seconds": row.get("Call Time"),
+        "disconnection_reason": row.get("Disconnection Reason"),
+        "processed": False,
+        "sector_processed": False,
+    }
+
+
+def add_calls(writer, firestore, lead, calls: List[Call]) -> int:
+    """
+    Queue one marker create per call and one lead update for all of them
+    on a Transaction or WriteBatch; returns the number of writes.
+    """
+    for call_id, row, at in calls:
+        writer.create(marker_ref(lead, call_id), history_entry(call_id, row, at))
+    update = lead_update(firestore, *calls[-1])
+    if len(calls) > 1:
+        update["call_attempts"] = firestore.Increment(len(calls))
+        update["disposition_history"] = firestore.ArrayUnion([history_entry(*c) for c in calls])
+    writer.update(lead, update)
+    return len(calls) + 1
+
+
+def add_call(writer, firestore, lead, call_id: str, row: Dict[str, Any]) -> None:
+    """Queue the marker create and the lead update on a Transaction or WriteBatch."""
+    add_calls(writer, firestore, lead, [(call_id, row, datetime.utcnow())])
+
+
+def record_calls(db, doc_id: str, calls: List[Call]) -> Dict[str, str]:
+    """
+    Record `calls` on leads/{doc_id} in one transaction; returns
+    {call_id: UPDATED | DUPLICATE (already recorded) | MISSING (no such
+    lead)}.  Any other error propagates.
+    """
+    from google.api_core.exceptions import NotFound
+    from google.cloud import firestore
+
+    lead = lead_ref(db, doc_id)
+
+    @firestore.transactional
+    def txn(t):
+        with spans.span("firestore_read"):
+            seen = {c[0] for c in calls if marker_ref(lead, c[0]).get(transaction=t).exists}
+        fresh = [c for c in calls if c[0] not in seen]
+        if fresh:
+            add_calls(t, firestore, lead, fresh)  # update() fails the commit if the lead is gone
+        return {c[0]: DUPLICATE if c[0] in seen else UPDATED for c in calls}
+
+    try:
+        with spans.span("firestore_txn"):
+            return txn(db.transaction())
+    except NotFound:
+        return {c[0]: MISSING for c in calls}
+
+
+def record_call(db, doc_id: str, call_id: str, row: Dict[str, Any]) -> str:
+    """
+    Record `call_id` on leads/{doc_id} in one transaction.  Returns
+    UPDATED, DUPLICATE (already recorded) or MISSING (no such lead).
+    Any other error propagates.
+    """
+    return record_calls(db, doc_id, [(call_id, row, datetime.utcnow())])[call_id]
@@ -0,0 +1,168 @@
+"""
+payload_archive.py
+─────────────────────────────────────────────────────────────
+Keeps the raw Retell payload out of BigQuery.
+
+By default (`PAYLOAD_ARCHIVE_MODE=inline`) log_to_bigquery keeps
+writing `transcript` and `full_webhook_payload` as JSON strings, so
+every transcript is streamed (and later scanned) twice.
+
+With `PAYLOAD_ARCHIVE_MODE=gcs` the payload is serialised once,
+gzip-compressed and stored as a content-addressed object:
+
+    gs://<PAYLOAD_ARCHIVE_BUCKET>/payloads/YYYY/MM/DD/<call_id>.<sha16>.json.gz
+
+and the history row carries only `payload_uri`, `payload_sha256`,
+`payload_bytes` (JSON size) and `payload_gz_bytes` (object size);
+`transcript` / `full_webhook_payload` are left NULL.  The upload is
+create-only, so a redelivered webhook with the same body is a no-op.
+If the archive write fails the row falls back to the inline columns
+rather than losing the payload.
+
+`history_row(row, …)` is what the handlers hand to bq_sink.py: in gcs
+mode only the JSON serialisation happens on the request path; the
+gzip and the upload run in the sink's flusher just before the insert,
+which is where the `gs://` reference is filled in.
+
+Reads are lazy: `fetch_payload(uri, client)` and `fetch_transcript(...)`
+pull and decompress a single object on demand.
+
+The BigQuery table needs the four payload_* columns (NULLABLE) before
+switching an environment to `gcs`.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional, Union
+
+from google.api_core.exceptions import PreconditionFailed
+
+import spans
+
+MODE = os.getenv("PAYLOAD_ARCHIVE_MODE", "inline").lower()
+BUCKET_NAME = os.getenv("PAYLOAD_ARCHIVE_BUCKET", "retell-calling-reference-data")
+PREFIX = os.getenv("PAYLOAD_ARCHIVE_PREFIX", "payloads").strip("/")
+GZIP_LEVEL = int(os.getenv("PAYLOAD_ARCHIVE_GZIP_LEVEL", "6"))
+
+
+def _call_date(call: dict) -> datetime:
+    """Date the object is filed under – the call's own timestamp when known,
+    so redeliveries on another day still land on the same object."""
+    ts = call.get("end_timestamp") or call.get("start_timestamp")
+    try:
+        return datetime.fromtimestamp(int(ts) / 1000, tz=timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return datetime.now(timezone.utc)
+
+
+def object_path(call: dict, sha256: str) -> str:
+    call_id = call.get("call_id") or "no-call-id"
+    return f"{PREFIX}/{_call_date(call):%Y/%m/%d}/{call_id}.{sha256[:16]}.json.gz"
+
+
+def _encode(payload: dict) -> bytes:
+    return json.dumps(payload, separators=(",", ":"), sort_keys=True).encode("utf-8")
+
+
+def _store(storage_client, raw: bytes, call: dict, bucket_name: str = None) -> Dict[str, Any]:
+    sha256 = hashlib.sha256(raw).hexdigest()
+    # mtime=0 keeps the compressed bytes deterministic for identical payloads
+    body = gzip.compress(raw, compresslevel=GZIP_LEVEL, mtime=0)
+
+    bucket_name = bucket_name or BUCKET_NAME
+    path = object_path(call, sha256)
+    blob = storage_client.bucket(bucket_name).blob(path)
+    blob.content_encoding = "gzip"
+    blob.metadata = {"sha256": sha256, "call_id": call.get("call_id") or ""}
+    try:
+        with spans.span("payload_archive", len(body)):
+            blob.upload_from_string(body, content_type="application/json", if_generation_match=0)
+    except PreconditionFailed:
+        pass  # same content already archived (webhook redelivery)
+
+    return {
+        "payload_uri": f"gs://{bucket_name}/{path}",
+        "payload_sha256": sha256,
+        "payload_bytes": len(raw),
+        "payload_gz_bytes": len(body),
+    }
+
+
+def archive_payload(storage_client, payload: dict, call: dict, bucket_name: str = None) -> Dict[str, Any]:
+    """Store `payload` once (gzip, create-only) and return its reference."""
+    return _store(storage_client, _encode(payload), call, bucket_name)
+
+
+def _archived_fields(storage_client, raw: bytes, call: dict) -> Dict[str, Any]:
+    try:
+        return {"transcript": None, "full_webhook_payload": None, **_store(storage_client, raw, call)}
+    except Exception as exc:
+        print(f"payload_archive: archive failed, logging payload inline – {exc}")
+    return {
+        "transcript": json.dumps(call.get("transcript")),
+        "full_webhook_payload": raw.decode("utf-8"),
+    }
+
+
+def history_fields(storage_client, payload: dict, call: dict) -> Dict[str, Any]:
+    """
+    The payload-bearing columns of a retell_call_history row for the
+    current PAYLOAD_ARCHIVE_MODE.
+    """
+    if MODE == "gcs" and storage_client is not None:
+        return _archived_fields(storage_client, _encode(payload), call)
+    return {
+        "transcript": json.dumps(call.get("transcript")),
+        "full_webhook_payload": json.dumps(payload),
+    }
+
+
+def history_row(
+    row: Dict[str, Any], storage_client, payload: dict, call: dict
+) -> Union[Dict[str, Any], Callable[[], Dict[str, Any]]]:
+    """
+    `row` with history_fields() – for bq_sink.  In gcs mode a callable
+    that archives the payload (serialised now, so later changes to it do
+    not leak in) and returns the row; bq_sink calls it in its flusher.
+    """
+    if MODE == "gcs" and storage_client is not None:
+        raw = _encode(payload)
+        call = {k: call.get(k) for k in ("call_id", "end_timestamp", "start_timestamp", "transcript")}
+        return lambda: {**row, **_archived_fields(storage_client, raw, call)}
+    return {**row, **history_fields(storage_client, payload, call)}
+
+
+# ───────────────────────── Lazy reads ──────────────────────────
+def _split_uri(uri: str):
+    if not uri.startswith("gs://"):
+        raise ValueError(f"not a gs:// URI: {uri!r}")
+    bucket, _, path = uri[len("gs://"):].partition("/")
+    return bucket, path
+
+
+def fetch_payload(uri: str, storage_client, verify: bool = True) -> dict:
+    """Download, decompress and parse one archived payload."""
+    bucket, path = _split_uri(uri)
+    # raw_download: skip GCS decompressive transcoding, gunzip locally
+    body = storage_client.bucket(bucket).blob(path).download_as_bytes(raw_download=True)
+    return decode_archived(path, body, verify)
+
+
+def decode_archived(path: str, body: bytes, verify: bool = True) -> dict:
+    """Parse the stored bytes of an archived payload (gzip or plain JSON)."""
+    raw = gzip.decompress(body) if body[:2] == b"\x1f\x8b" else body
+    if verify:
+        digest = hashlib.sha256(raw).hexdigest()
+        if not path.endswith(f".{digest[:16]}.json.gz"):
+            raise ValueError(f"payload hash mismatch for {path}")
+    return json.loads(raw)
+
+
+def fetch_transcript(uri: str, storage_client) -> Optional[Any]:
+    """The `transcript` of the archived call (what the inline column held)."""
+    payload = fetch_payload(uri, storage_client)
+    call = payload.get("data") or payload.get("call") or {}
+    return call.get("transcript")
@@ -0,0 +1,599 @@
+"""
+pipeline.py
+─────────────────────────────────────────────────────────────
+Schema-driven webhook pipeline shared by every campaign.
+
+One `Pipeline` per distinct agent_config entry, compiled once and
+cached, does what each handler module used to re-implement:
+
+    log_to_bigquery → build_row → CSV append (or segment) → Firestore
+                                                            → Parquet
+
+Everything campaign-specific comes from the config entry:
+
+    {
+      "handler":        "pipeline",
+      "bucket_name":    "acme-retell-calling-reference-data",
+      "csv_path":       "raw_leads/inbound_webhook.csv",
+      "key_column":     "Phone",          # dedupe key; null = no dedupe
+      "storage_mode":   "segments",       # optional, see gcs_segments.py
+                                          # "rollover" (gcs_rollover.py)
+                                          # or "feed" (gcs_feed.py)
+      "parquet_prefix": "parquet/inbound_webhook",  # optional, see gcs_parquet.py
+      "schema":         "standard",       # column preset (SCHEMAS)
+      "columns":        [...],            # optional, overrides the preset
+      "bq_table":       "retell_call_history",   # "" = no BigQuery row
+      "use_firestore":  false,            # update leads/{firestore_doc_id}
+      "raise_on_error": true              # 500 → Retell redelivers
+    }
+
+`columns` entries are either a header name from the preset (to pick or
+re-order columns) or a full row_schema column:
+    {"header": "Zip", "source": "vars", "keys": ["zip", "zip_code"]}
+and may set "type" ("int", "float", "bool", "timestamp") for the
+Parquet copy.
+
+The router calls `get(config).handle(payload, call)` directly for
+`"handler": "pipeline"`; handlers/core.py, football.py and
+client_template.py are thin presets over the same engine.  bulk.py
+feeds whole groups of events through `handle_batch()` – one CSV write,
+one BigQuery hand-off and one Firestore batch per group.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import bq_sink
+import clients
+import gcs_csv
+import gcs_feed
+import gcs_parquet
+import gcs_rollover
+import gcs_segments
+import idempotency
+import lead_sink
+import leads
+import payload_archive
+import spans
+from row_schema import Column, compile_columns, headers
+
+BQ_DATASET_ID = "lead_warehouse"
+BQ_TABLE_ID = os.getenv("BQ_TABLE_ID", "retell_call_history")
+FIRESTORE_BATCH_LIMIT = 500  # writes per WriteBatch commit
+
+# ───────────────────────── Column presets ──────────────────────────
+VAR_ALIASES = {
+    "First Name": ("first_name", "First Name", "firstName"),
+    "Last Name": ("last_name", "Last Name", "lastName"),
+    "Address": ("address", "Address"),
+    "City": ("city", "City"),
+    "State": ("state", "State", "Input State"),
+    "Zip": ("zip", "Zip", "zip_code", "zipCode"),
+    "Email": ("email", "Email", "Input Email"),
+    "Recording": ("recording_url", " recording_url", "recording_url ", "recording"),
+}
+
+# core / football / client_template
+STANDARD_COLUMNS = [
+    Column("Date", "call", ("end_timestamp",), "datetime"),
+    Column("Phone", "call", ("to_number",), "phone"),
+    Column("Call Time", "cost", ("total_duration_seconds",), dtype="int"),
+    Column("First Name", "vars", VAR_ALIASES["First Name"]),
+    Column("Last Name", "vars", VAR_ALIASES["Last Name"]),
+    Column("Address", "vars", VAR_ALIASES["Address"]),
+    Column("City", "vars", VAR_ALIASES["City"]),
+    Column("Input State", "vars", VAR_ALIASES["State"]),
+    Column("State Given", "analysis", ("_state",)),
+    Column("Zip", "vars", VAR_ALIASES["Zip"]),
+    Column("Input Email", "vars", VAR_ALIASES["Email"]),
+    Column("Email Given", "analysis", ("_email",)),
+    Column("Accredited", "analysis", ("_accredited_investor", "_accredited _investor"), "lower", dtype="bool"),
+    Column("Correct Name", "analysis", ("_correct_name", "_correct _name"), "lower", dtype="bool"),
+    Column("New Investments", "analysis", ("_new_investments", "_new _investments"), "lower", dtype="bool"),
+    Column("Sectors", "analysis", ("_investment_sectors", "_investment _sectors")),
+    Column("DNC", "analysis", ("_dnc", "_d_n_c"), "lower", dtype="bool"),
+    Column("Summary", "analysis", ("_summary", "_call_summary", "_call _summary")),
+    Column("Quality", "analysis", ("_quality",)),
+    Column("Disconnection Reason", "call", ("disconnection_reason",)),
+    Column("Interested", "analysis", ("_interested",), "lower", dtype="bool"),
+    Column("Liquid To Invest", "analysis", ("_liquid_to_invest", "_liquid _to _invest"), "lower"),
+    Column("Job", "analysis", ("_job",)),
+    Column("Follow Up", "analysis", ("_follow_up", "_follow _up")),
+    Column("Past Experience", "analysis", ("_past_experience", "_past _experience"), "lower"),
+    Column("Recording", "analysis", ("recording_url",)),
+]
+
+# retell-webhook-endpoint/main.py (Firestore-synced core + Vista columns)
+VISTA_COLUMNS = [
+    *STANDARD_COLUMNS[:17],
+    Column("Summery", "analysis",
+           ("_summary", "_call_summary", "_call _summery", "_Summary", "Summary", "summary")),
+    Column("Quality", "analysis", ("_quality",)),
+    Column("Disconnection Reason", "call", ("disconnection_reason",)),
+    Column("Recording", "vars", VAR_ALIASES["Recording"]),
+    Column("Firestore_ID", "vars", ("firestore_doc_id",)),
+    Column("Processed"),
+    Column("Sector Processed"),
+    Column("Interested", "analysis", ("_interested",), "lower", dtype="bool"),
+    Column("Liquid To Invest", "analysis", ("_liquid_to_invest", "_liquid _to _invest"), "lower"),
+    Column("Job", "analysis", ("_job",)),
+    Column("Follow Up", "analysis", ("_follow_up", "_follow _up")),
+    Column("Past Experience", "analysis",
+           ("_past_oil", "_past _oil", "_past_experience", "past_experience"), "lower"),
+    Column("summary"),
+]
+
+SCHEMAS = {"standard": STANDARD_COLUMNS, "vista": VISTA_COLUMNS}
+
+
+def _columns_from_config(config: dict) -> List[Column]:
+    schema = config.get("schema", "standard")
+    if schema not in SCHEMAS:
+        raise ValueError(f"unknown schema {schema!r} (expected one of {sorted(SCHEMAS)})")
+    preset = SCHEMAS[schema]
+    spec = config.get("columns")
+    if not spec:
+        return list(preset)
+
+    by_header = {c.header: c for c in preset}
+    columns = []
+    for entry in spec:
+        if isinstance(entry, str):
+            if entry not in by_header:
+                raise ValueError(f"column {entry!r} is not in the {schema!r} schema")
+            columns.append(by_header[entry])
+        else:
+            columns.append(
+                Column(
+                    entry["header"],
+                    entry.get("source"),
+                    tuple(entry.get("keys", ())),
+                    entry.get("transform"),
+                    entry.get("default", ""),
+                    entry.get("type"),
+                )
+            )
+    return columns
+
+
+# ─────────────────────────── Pipeline ────────────────────────────
+class Pipeline:
+    def __init__(self, config: dict):
+        self.label = config.get("label", "pipeline")
+        self.bucket_name = (
+            config.get("bucket_name") or config.get("bucket") or config.get("bucketName")
+        )
+        self.csv_path = config.get("csv_path") or config.get("path") or "raw_leads/inbound_webhook.csv"
+        self.key_column = config.get("key_column", "Phone")
+        self.storage_mode = config.get("storage_mode", "rmw")
+        self.parquet_prefix = config.get("parquet_prefix") or None
+        self.bq_table = config.get("bq_table", BQ_TABLE_ID)
+        self.use_firestore = bool(config.get("use_firestore", False))
+        self.raise_on_error = bool(config.get("raise_on_error", True))
+
+        self.columns = _columns_from_config(config)
+        self.headers = headers(self.columns)
+        self.build_row = compile_columns(self.columns, label=self.label)
+        if self.parquet_prefix:
+            gcs_parquet.partition_column(self.columns)  # fail the route, not every request
+
+    # ─────────────── BigQuery ───────────────
+    def _table_ref(self) -> str:
+        return f"{clients.PROJECT_ID}.{BQ_DATASET_ID}.{self.bq_table}"
+
+    def _history_row(self, payload: dict, call: dict):
+        """The history row, or a callable that archives the payload first (payload_archive.history_row)."""
+        analysis = call.get("call_analysis", {}).get("custom_analysis_data", {})
+        row = {
+            "ingestion_timestamp": datetime.utcnow().isoformat(),
+            "call_id": call.get("call_id"),
+            "to_number": call.get("to_number"),
+            "from_number": call.get("from_number"),
+            "disposition": str(
+                analysis.get("_correct_name", analysis.get("_correct _name", ""))
+            ),
+            "retell_agent_id": call.get("agent_id"),
+            "call_duration_ms": call.get("call_cost", {}).get("total_duration_seconds", 0)
+            * 1000,
+        }
+        # inline JSON, or a gs:// reference to the payload archived by the sink's flusher
+        return payload_archive.history_row(row, clients.storage(), payload, call)
+
+    def log_to_bigquery(self, payload: dict, call: dict) -> bool:
+        """True once the row is known to be in BigQuery – never for an async hand-off (bq_sink.py)."""
+        if not self.bq_table:
+            return True
+        try:
+            with spans.span("bigquery"):
+                row = self._history_row(payload, call)
+                # batched off the response path (see bq_sink.py)
+                sink = bq_sink.get_sink(clients.bigquery)
+                return sink.submit(self._table_ref(), row, insert_id=call.get("call_id")) and sink.confirms
+        except Exception as e:
+            print(f"{self.label} BigQuery logging failed: {e}")
+            return False
+
+    def log_many_to_bigquery(self, events: List[Tuple[dict, dict]]) -> List[bool]:
+        """log_to_bigquery() for several (payload, call) pairs, handed over as one batch."""
+        if not (self.bq_table and events):
+            return [True] * len(events)
+        rows = []
+        for payload, call in events:
+            try:
+                row = self._history_row(payload, call)
+            except Exception as e:
+                print(f"{self.label} BigQuery logging failed for {call.get('call_id')}: {e}")
+                continue
+            rows.append((row, call.get("call_id")))
+        try:
+            sink = bq_sink.get_sink(clients.bigquery)
+            kept = sink.submit_many(self._table_ref(), rows)
+            landed = kept if sink.confirms else set()
+        except Exception as e:
+            print(f"{self.label} BigQuery logging failed for {len(rows)} row(s): {e}")
+            landed = set()
+        return [call.get("call_id") in landed for _, call in events]
+
+    # ─────────────── CSV ───────────────
+    def append(self, storage_client, rows: List[Dict[str, Any]]) -> Optional[int]:
+        if self.storage_mode == "segments":
+            gcs_segments.append_segment(
+                storage_client, self.bucket_name, self.csv_path, rows, self.headers, self.key_column
+            )
+            return None
+        bucket = storage_client.bucket(self.bucket_name)
+        if self.storage_mode == "feed":
+            first, nxt = gcs_feed.append_rows(bucket, self.csv_path, rows, self.headers)
+            print(
+                f"{self.label}: appended {len(rows)} row(s) to the feed of "
+                f"gs://{self.bucket_name}/{self.csv_path} as #{first}-{nxt - 1}."
+            )
+            return None
+        if self.storage_mode == "rollover":
+            open_rows = gcs_rollover.append_rows(bucket, self.csv_path, rows, self.headers, self.key_column)
+            print(
+                f"{self.label}: appended {len(rows)} row(s) to the open segment of "
+                f"gs://{self.bucket_name}/{self.csv_path}. Rows in segment: {open_rows}"
+            )
+            return open_rows
+        total_rows = gcs_csv.append_rows(bucket, self.csv_path, rows, self.headers, self.key_column)
+        print(
+            f"{self.label}: appended {len(rows)} row(s) to "
+            f"gs://{self.bucket_name}/{self.csv_path}. Total rows: {total_rows}"
+        )
+        return total_rows
+
+    # ─────────────── Parquet ───────────────
+    def write_parquet(self, storage_client, rows: List[Dict[str, Any]]) -> None:
+        parts = gcs_parquet.write_rows(
+            storage_client, self.bucket_name, self.parquet_prefix, rows, self.columns
+        )
+        if parts:
+            print(f"{self.label}: wrote {len(rows)} row(s) to {len(parts)} Parquet part(s).")
+
+    def compact_parquet(self, storage_client, min_parts: int = gcs_parquet.COMPACT_MIN_PARTS) -> Dict[str, int]:
+        return gcs_parquet.compact(
+            storage_client, self.bucket_name, self.parquet_prefix, self.columns, self.key_column, min_parts
+        )
+
+    # ─────────────── Firestore ───────────────
+    def update_lead(self, call: dict, vars_: dict, row: Dict[str, Any]) -> None:
+        """Record the call on leads/{firestore_doc_id} (skips duplicate call_ids)."""
+        doc_id = vars_.get("firestore_doc_id")
+        if not doc_id:
+            print(f"{self.label}: payload lacks firestore_doc_id – Firestore skipped.")
+            return
+        if clients.firestore() is None:
+            raise RuntimeError("Firestore client unavailable")
+
+        call_id = call.get("call_id")
+        # inline transaction, or spooled for the write-behind flusher (LEAD_SINK_MODE)
+        outcome = lead_sink.get_sink(clients.firestore, clients.storage).record(doc_id, call_id, row)
+        if outcome == leads.QUEUED:
+            print(f"{self.label}: lead {doc_id} update queued.")
+        elif outcome == leads.MISSING:
+            print(f"{self.label}: lead {doc_id} not found – Firestore skipped.")
+        elif outcome == leads.DUPLICATE:
+            print(f"{self.label}: duplicate call_id {call_id} ignored.")
+        else:
+            print(f"{self.label}: lead {doc_id} updated with call results.")
+
+    def update_leads(self, items: List[Tuple[dict, dict, Dict[str, Any]]]) -> List[Optional[str]]:
+        """
+        update_lead() for several (call, vars_, row) triples: one get_all()
+        for the leads and their call markers (existence only) and one
+        WriteBatch per FIRESTORE_BATCH_LIMIT writes.  Returns an error
+        string (or None) per item.
+        """
+        errors: List[Optional[str]] = [None] * len(items)
+        wanted = [(i, vars_.get("firestore_doc_id")) for i, (_, vars_, _) in enumerate(items)]
+        wanted = [(i, doc_id) for i, doc_id in wanted if doc_id]
+        if not wanted:
+            return errors
+        db = clients.firestore()
+        if db is None:
+            for i, _ in wanted:
+                errors[i] = "Firestore client unavailable"
+            return errors
+        from google.cloud import firestore
+
+        refs = {doc_id: leads.lead_ref(db, doc_id) for _, doc_id in wanted}
+        markers = {i: leads.marker_ref(refs[doc_id], items[i][0].get("call_id")) for i, doc_id in wanted}
+        try:
+            # a field mask keeps the (growing) lead documents off the wire
+            found = {
+                snap.reference.path
+                for snap in db.get_all(list(refs.values()) + list(markers.values()), field_paths=["call_id"])
+                if snap.exists
+            }
+        except Exception as e:
+            for i, _ in wanted:
+                errors[i] = f"lead lookup failed: {e}"
+            return errors
+
+        writes = []
+        for i, doc_id in wanted:
+            call_id = items[i][0].get("call_id")
+            if refs[doc_id].path not in found:
+                print(f"{self.label}: lead {doc_id} not found – Firestore skipped.")
+            elif markers[i].path in found:
+                print(f"{self.label}: duplicate call_id {call_id} ignored.")
+            else:
+                found.add(markers[i].path)  # the same call twice in this batch
+                writes.append((i, refs[doc_id], call_id, items[i][2]))
+
+        per_batch = FIRESTORE_BATCH_LIMIT // leads.WRITES_PER_CALL
+        for start in range(0, len(writes), per_batch):
+            chunk = writes[start : start + per_batch]
+            batch = db.batch()
+            for _, ref, call_id, row in chunk:
+                leads.add_call(batch, firestore, ref, call_id, row)
+            try:
+                batch.commit()
+            except Exception as e:
+                for i, *_ in chunk:
+                    errors[i] = str(e)
+        failed = sum(1 for i, *_ in writes if errors[i])
+        print(f"{self.label}: {len(writes) - failed} lead(s) updated, {failed} failed.")
+        return errors
+
+    # ─────────────── Entry points ───────────────
+    @staticmethod
+    def _sources(call: dict) -> Tuple[dict, dict, dict]:
+        vars_ = call.get("retell_llm_dynamic_variables", {}) or {}
+        analysis = call.get("call_analysis", {}).get("custom_analysis_data", {}) or {}
+        # make the recording URL visible to build_row()
+        analysis["recording_url"] = call.get("recording_url", "")
+        cost = call.get("call_cost", {}) or {}
+        return vars_, analysis, cost
+
+    def handle(self, payload: dict, call: dict, config: dict = None) -> None:
+        storage_client = clients.storage()
+        if not storage_client:
+            print(f"{self.label}: storage client missing – aborting.")
+            return
+
+        # redeliveries skip the stages that already completed (idempotency.py)
+        with idempotency.guard(clients.storage).execution(call.get("call_id")) as ex:
+            if ex.complete:
+                print(f"{self.label}: call {ex.call_id} already processed – skipping.")
+                return
+            self._run(ex, storage_client, payload, call)
+
+    def _run(self, ex, storage_client, payload: dict, call: dict) -> None:
+        # marked only when confirmed: a queued row is retried by the next delivery
+        if ex.needs("bigquery") and self.log_to_bigquery(payload, call):
+            ex.mark("bigquery")
+
+        with spans.span("build_row"):
+            vars_, analysis, cost = self._sources(call)
+            row = self.build_row(call, vars_, analysis, cost)
+        if not row["Date"]:
+            print(f"{self.label}: invalid/missing end_timestamp, skipping.")
+            return
+
+        if ex.needs("csv"):
+            try:
+                with spans.span("csv_append"):
+                    self.append(storage_client, [row])
+            except Exception as e:
+                print(
+                    f"{self.label} error: failed to append webhook payload to storage "
+                    f"(bucket={self.bucket_name}, path={self.csv_path}): {e}"
+                )
+                if self.raise_on_error:
+                    raise
+                return
+            ex.mark("csv")
+
+        if self.use_firestore and ex.needs("firestore"):
+            self.update_lead(call, vars_, row)
+            ex.mark("firestore")
+
+        # last, so a redelivery for a failed part redoes nothing else
+        if self.parquet_prefix and ex.needs("parquet"):
+            try:
+                self.write_parquet(storage_client, [row])
+            except Exception as e:
+                print(f"{self.label} error: failed to write Parquet part under {self.parquet_prefix}: {e}")
+                if self.raise_on_error:
+                    raise
+                return
+            ex.mark("parquet")
+
+    def handle_batch(self, events: List[Tuple[dict, dict]]) -> List[Tuple[str, Optional[str]]]:
+        """
+        Bulk variant of handle() for (payload, call) pairs routed here: one
+        BigQuery hand-off, one CSV write and one Firestore batch for the lot.
+        Returns (status, error) per event – status is "ok", "duplicate",
+        "skipped" or "error".  A failed stage leaves its calls open in the
+        idempotency guard regardless of raise_on_error, so the sender can
+        simply re-send the failures.
+        """
+        results: List[Tuple[str, Optional[str]]] = [("ok", None)] * len(events)
+        storage_client = clients.storage()
+        if not storage_client:
+            return [("error", "storage client unavailable")] * len(events)
+
+        guard = idempotency.guard(clients.storage)
+        with contextlib.ExitStack() as stack:
+            live, seen = [], set()
+            # acquire in call_id order so two overlapping batches cannot
+            # each hold a call the other is waiting for
+            for i in sorted(range(len(events)), key=lambda j: str(events[j][1].get("call_id") or "")):
+                payload, call = events[i]
+                call_id = call.get("call_id")
+                if call_id and call_id in seen:
+                    results[i] = ("duplicate", None)
+                    continue
+                seen.add(call_id)
+                ex = stack.enter_context(guard.execution(call_id))
+                if ex.complete:
+                    results[i] = ("duplicate", None)
+                    continue
+                live.append((i, ex, payload, call))
+            live.sort(key=lambda item: item[0])
+
+            pending = [item for item in live if item[1].needs("bigquery")]
+            with spans.span("bigquery"):
+                landed = self.log_many_to_bigquery([(payload, call) for _, _, payload, call in pending])
+            for (_, ex, _, _), ok in zip(pending, landed):
+                if ok:
+                    ex.mark("bigquery")
+
+            rows = []
+            for i, ex, _, call in live:
+                vars_, analysis, cost = self._sources(call)
+                row = self.build_row(call, vars_, analysis, cost)
+                if not row["Date"]:
+                    results[i] = ("skipped", "invalid/missing end_timestamp")
+                    continue
+                rows.append((i, ex, call, vars_, row))
+
+            pending = [item for item in rows if item[1].needs("csv")]
+            if pending:
+                try:
+                    with spans.span("csv_append"):
+                        self.append(storage_client, [row for *_, row in pending])
+                except Exception as e:
+                    print(
+                        f"{self.label} error: failed to append {len(pending)} row(s) to storage "
+                        f"(bucket={self.bucket_name}, path={self.csv_path}): {e}"
+                    )
+                    for i, ex, *_ in pending:
+                        ex.fail()
+                        results[i] = ("error", f"csv: {e}")
+                    rows = [item for item in rows if not item[1].failed]
+                else:
+                    for _, ex, *_ in pending:
+                        ex.mark("csv")
+
+            if self.use_firestore:
+                pending = [item for item in rows if item[1].needs("firestore")]
+                with spans.span("firestore_batch"):
+                    errors = self.update_leads([(call, vars_, row) for _, _, call, vars_, row in pending])
+                for (i, ex, *_), error in zip(pending, errors):
+                    if error:
+                        ex.fail()
+                        results[i] = ("error", f"firestore: {error}")
+                    else:
+                        ex.mark("firestore")
+
+            if self.parquet_prefix:
+                pending = [item for item in rows if not item[1].failed and item[1].needs("parquet")]
+                try:
+                    self.write_parquet(storage_client, [row for *_, row in pending])
+                except Exception as e:
+                    print(f"{self.label} error: failed to write {len(pending)} Parquet row(s): {e}")
+                    for i, ex, *_ in pending:
+                        ex.fail()
+                        results[i] = ("error", f"parquet: {e}")
+                else:
+                    for _, ex, *_ in pending:
+                        ex.mark("parquet")
+        return results
+
+
+# ───────────────────────── Compiled cache ──────────────────────────
+_lock = threading.Lock()
+_pipelines: Dict[str, Pipeline] = {}
+# id(config) → (config, pipeline), least recently used first: skips
+# re-serialising the routing entry on every request; holding `config`
+# keeps its id from being reused.  Bounded, because handlers' for_config
+# builds a fresh dict per call and a refreshed routing table brings new
+# entries – those only churn the oldest slots.
+_IDENTITY_SLOTS = 256
+_by_identity: "collections.OrderedDict[int, tuple]" = collections.OrderedDict()
+
+
+def normalise(config: dict) -> dict:
+    """
+    `config` with its target under the canonical keys: "bucket" /
+    "bucketName" become "bucket_name" and "path" becomes "csv_path", so a
+    routing entry's own target wins over preset defaults merged beneath it.
+    """
+    out = dict(config)
+    for canonical, aliases in (("bucket_name", ("bucket", "bucketName")), ("csv_path", ("path",))):
+        if not out.get(canonical):
+            value = next((out[a] for a in aliases if out.get(a)), None)
+            if value:
+                out[canonical] = value
+    return out
+
+
+def _cache_key(config: dict) -> str:
+    return json.dumps(config, sort_keys=True, default=str)
+
+
+def get(config: dict) -> Pipeline:
+    """The compiled pipeline for `config` (built once per distinct entry)."""
+    with _lock:
+        hit = _by_identity.get(id(config))
+        if hit is not None and hit[0] is config:
+            _by_identity.move_to_end(id(config))
+            return hit[1]
+    key = _cache_key(config)
+    with _lock:
+        pipe = _pipelines.get(key)
+        if pipe is None:
+            pipe = _pipelines[key] = Pipeline(config)
+        _by_identity[id(config)] = (config, pipe)
+        _by_identity.move_to_end(id(config))
+        while len(_by_identity) > _IDENTITY_SLOTS:
+            _by_identity.popitem(last=False)
+    return pipe
+
+
+def handle(payload: dict, call: dict, config: dict) -> None:
+    """Router-compatible entry point: `"handler": "pipeline"`."""
+    get(config).handle(payload, call)
+
+
+def compact_parquet(routes: Dict[str, Tuple[dict, Any]], min_parts: int = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Compact the Parquet parts of every pipeline-backed route with a
+    parquet_prefix (routes as in RoutingTable.snapshot().routes), once
+    per distinct target.  Returns {"gs://bucket/prefix": {dt: parts folded}}.
+    """
+    storage_client = clients.storage()
+    report: Dict[str, Dict[str, Any]] = {}
+    for _, handle in routes.values():
+        target = getattr(handle, "__self__", None)
+        if not isinstance(target, Pipeline) or not target.parquet_prefix:
+            continue
+        where = f"gs://{target.bucket_name}/{target.parquet_prefix}"
+        if where in report:
+            continue
+        try:
+            report[where] = target.compact_parquet(
+                storage_client, gcs_parquet.COMPACT_MIN_PARTS if min_parts is None else min_parts
+            )
+        except Exception as e:
+            print(f"Parquet compaction failed for {where}: {e}")
+            report[where] = {"error": str(e)}
+    return report
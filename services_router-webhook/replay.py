@@ -0,0 +1,457 @@
+"""
+replay.py
+─────────────────────────────────────────────────────────────
+Offline replay: rebuild campaign CSVs from archived webhook payloads.
+
+When a CSV gets clobbered, or a handler bug is fixed, the rows can be
+regenerated from what retell_call_history already holds:
+
+  python replay.py --source export.ndjson.gz --out ./rebuilt
+  python replay.py --source ./payloads --agent-config agent_config.json \\
+                   --workers 8 --only retell-calling-reference-data --json stats.json
+
+Sources (--source, repeatable, read in the order given):
+  *.ndjson / *.jsonl [.gz]  one object per line – a BigQuery export of
+                            retell_call_history (full_webhook_payload
+                            inline, or payload_uri for archived rows) or
+                            raw webhook payloads
+  *.json [.gz]              one payload per file
+  directory                 walked recursively (sorted) for the above –
+                            e.g. a copy of the payload_archive.py tree
+
+Archived rows (payload_uri) are read from --gcs-root/<bucket>/<path> when
+given, otherwise downloaded with the storage client.
+
+Routing is the router's table (DEFAULT_AGENT_CONFIGS + AGENT_CONFIG_URI,
+or --agent-config layered over the defaults), and rows come from the
+same compiled Pipeline.build_row the live handlers use.  Only the CSV
+is rebuilt – no BigQuery rows, no Firestore updates.
+
+Output goes to --out/<bucket_name>/<csv_path> (a fake-GCS layout);
+upload it with `gsutil cp` once checked.
+
+How it stays in bounded memory with millions of payloads:
+* the reader streams sources and hands chunks of raw lines to
+  --workers processes through bounded queues, sharded by agent_id
+  (found with a regex – the parent never parses JSON);
+* workers stream rows into per-target part files, each row tagged
+  with its global sequence number;
+* the merge reproduces gcs_csv's keep-last-per-key dedupe without a
+  global key index: (key, seq) pairs are hash-partitioned to disk,
+  each partition (≤ --partition-rows keys) yields its winning seqs,
+  and the parts are k-way merged by seq against the merged winners.
+"""
+
+import argparse
+import contextlib
+import csv
+import gzip
+import hashlib
+import heapq
+import importlib
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+csv.field_size_limit(sys.maxsize)
+
+CHUNK_LINES = 1000
+QUEUE_CHUNKS = 8  # per worker: at most CHUNK_LINES * QUEUE_CHUNKS lines in flight
+PARTITION_ROWS = 500_000
+
+_AGENT_RE = re.compile(r'"(?:retell_)?agent_id"\s*:\s*"([^"]+)"')
+_LINE_SUFFIXES = (".ndjson", ".jsonl", ".ndjson.gz", ".jsonl.gz")
+_FILE_SUFFIXES = (".json", ".json.gz")
+
+
+# ───────────────────────────── Reading ─────────────────────────────
+def _open_text(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def _files(path: str) -> Iterator[str]:
+    if not os.path.isdir(path):
+        yield path
+        return
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            if name.endswith(_LINE_SUFFIXES + _FILE_SUFFIXES):
+                yield os.path.join(root, name)
+
+
+def iter_records(sources: List[str]) -> Iterator[str]:
+    """Raw JSON texts, one per event, streamed from every source in order."""
+    for source in sources:
+        for path in _files(source):
+            with _open_text(path) as fh:
+                if path.endswith(_LINE_SUFFIXES):
+                    for line in fh:
+                        if line.strip():
+                            yield line
+                else:
+                    yield fh.read()
+
+
+def _shard(text: str, workers: int) -> int:
+    m = _AGENT_RE.search(text)
+    return zlib.crc32(m.group(1).encode()) % workers if m else 0
+
+
+# ───────────────────────────── Routing ─────────────────────────────
+def load_configs(agent_config: Optional[str]) -> Dict[str, Dict]:
+    """The router's table: defaults + AGENT_CONFIG_URI, or + a local file."""
+    os.environ.setdefault("ROUTER_STARTUP_MODE", "lazy")
+    import router_webhook
+
+    if not agent_config:
+        return dict(router_webhook.ROUTES.configs())
+    with open(agent_config, "r", encoding="utf-8") as fh:
+        data = json.load(fh)
+    return {**router_webhook.DEFAULT_AGENT_CONFIGS, **router_webhook._parse_agents(data)}
+
+
+def _pipeline_for(config: Dict):
+    """The compiled Pipeline behind a routing entry, or None if it has none."""
+    import pipeline
+
+    modpath = config["handler"]
+    if modpath == "pipeline":
+        return pipeline.get(config)
+    bind = getattr(importlib.import_module(modpath), "for_config", None)
+    target = getattr(bind(config), "__self__", None) if bind is not None else None
+    return target if isinstance(target, pipeline.Pipeline) else None
+
+
+def _target_id(bucket: str, path: str) -> str:
+    return hashlib.sha1(f"{bucket}/{path}".encode()).hexdigest()[:12]
+
+
+# ───────────────────────────── Workers ─────────────────────────────
+class _Worker:
+    def __init__(self, index: int, configs: Dict[str, Dict], workdir: str, gcs_root: Optional[str]):
+        self.index = index
+        self.configs = configs
+        self.workdir = workdir
+        self.gcs_root = gcs_root
+        self._pipes: Dict[str, Any] = {}
+        self._files: Dict[str, Tuple[Any, Any]] = {}
+        self.targets: Dict[str, Dict[str, Any]] = {}
+        self.stats = {
+            "events": 0,
+            "rows": 0,
+            "no_date": 0,
+            "ignored": 0,
+            "not_routed": 0,
+            "unsupported": 0,
+            "errors": 0,
+            "busy_s": 0.0,
+        }
+        self.error_samples: List[str] = []
+
+    def _fetch(self, uri: str) -> dict:
+        import payload_archive
+
+        if self.gcs_root:
+            bucket, path = payload_archive._split_uri(uri)
+            with open(os.path.join(self.gcs_root, bucket, path), "rb") as fh:
+                return payload_archive.decode_archived(path, fh.read())
+        import clients
+
+        return payload_archive.fetch_payload(uri, clients.storage())
+
+    def _decode(self, text: str) -> dict:
+        obj = json.loads(text)
+        if "full_webhook_payload" not in obj and "payload_uri" not in obj:
+            return obj  # a raw webhook payload
+        inline = obj.get("full_webhook_payload")
+        if inline:
+            return json.loads(inline) if isinstance(inline, str) else inline
+        if obj.get("payload_uri"):
+            return self._fetch(obj["payload_uri"])
+        raise ValueError("row has neither full_webhook_payload nor payload_uri")
+
+    def _pipe(self, agent_id: str):
+        if agent_id not in self._pipes:
+            cfg = self.configs.get(agent_id)
+            self._pipes[agent_id] = _pipeline_for(cfg) if cfg else None
+        return self._pipes[agent_id]
+
+    def _writer(self, pipe):
+        tid = _target_id(pipe.bucket_name, pipe.csv_path)
+        if tid not in self._files:
+            part_dir = os.path.join(self.workdir, tid)
+            os.makedirs(part_dir, exist_ok=True)
+            fh = open(os.path.join(part_dir, f"w{self.index:03d}.csv"), "w", newline="", encoding="utf-8")
+            self._files[tid] = (fh, csv.writer(fh, quoting=csv.QUOTE_ALL, lineterminator="\n"))
+            self.targets[tid] = {
+                "bucket_name": pipe.bucket_name,
+                "csv_path": pipe.csv_path,
+                "headers": pipe.headers,
+                "key_column": pipe.key_column,
+                "rows": 0,
+            }
+        return tid, self._files[tid][1]
+
+    def process(self, seq: int, text: str) -> None:
+        self.stats["events"] += 1
+        try:
+            payload = self._decode(text)
+            if payload.get("event", "call_analyzed") != "call_analyzed":
+                self.stats["ignored"] += 1
+                return
+            call = payload.get("data") or payload.get("call", {})
+            agent_id = call.get("agent_id", "")
+            if agent_id not in self.configs:
+                self.stats["not_routed"] += 1
+                return
+            pipe = self._pipe(agent_id)
+            if pipe is None:
+                self.stats["unsupported"] += 1
+                return
+            vars_, analysis, cost = pipe._sources(call)
+            row = pipe.build_row(call, vars_, analysis, cost)
+            if not row["Date"]:
+                self.stats["no_date"] += 1
+                return
+            tid, writer = self._writer(pipe)
+            writer.writerow([seq] + ["" if row.get(h) is None else row.get(h) for h in pipe.headers])
+            self.targets[tid]["rows"] += 1
+            self.stats["rows"] += 1
+        except Exception as exc:
+            self.stats["errors"] += 1
+            if len(self.error_samples) < 5:
+                self.error_samples.append(f"#{seq}: {exc}")
+
+    def close(self) -> None:
+        for fh, _ in self._files.values():
+            fh.close()
+
+
+def _work(index, inq, outq, configs, workdir, gcs_root) -> None:
+    worker = _Worker(index, configs, workdir, gcs_root)
+    # per-event handler warnings (bad timestamps …) would flood the console;
+    # they are counted in the stats instead
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        while True:
+            chunk = inq.get()
+            if chunk is None:
+                break
+            t0 = time.perf_counter()
+            for seq, text in chunk:
+                worker.process(seq, text)
+            worker.stats["busy_s"] += time.perf_counter() - t0
+    worker.close()
+    outq.put((index, worker.stats, worker.targets, worker.error_samples))
+
+
+# ───────────────────────────── Merging ─────────────────────────────
+def _part_rows(path: str) -> Iterator[Tuple[int, List[str]]]:
+    with open(path, "r", newline="", encoding="utf-8") as fh:
+        for rec in csv.reader(fh):
+            yield int(rec[0]), rec[1:]
+
+
+def _winners(parts: List[str], key_i: int, scratch: str, partition_rows: int, rows: int) -> Iterator[int]:
+    """Ascending seqs of the last row per key, in memory bounded by partition_rows."""
+    n_parts = max(1, -(-rows // partition_rows))
+    spill = [open(os.path.join(scratch, f"keys-{p}.csv"), "w", newline="", encoding="utf-8") for p in range(n_parts)]
+    writers = [csv.writer(fh, lineterminator="\n") for fh in spill]
+    for part in parts:
+        for seq, rec in _part_rows(part):
+            key = rec[key_i]
+            writers[zlib.crc32(key.encode()) % n_parts].writerow([seq, key])
+    for fh in spill:
+        fh.close()
+
+    sorted_paths = []
+    for p in range(n_parts):
+        last: Dict[str, int] = {}
+        with open(os.path.join(scratch, f"keys-{p}.csv"), "r", newline="", encoding="utf-8") as fh:
+            for seq, key in csv.reader(fh):
+                seq = int(seq)
+                if seq > last.get(key, -1):
+                    last[key] = seq
+        os.remove(os.path.join(scratch, f"keys-{p}.csv"))
+        out = os.path.join(scratch, f"win-{p}.txt")
+        with open(out, "w") as fh:
+            fh.writelines(f"{seq}\n" for seq in sorted(last.values()))
+        sorted_paths.append(out)
+        del last
+
+    def ints(path):
+        with open(path) as fh:
+            for line in fh:
+                yield int(line)
+
+    return heapq.merge(*(ints(p) for p in sorted_paths))
+
+
+def merge_target(target: Dict[str, Any], part_dir: str, out_root: str, partition_rows: int) -> int:
+    """Write one rebuilt CSV from the workers' part files; returns rows written."""
+    parts = sorted(os.path.join(part_dir, n) for n in os.listdir(part_dir))
+    headers = target["headers"]
+    key_i = headers.index(target["key_column"]) if target["key_column"] in headers else None
+    dest = os.path.join(out_root, target["bucket_name"], target["csv_path"])
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+    winners = None
+    if key_i is not None:
+        winners = _winners(parts, key_i, part_dir, partition_rows, target["rows"])
+    next_win = next(winners, None) if winners is not None else None
+
+    written = 0
+    with open(dest + ".tmp", "w", newline="", encoding="utf-8") as fh:
+        out = csv.writer(fh, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        out.writerow(headers)
+        for seq, rec in heapq.merge(*(_part_rows(p) for p in parts), key=lambda r: r[0]):
+            if winners is not None:
+                if seq != next_win:
+                    continue
+                next_win = next(winners, None)
+            out.writerow(rec)
+            written += 1
+    os.replace(dest + ".tmp", dest)
+    return written
+
+
+# ───────────────────────────── Driver ──────────────────────────────
+def replay(
+    sources: List[str],
+    out_root: str,
+    configs: Dict[str, Dict],
+    workers: int = None,
+    gcs_root: str = None,
+    only_buckets: List[str] = None,
+    partition_rows: int = PARTITION_ROWS,
+) -> Dict[str, Any]:
+    workers = workers or os.cpu_count() or 1
+    if only_buckets:
+        configs = {
+            aid: cfg for aid, cfg in configs.items()
+            if (cfg.get("bucket_name") or cfg.get("bucket") or cfg.get("bucketName")) in only_buckets
+        }
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    t0 = time.perf_counter()
+    try:
+        ctx = multiprocessing.get_context()
+        outq = ctx.Queue()
+        inqs = [ctx.Queue(maxsize=QUEUE_CHUNKS) for _ in range(workers)]
+        procs = [
+            ctx.Process(target=_work, args=(k, inqs[k], outq, configs, workdir, gcs_root), daemon=True)
+            for k in range(workers)
+        ]
+        for p in procs:
+            p.start()
+
+        chunks: List[List[Tuple[int, str]]] = [[] for _ in range(workers)]
+        read = 0
+        for seq, text in enumerate(iter_records(sources)):
+            k = _shard(text, workers)
+            chunks[k].append((seq, text))
+            if len(chunks[k]) >= CHUNK_LINES:
+                inqs[k].put(chunks[k])  # blocks while that worker is behind
+                chunks[k] = []
+            read = seq + 1
+        for k in range(workers):
+            if chunks[k]:
+                inqs[k].put(chunks[k])
+            inqs[k].put(None)
+
+        totals: Dict[str, Any] = {}
+        targets: Dict[str, Dict[str, Any]] = {}
+        errors: List[str] = []
+        per_worker = []
+        for _ in range(workers):
+            index, stats, found, samples = outq.get()
+            per_worker.append({"worker": index, **stats})
+            for name, n in stats.items():
+                totals[name] = totals.get(name, 0) + n
+            for tid, meta in found.items():
+                if tid in targets:
+                    targets[tid]["rows"] += meta["rows"]
+                else:
+                    targets[tid] = meta
+            errors.extend(samples)
+        for p in procs:
+            p.join()
+        t_map = time.perf_counter() - t0
+
+        outputs = []
+        for tid, meta in sorted(targets.items(), key=lambda kv: (kv[1]["bucket_name"], kv[1]["csv_path"])):
+            written = merge_target(meta, os.path.join(workdir, tid), out_root, partition_rows)
+            outputs.append({
+                "path": os.path.join(out_root, meta["bucket_name"], meta["csv_path"]),
+                "rows_in": meta["rows"],
+                "rows_out": written,
+            })
+        elapsed = time.perf_counter() - t0
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "events": read,
+        **{k: (round(v, 3) if isinstance(v, float) else v) for k, v in totals.items()},
+        "workers": workers,
+        "elapsed_s": round(elapsed, 3),
+        "map_s": round(t_map, 3),
+        "merge_s": round(elapsed - t_map, 3),
+        "events_per_s": round(read / elapsed) if elapsed else None,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "max_worker_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        "outputs": outputs,
+        "error_samples": errors[:20],
+        "per_worker": sorted(per_worker, key=lambda w: w["worker"]),
+    }
+
+
+def main(argv: List[str] = None) -> int:
+    ap = argparse.ArgumentParser(description="Rebuild campaign CSVs from archived webhook payloads.")
+    ap.add_argument("--source", action="append", required=True, help="NDJSON/JSON file or directory")
+    ap.add_argument("--out", required=True, help="output root (<out>/<bucket>/<csv_path>)")
+    ap.add_argument("--agent-config", help="local agent_config.json layered over the built-in routes")
+    ap.add_argument("--workers", type=int, default=None, help="processes (default: CPU count)")
+    ap.add_argument("--gcs-root", help="local mirror for payload_uri objects (<root>/<bucket>/<path>)")
+    ap.add_argument("--only", action="append", help="only rebuild targets in this bucket (repeatable)")
+    ap.add_argument("--partition-rows", type=int, default=PARTITION_ROWS,
+                    help="max keys held in memory per dedupe partition")
+    ap.add_argument("--json", help="write the stats report to this file")
+    args = ap.parse_args(argv)
+
+    report = replay(
+        args.source,
+        args.out,
+        load_configs(args.agent_config),
+        workers=args.workers,
+        gcs_root=args.gcs_root,
+        only_buckets=args.only,
+        partition_rows=args.partition_rows,
+    )
+    for out in report["outputs"]:
+        print(f"  {out['path']}: {out['rows_out']:,} row(s) ({out['rows_in']:,} before dedupe)")
+    print(
+        f"replay: {report['events']:,} event(s) in {report['elapsed_s']}s "
+        f"({report['events_per_s']:,}/s, {report['workers']} worker(s)); "
+        f"rows={report.get('rows', 0):,} errors={report.get('errors', 0)} "
+        f"not_routed={report.get('not_routed', 0)} no_date={report.get('no_date', 0)}"
+    )
+    for sample in report["error_samples"]:
+        print(f"  error {sample}")
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(report, fh, indent=2)
+    return 1 if report.get("errors") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
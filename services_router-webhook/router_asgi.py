@@ -0,0 +1,161 @@
+"""
+router_asgi.py
+─────────────────────────────────────────────────────────────
+asyncio server mode for the webhook router.
+
+`functions-framework --target=retell_webhook_router` serves the router
+from gunicorn's threaded WSGI worker: THREADS (default 4 per CPU)
+webhooks in flight per instance, each holding a thread for as long as
+its GCS, BigQuery and Firestore calls take.  The same router on
+functions-framework's ASGI server (Starlette on uvicorn):
+
+  functions-framework --target=retell_webhook_router_async \\
+      --source=router_asgi.py --asgi
+
+* Validation and routing are the router's own (_validate and
+  _dispatch in router_webhook.py), so statuses and bodies are the
+  same; `--entry-point retell_webhook_router_async` deploys it.
+* Connections are coroutines: hundreds of webhooks can be in flight
+  while the handlers, whose client libraries block, run on a bounded
+  thread pool (ASGI_THREADS) in the request's span context.
+* In flight per (bucket_name, csv_path) is bounded by an asyncio
+  semaphore (ASGI_TARGET_CONCURRENCY), so one hot CSV cannot take every
+  thread and starve the other campaigns.  Waiting webhooks cost a
+  coroutine, not a thread.  Webhooks admitted together still share one
+  download/merge/upload (group_commit.py), so the bound is also the
+  largest batch a target's write can take – keep it well above the
+  per-target rate × write time.
+* With WEBHOOK_ACK_MODE=spool the spool append (an fsync or a GCS
+  create) runs on the pool too, and the answer is "queued" as before.
+
+Tunables (environment):
+  ASGI_THREADS              handler threads            (default 256)
+  ASGI_TARGET_CONCURRENCY   in flight per CSV target   (default 192)
+"""
+
+import asyncio
+import contextvars
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import coldstart
+import router_webhook
+import spans
+
+with coldstart.timed("import functions_framework.aio", kind="import"):
+    import functions_framework.aio
+
+THREADS = int(os.getenv("ASGI_THREADS", "256"))
+TARGET_CONCURRENCY = int(os.getenv("ASGI_TARGET_CONCURRENCY", "192"))
+
+_executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix="asgi-handler")
+_limits: Dict[Hashable, asyncio.Semaphore] = {}
+_stats = {
+    "requests": 0,
+    "inflight": 0,       # received, not yet answered
+    "peak_inflight": 0,
+    "waiting": 0,        # held back by their target's semaphore right now
+    "waited": 0,         # ever held back
+}
+
+
+def stats() -> Dict[str, int]:
+    return dict(_stats)
+
+
+class _Request:
+    """The parts of a flask.Request the router reads, over an already-read body."""
+
+    def __init__(self, method: str, content_type: str, body: bytes):
+        self.method = method
+        self.mimetype = content_type.split(";", 1)[0].strip().lower()
+        self.content_length = len(body)
+        self._body = body
+
+    @property
+    def is_json(self) -> bool:
+        # werkzeug: application/json or application/*+json
+        return self.mimetype == "application/json" or (
+            self.mimetype.startswith("application/") and self.mimetype.endswith("+json")
+        )
+
+    def get_json(self, silent: bool = False):
+        try:
+            return json.loads(self._body)
+        except ValueError:
+            if silent:
+                return None
+            raise
+
+    def get_data(self) -> bytes:
+        return self._body
+
+
+async def _in_thread(fn: Callable, *args):
+    """Run `fn` on the handler pool in a copy of the current context (spans.current())."""
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_executor, ctx.run, fn, *args)
+
+
+def _target(agent_id: str) -> Optional[Tuple[str, str]]:
+    """(bucket_name, csv_path) the agent's route writes, or None when it is not routed."""
+    route = router_webhook.ROUTES.route(agent_id)
+    if route is None:
+        return None
+    cfg, handle = route
+    pipe = getattr(handle, "__self__", None)  # pipeline and presets: the compiled engine
+    if pipe is not None and hasattr(pipe, "csv_path"):
+        return pipe.bucket_name, pipe.csv_path
+    return cfg.get("bucket_name") or cfg.get("bucket"), cfg.get("csv_path") or cfg.get("path")
+
+
+async def _route(request: _Request, trace) -> Tuple[str, int]:
+    webhook = router_webhook._validate(request, trace)
+    if not isinstance(webhook, router_webhook._Webhook):
+        return webhook
+
+    spool = router_webhook.SPOOL
+    if spool is not None and await _in_thread(spool.submit, request.get_data()):
+        return "queued", 200
+
+    # the lookup may load the table and compile routes (lazy mode, prewarm
+    # still holding the lock) – never on the event loop
+    key = await _in_thread(_target, webhook.agent_id)
+    if key is None:
+        return await _in_thread(router_webhook._dispatch, *webhook)  # logs the unmapped agent
+    sem = _limits.get(key)
+    if sem is None:
+        sem = _limits[key] = asyncio.Semaphore(TARGET_CONCURRENCY)
+    if sem.locked():
+        _stats["waited"] += 1
+    _stats["waiting"] += 1
+    try:
+        await sem.acquire()
+    finally:
+        _stats["waiting"] -= 1
+    try:
+        return await _in_thread(router_webhook._dispatch, *webhook)
+    finally:
+        sem.release()
+
+
+@functions_framework.aio.http
+async def retell_webhook_router_async(request):
+    """
+    retell_webhook_router on functions-framework's ASGI server
+    (`--asgi`); `request` is a starlette.requests.Request.
+    """
+    body = await request.body()
+    _stats["requests"] += 1
+    _stats["inflight"] += 1
+    _stats["peak_inflight"] = max(_stats["peak_inflight"], _stats["inflight"])
+    try:
+        with spans.request() as trace:
+            result = await _route(_Request(request.method, request.headers.get("content-type", ""), body), trace)
+            if trace is not None:
+                await _in_thread(router_webhook._report_timing, trace, result[1])
+    finally:
+        _stats["inflight"] -= 1
+    return result
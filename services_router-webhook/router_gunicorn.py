@@ -0,0 +1,199 @@
+"""
+router_gunicorn.py
+─────────────────────────────────────────────────────────────
+Multi-process server profile for the webhook router on our own VM.
+
+`functions-framework` runs one gunicorn worker, and its WORKERS=N
+imports the function in the master before forking – the spool's slot
+lock and the sinks' threads do not survive that.  This profile runs N
+gthread workers that each import the router themselves:
+
+  gunicorn -c gunicorn.conf.py router_gunicorn:app
+
+(WORKERS, default one per CPU, and THREADS per worker; see
+gunicorn.conf.py.)  The workers share the host through ROUTER_RUN_DIR:
+
+* Writes: GROUP_COMMIT_LOCK_DIR defaults to ROUTER_RUN_DIR/locks, so a
+  target's CSV flush (group_commit.py) holds a per-target file lock
+  across workers.  Workers take turns instead of losing generation
+  races to each other, and each worker's batch keeps growing while
+  another one writes.
+* Spool: with WEBHOOK_ACK_MODE=spool every worker locks its own slot
+  of the one WEBHOOK_SPOOL_DIR; a worker gunicorn replaces replays its
+  predecessor's slot, and a live worker adopts slots nobody reclaims
+  (webhook_spool.py).
+* Stats: each worker publishes its counters – requests, in flight,
+  statuses, group commit, GCS write retries, spool – to
+  ROUTER_RUN_DIR/stats/worker-<pid>.json every ROUTER_STATS_S.
+  `GET /_stats` on any worker answers with every live worker's and
+  the host total.
+
+Tunables (environment):
+  ROUTER_RUN_DIR    lock and stats files shared by the workers
+                    (default /tmp/retell-router)
+  ROUTER_STATS_S    stats publish interval, seconds  (default 5)
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List
+
+RUN_DIR = os.getenv("ROUTER_RUN_DIR", "/tmp/retell-router")
+STATS_DIR = os.path.join(RUN_DIR, "stats")
+STATS_INTERVAL = float(os.getenv("ROUTER_STATS_S", "5"))
+STATS_PATH = "/_stats"
+
+# before the router (and group_commit.py) is imported
+os.environ.setdefault("GROUP_COMMIT_LOCK_DIR", os.path.join(RUN_DIR, "locks"))
+
+import coldstart  # noqa: E402
+
+with coldstart.timed("import functions_framework", kind="import"):
+    import functions_framework  # noqa: E402
+
+
+# ─────────────────────────── worker stats ───────────────────────────
+def _merge(total: Dict[str, Any], part: Dict[str, Any]) -> None:
+    """Add `part` into `total`: numbers are summed, max_* / peak_* take the max."""
+    for name, value in part.items():
+        if isinstance(value, dict):
+            _merge(total.setdefault(name, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            if name.startswith(("max_", "peak_")):
+                total[name] = max(total.get(name, 0), value)
+            else:
+                total[name] = total.get(name, 0) + value
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _WorkerStats:
+    """
+    WSGI middleware around the router: counts this worker's requests
+    and publishes them with the modules' own stats; serves GET /_stats.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        self._pid = None
+        self._started = time.time()
+        self._stats = {"requests": 0, "inflight": 0, "peak_inflight": 0, "busy_ms": 0, "statuses": {}}
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") == STATS_PATH and environ.get("REQUEST_METHOD") == "GET":
+            body = json.dumps(self.host_stats(), default=str).encode("utf-8")
+            start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+            return [body]
+
+        self._start_publisher()
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["inflight"] += 1
+            self._stats["peak_inflight"] = max(self._stats["peak_inflight"], self._stats["inflight"])
+        status = []
+
+        def record_status(line, headers, exc_info=None):
+            status.append(line[:1] + "xx")
+            return start_response(line, headers, exc_info)
+
+        t0 = time.perf_counter()
+        try:
+            return self.app(environ, record_status)
+        finally:
+            with self._lock:
+                self._stats["inflight"] -= 1
+                self._stats["busy_ms"] += int((time.perf_counter() - t0) * 1000)
+                statuses = self._stats["statuses"]
+                for cls in status or ["5xx"]:
+                    statuses[cls] = statuses.get(cls, 0) + 1
+
+    # ─── publishing ───
+    def _start_publisher(self) -> None:
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()  # once per process, also after a fork
+        os.makedirs(STATS_DIR, exist_ok=True)
+        threading.Thread(target=self._publish_loop, name="worker-stats", daemon=True).start()
+        atexit.register(self._unpublish)
+
+    def _path(self, pid: int) -> str:
+        return os.path.join(STATS_DIR, f"worker-{pid}.json")
+
+    def worker_stats(self) -> Dict[str, Any]:
+        import router_webhook  # loaded by create_app below
+
+        with self._lock:
+            out = json.loads(json.dumps(self._stats))
+        out.update(pid=os.getpid(), started=self._started, published=time.time())
+        gcs_csv = coldstart.import_module("gcs_csv")
+        out["group_commit"] = gcs_csv.group_commit_stats()
+        out["gcs_write"] = gcs_csv.retry_stats()
+        if router_webhook.SPOOL is not None:
+            out["webhook_spool"] = router_webhook.SPOOL.stats()
+        return out
+
+    def _publish(self) -> None:
+        path = self._path(os.getpid())
+        try:
+            with open(path + ".tmp", "w") as fh:
+                json.dump(self.worker_stats(), fh, default=str)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"router_gunicorn: publishing worker stats failed: {e}")
+
+    def _publish_loop(self) -> None:
+        while True:
+            self._publish()
+            time.sleep(STATS_INTERVAL)
+
+    def _unpublish(self) -> None:
+        try:
+            os.remove(self._path(os.getpid()))
+        except OSError:
+            pass
+
+    # ─── reading ───
+    def host_stats(self) -> Dict[str, Any]:
+        """Every live worker's last published stats (this one's current), and their sum."""
+        workers: List[Dict[str, Any]] = [self.worker_stats()]
+        try:
+            names = os.listdir(STATS_DIR)
+        except FileNotFoundError:
+            names = []
+        for name in sorted(names):
+            if not (name.startswith("worker-") and name.endswith(".json")):
+                continue
+            pid = int(name[len("worker-"):-len(".json")])
+            if pid == os.getpid() or not _alive(pid):
+                continue
+            try:
+                with open(os.path.join(STATS_DIR, name)) as fh:
+                    workers.append(json.load(fh))
+            except (OSError, ValueError):
+                continue  # being replaced or removed right now
+        total: Dict[str, Any] = {}
+        for worker in workers:
+            _merge(total, {k: v for k, v in worker.items() if k not in ("pid", "started", "published")})
+        return {"workers": sorted(workers, key=lambda w: w["pid"]), "total": total}
+
+
+app = _WorkerStats(
+    functions_framework.create_app(
+        "retell_webhook_router", os.path.join(os.path.dirname(os.path.abspath(__file__)), "router_webhook.py")
+    )
+)
@@ -4,12 +4,38 @@ router_webhook.py
 Single Cloud‑Function entry point for all Retell webhooks.
 
 * Validates the inbound JSON.
-* Looks up `agent_id` in AGENT_CONFIGS.
-* Dynamically imports the designated module
-  and calls module.handle(payload, call, config).
-* Each handler module owns its own HEADERS, build_row(),
-  Firestore / CSV logic, etc., but can be overridden by the
-  per-agent config.
+* Looks up `agent_id` in the routing table (routing_table.py):
+  DEFAULT_AGENT_CONFIGS overlaid with AGENT_CONFIG_URI, re-checked
+  in the background every ROUTER_CONFIG_TTL_S with a
+  generation-conditional GET and swapped atomically.  Every route
+  is resolved (module imported / pipeline compiled) before the
+  table is published, so dispatch never imports on the request path.
+* `"handler": "pipeline"` runs the shared schema-driven engine
+  (pipeline.py), compiled once per agent_config entry – columns,
+  sinks, dedupe key and Firestore on/off all come from the config.
+* Any other value is a module path that is imported once and
+  called as module.handle(payload, call, config)
+  (handlers.core / football / client_template are presets over
+  the same engine).
+
+Cold start (ROUTER_STARTUP_MODE):
+  prewarm (default) – Cloud clients, the GCS routing table and every
+                      routed handler are loaded on a background
+                      thread; the first request only waits for what
+                      it actually needs.
+  lazy              – nothing is loaded until a request needs it.
+  eager             – legacy: everything loaded before serving.
+The per-module timing breakdown is logged once as "cold-start report"
+and available from coldstart.report().
+
+Per-request timing (spans.py): parse_json, route, handler and the
+stages below it (build_row, gcs_download, csv_merge, gcs_upload,
+bq_insert, firestore_*, …) with byte counts.  Every _log_struct
+record of a request carries them as `timing`; successful requests get
+a "webhook timing" record only when slower than WEBHOOK_SLOW_MS or
+sampled by WEBHOOK_TRACE_SAMPLE.  Per-agent histograms are logged as
+"stage histograms" every WEBHOOK_SPANS_REPORT_S.  WEBHOOK_SPANS=off
+disables it all.
 
 Deploy as a 1st‑gen or 2nd‑gen Cloud Function with:
   gcloud functions deploy retell-webhook \
@@ -17,17 +43,58 @@ Deploy as a 1st‑gen or 2nd‑gen Cloud Function with:
      --entry-point retell_webhook_router \
      --trigger-http \
      --region us-central1
+
+Backfills go to the same source deployed with
+`--entry-point retell_webhook_bulk` (bulk.py), or run
+`python bulk.py events.ndjson` with credentials.  Routes with a
+parquet_prefix are compacted by `--entry-point retell_parquet_compact`
+on a Cloud Scheduler job (gcs_parquet.py).  `--entry-point
+retell_webhook_feed` serves "rows since cursor N" for routes with
+"storage_mode": "feed" (gcs_feed.py).  Those rows are lead PII: callers
+must send WEBHOOK_FEED_TOKEN in an X-Feed-Token header, and the entry
+point refuses every request while the token is unset.  Deploy it with
+--no-allow-unauthenticated as well; WEBHOOK_FEED_AUTH=iam drops the
+token check for a deployment that relies on that invoker IAM alone.
+
+WEBHOOK_ACK_MODE=spool answers a valid webhook with 200 as soon as
+its body is in a durable spool and dispatches it from a worker pool
+(webhook_spool.py); the default is to answer after the handler.
+`retell_webhook_router_async` serves the same router from
+functions-framework's ASGI server, with bounded in-flight webhooks
+per CSV target (router_asgi.py, `--asgi`).  On our own VM,
+`gunicorn -c gunicorn.conf.py router_gunicorn:app` runs it in several
+worker processes that coordinate their writes (router_gunicorn.py).
 """
 
-import importlib
+import hmac
 import json
 import os
+import random
+import sys
+import time
 import traceback
-from typing import Callable, Dict
+from typing import Callable, Dict, NamedTuple
+
+import clients
+import coldstart
+import routing_table
+import spans
+import webhook_spool
 
-import functions_framework
-from google.cloud import logging  # optional but recommended
-from google.cloud import storage
+with coldstart.timed("import functions_framework", kind="import"):
+    import functions_framework
+
+STARTUP_MODE = os.getenv("ROUTER_STARTUP_MODE", "prewarm").lower()
+
+# Per-stage timing (spans.py) – every _log_struct record of a request
+# carries its stages; these decide when a successful request gets one.
+SLOW_MS = float(os.getenv("WEBHOOK_SLOW_MS", "5000"))          # 0 = never
+TRACE_SAMPLE = float(os.getenv("WEBHOOK_TRACE_SAMPLE", "0"))   # 0…1
+HISTOGRAM_REPORT_S = float(os.getenv("WEBHOOK_SPANS_REPORT_S", "300"))  # 0 = never
+
+# retell_webhook_feed returns lead rows – shared secret unless IAM guards it
+FEED_TOKEN = os.getenv("WEBHOOK_FEED_TOKEN", "")
+FEED_AUTH = os.getenv("WEBHOOK_FEED_AUTH", "token").lower()    # token | iam
 
 # ────────────────────────────────────────────────────────────
 # 1)  ROUTING TABLE  – add / remove lines as campaigns change
@@ -35,7 +102,7 @@ from google.cloud import storage
 # Optional: GCS URI "bucket/path/to/agent_config.json"
 AGENT_CONFIG_URI = os.getenv("AGENT_CONFIG_URI", "")
 
-# Default fallback configs; will be replaced if AGENT_CONFIG_URI is provided
+# Built-in routes; entries from AGENT_CONFIG_URI are layered on top
 DEFAULT_AGENT_CONFIGS: Dict[str, Dict] = {
     # ------- Core agents (Firestore + CSV) -------
     "agent_ac2199cdcb5af27a4e0684035e": {
@@ -71,44 +138,22 @@ DEFAULT_AGENT_CONFIGS: Dict[str, Dict] = {
     },
 }
 
-AGENT_CONFIGS: Dict[str, Dict] = DEFAULT_AGENT_CONFIGS.copy()
-
 
 # ────────────────────────────────────────────────────────────
-# 2)  OPTIONAL – Cloud Logging for better observability
-#     Comment these three lines out if you don't need them.
+# 2)  OPTIONAL – Cloud Logging for better observability
+#     Clients come from the shared registry in clients.py and are
+#     built on first use (or by the prewarm thread).
 # ────────────────────────────────────────────────────────────
-_log_client = logging.Client()
-_log = _log_client.logger("retell-router")
+_handles: Dict[str, Callable[[dict, dict, dict], None]] = {}
 
-# Initialise a storage client for optional dynamic config
-try:
-    _storage_client = storage.Client(project=os.getenv("GCP_PROJECT", "retell-calling"))
-except Exception as exc:  # pragma: no cover
-    _storage_client = None
-    print(f"router-webhook: storage client init failed: {exc}")
 
-
-def _load_handlers_from_gcs(uri: str) -> Dict[str, Dict]:
-    """Return {agent_id: full_config_dict} loaded from GCS JSON."""
-    if not (uri and _storage_client):
-        return None
-    try:
-        bucket, path = uri.split("/", 1)
-        blob = _storage_client.bucket(bucket).blob(path)
-        data = json.loads(blob.download_as_text())
-        # Return the entire config for each agent that has a handler defined
-        return {
-            aid: cfg for aid, cfg in data.get("agents", {}).items() if "handler" in cfg
-        }
-    except Exception as exc:  # pragma: no cover - best effort
-        print(f"router-webhook: failed to load handler config from {uri}: {exc}")
-        return None
+def _logger():
+    return clients.logger("retell-router")
 
 
-_dynamic_configs = _load_handlers_from_gcs(AGENT_CONFIG_URI)
-if _dynamic_configs:
-    AGENT_CONFIGS.update(_dynamic_configs)
+def _storage():
+    """Storage client for optional dynamic config (None if init failed)."""
+    return clients.storage()
 
 
 # ────────────────────────────────────────────────────────────
@@ -116,42 +161,192 @@ if _dynamic_configs:
 # ────────────────────────────────────────────────────────────
 def _import_handle(modpath: str) -> Callable[[dict, dict, dict], None]:
     """
-    Dynamically import `modpath` and return its `handle` function.
+    Import `modpath` (timed, first time only) and return its `handle` function.
     Raises AttributeError if the function is missing.
     """
-    module = importlib.import_module(modpath)
+    handle = _handles.get(modpath)
+    if handle is not None:
+        return handle
+    module = coldstart.import_module(modpath)
     try:
-        return getattr(module, "handle")
+        handle = getattr(module, "handle")
     except AttributeError as exc:  # pragma: no cover
         raise AttributeError(
             f"Module {modpath!r} must expose a top‑level `handle(payload, call, config)`"
         ) from exc
+    _handles[modpath] = handle
+    return handle
+
+
+def _parse_agents(data: dict) -> Dict[str, Dict]:
+    """The entire config for each agent in agent_config.json that has a handler."""
+    return {aid: cfg for aid, cfg in data.get("agents", {}).items() if "handler" in cfg}
+
+
+def _resolve_route(agent_id: str, cfg: Dict) -> Callable[[dict, dict, dict], None]:
+    """What dispatch calls for this routing entry – resolved at table load."""
+    modpath = cfg["handler"]
+    if modpath == "pipeline":
+        return coldstart.import_module("pipeline").get(cfg).handle
+    module = coldstart.import_module(modpath)
+    # presets over the pipeline bind their compiled engine up front
+    bind = getattr(module, "for_config", None)
+    return bind(cfg) if bind is not None else _import_handle(modpath)
+
+
+ROUTES = routing_table.RoutingTable(
+    AGENT_CONFIG_URI,
+    DEFAULT_AGENT_CONFIGS,
+    _storage,
+    parse=_parse_agents,
+    resolve=_resolve_route,
+)
+
+
+def _load_routes() -> None:
+    with coldstart.timed("load routing table"):
+        ROUTES.load()
 
 
 def _log_struct(severity: str, message: str, **kwargs) -> None:
-    """Helper for structured logging that appears in Cloud Logging."""
-    _log.log_struct(
+    """Helper for structured logging that appears in Cloud Logging."""
+    trace = spans.current()
+    if trace is not None:
+        kwargs.setdefault("timing", trace.summary())
+    log = _logger()
+    if log is None:
+        print(f"router-webhook [{severity}] {message} {kwargs}")
+        return
+    log.log_struct(
         {"message": message, **kwargs},
         severity=severity,
     )
 
 
+def _failure_stats() -> Dict[str, object]:
+    """
+    Counters for the handler-failure log, from the modules and sinks that
+    already exist – never imports a module, builds a sink or starts a
+    thread, and never raises (the 500 must still go out).
+    """
+    out: Dict[str, object] = {}
+    for field, module, attr in (
+        ("gcs_write_stats", "gcs_csv", None),
+        ("bq_sink_stats", "bq_sink", "_sink"),
+        ("idempotency_stats", "idempotency", "_guard"),
+        ("lead_sink_stats", "lead_sink", "_sink"),
+    ):
+        try:
+            mod = sys.modules.get(module)
+            if mod is None:
+                continue
+            if attr is None:
+                out[field] = mod.retry_stats()
+            elif getattr(mod, attr, None) is not None:
+                out[field] = getattr(mod, attr).stats()
+        except Exception as e:
+            out[field] = f"unavailable: {e}"
+    try:
+        out["webhook_spool_stats"] = SPOOL.stats() if SPOOL is not None else None
+    except Exception as e:
+        out["webhook_spool_stats"] = f"unavailable: {e}"
+    return out
+
+
+def _warm_clients() -> None:
+    # Heavy client libraries first so each handler's own import cost shows
+    # up separately in the report.
+    for mod in ("google.cloud.storage", "google.cloud.bigquery", "google.cloud.logging"):
+        coldstart.import_module(mod)
+    for kind, build in (
+        ("storage", clients.storage),
+        ("bigquery", clients.bigquery),
+        ("logging", _logger),
+    ):
+        with coldstart.timed(f"{kind} client"):
+            build()
+
+
+def _report_startup() -> None:
+    coldstart.mark_warm()
+    report = coldstart.report()
+    print(f"router-webhook: cold-start report {json.dumps(report)}")
+    try:
+        _log_struct("INFO", "cold-start report", mode=STARTUP_MODE, **report)
+    except Exception as exc:  # pragma: no cover - logging is optional
+        print(f"router-webhook: could not log cold-start report: {exc}")
+
+
+if STARTUP_MODE == "eager":
+    _warm_clients()
+    _load_routes()
+    _report_startup()
+elif STARTUP_MODE != "lazy":
+    coldstart.prewarm(_warm_clients, _load_routes, _report_startup)
+
+
 # ────────────────────────────────────────────────────────────
 # 4)  CLOUD‑FUNCTION ENTRY POINT
 # ────────────────────────────────────────────────────────────
+_last_histogram_report = time.monotonic()
+
+
+def _report_timing(trace: spans.Trace, status: int) -> None:
+    """Timing record for slow / sampled requests, and periodic histograms."""
+    global _last_histogram_report
+    elapsed = trace.elapsed_ms()
+    slow = bool(SLOW_MS) and elapsed >= SLOW_MS
+    if slow or (TRACE_SAMPLE and random.random() < TRACE_SAMPLE):
+        _log_struct(
+            "WARNING" if slow else "INFO",
+            "webhook timing",
+            agent_id=trace.agent_id,
+            status=status,
+        )
+    if HISTOGRAM_REPORT_S and time.monotonic() - _last_histogram_report >= HISTOGRAM_REPORT_S:
+        _last_histogram_report = time.monotonic()
+        _log_struct("INFO", "stage histograms", histograms=spans.histograms())
+
+
 @functions_framework.http
 def retell_webhook_router(request):
     """
     Cloud Functions (Python) HTTP handler.
     """
+    with spans.request() as trace:
+        result = _route_webhook(request, trace)
+        if trace is not None:
+            _report_timing(trace, result[1])
+    return result
+
+
+class _Webhook(NamedTuple):
+    payload: dict
+    call: dict
+    agent_id: str
+
+
+def _route_webhook(request, trace):
+    webhook = _validate(request, trace)
+    if not isinstance(webhook, _Webhook):
+        return webhook
 
+    # -------- Ack-first: spool it, a worker dispatches (webhook_spool.py) --------
+    if SPOOL is not None and SPOOL.submit(request.get_data()):
+        return "queued", 200
+    return _dispatch(*webhook)
+
+
+def _validate(request, trace):
+    """The _Webhook to dispatch, or the (body, status) to answer instead."""
     # -------- Basic HTTP / JSON validation --------
     if request.method != "POST":
         return "method not allowed – use POST", 405
     if not request.is_json:
         return "content‑type must be application/json", 400
 
-    payload: dict = request.get_json(silent=True) or {}
+    with spans.span("parse_json", request.content_length or 0):
+        payload: dict = request.get_json(silent=True) or {}
     if payload.get("event") != "call_analyzed":
         return "event ignored", 200
 
@@ -160,10 +355,16 @@ def retell_webhook_router(request):
 
     if not agent_id:
         return "missing agent_id", 400
+    if trace is not None:
+        trace.agent_id = agent_id
+    return _Webhook(payload, call, agent_id)
 
+
+def _dispatch(payload: dict, call: dict, agent_id: str):
     # -------- Routing --------
-    agent_config = AGENT_CONFIGS.get(agent_id)
-    if agent_config is None:
+    with spans.span("route"):
+        route = ROUTES.route(agent_id)
+    if route is None:
         _log_struct(
             "WARNING",
             "Unmapped agent – dropping payload",
@@ -172,11 +373,15 @@ def retell_webhook_router(request):
         )
         return "agent not routed", 200
 
-    # -------- Dynamic dispatch to handler --------
+    # -------- Dispatch to the pre-resolved handler --------
+    agent_config, handle = route
     try:
-        modpath = agent_config["handler"]
-        handle = _import_handle(modpath)
-        handle(payload, call, agent_config)  # <-- your per‑agent logic
+        if isinstance(handle, Exception):
+            raise handle  # import / compile failed when the table loaded
+        with spans.span("handler"):
+            handle(payload, call, agent_config)  # <-- your per‑agent logic
+        if STARTUP_MODE == "lazy" and not coldstart.is_warm():
+            _report_startup()
         return "ok", 200
 
     except Exception as exc:  # pragma: no cover
@@ -188,6 +393,102 @@ def retell_webhook_router(request):
             call_id=call.get("call_id"),
             error=str(exc),
             traceback=traceback.format_exc(),
+            **_failure_stats(),
         )
         # Returning 500 allows Retell to retry the webhook.
-        return "handler failed", 500
\ No newline at end of file
+        return "handler failed", 500
+
+
+def _process_spooled(body: bytes) -> None:
+    """Spool worker: dispatch one acked webhook; raising has the spool retry it."""
+    payload = json.loads(body)
+    call = payload.get("data") or payload.get("call", {})
+    with spans.request(call.get("agent_id")) as trace:
+        message, status = _dispatch(payload, call, call.get("agent_id", ""))
+        if trace is not None:
+            _report_timing(trace, status)
+    if status >= 500:
+        raise RuntimeError(message)
+
+
+SPOOL = (
+    webhook_spool.get_spool(_process_spooled, clients.storage)
+    if webhook_spool.ACK_MODE == "spool"
+    else None
+)
+
+
+@functions_framework.http
+def retell_webhook_bulk(request):
+    """
+    Bulk variant for backfills / re-sends: POST a JSON array or NDJSON of
+    call_analyzed payloads.  Events are grouped per routed target (see
+    bulk.py); the response reports every event's outcome.
+    """
+    if request.method != "POST":
+        return "method not allowed – use POST", 405
+
+    bulk = coldstart.import_module("bulk")
+    try:
+        events = bulk.parse_events(request.get_data())
+    except ValueError as exc:
+        return f"invalid body: {exc}", 400
+
+    with spans.request("_bulk"):
+        results = bulk.ingest(events, ROUTES.route)
+    # the instance may be throttled once the response is sent
+    coldstart.import_module("bq_sink").get_sink(clients.bigquery).flush()
+    body = {"summary": bulk.summarize(results), "results": results}
+    return json.dumps(body), 200, {"Content-Type": "application/json"}
+
+
+@functions_framework.http
+def retell_parquet_compact(request):
+    """
+    Scheduled compaction of the Parquet sinks (gcs_parquet.py) of every
+    routed pipeline; ?min_parts=N overrides PARQUET_COMPACT_MIN_PARTS.
+    """
+    min_parts = request.args.get("min_parts", type=int)
+    report = coldstart.import_module("pipeline").compact_parquet(ROUTES.snapshot().routes, min_parts)
+    _log_struct("INFO", "parquet compaction", report=report)
+    return json.dumps(report), 200, {"Content-Type": "application/json"}
+
+
+@functions_framework.http
+def retell_webhook_feed(request):
+    """
+    GET ?bucket=…&path=…&since=N[&max_rows=M] → the rows appended to that
+    target's change feed from cursor N on (gcs_feed.read_since); pass the
+    returned `next` as `since` on the following call.  Only targets of
+    routes with "storage_mode": "feed" are served, and only to callers
+    with the X-Feed-Token (see the module docstring).
+    """
+    if FEED_AUTH != "iam":
+        if not FEED_TOKEN:
+            return "feed disabled – set WEBHOOK_FEED_TOKEN", 403
+        offered = request.headers.get("X-Feed-Token", "")
+        if not hmac.compare_digest(offered.encode("utf-8"), FEED_TOKEN.encode("utf-8")):
+            return "forbidden", 403
+
+    bucket_name, csv_path = request.args.get("bucket", ""), request.args.get("path", "")
+    since = request.args.get("since", 0, type=int)
+    max_rows = request.args.get("max_rows", type=int)
+
+    pipeline = coldstart.import_module("pipeline")
+    feeds = {
+        (target.bucket_name, target.csv_path)
+        for _, handle in ROUTES.snapshot().routes.values()
+        for target in [getattr(handle, "__self__", None)]
+        if isinstance(target, pipeline.Pipeline) and target.storage_mode == "feed"
+    }
+    if (bucket_name, csv_path) not in feeds:
+        return "unknown feed – bucket/path must belong to a routed feed target", 404
+    if since < 0:
+        return "since must be >= 0", 400
+
+    storage_client = _storage()
+    if storage_client is None:
+        return "storage unavailable", 503
+    feed = coldstart.import_module("gcs_feed")
+    body = feed.read_since(storage_client.bucket(bucket_name), csv_path, since, max_rows)
+    return json.dumps(body), 200, {"Content-Type": "application/json"}
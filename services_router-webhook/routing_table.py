@@ -0,0 +1,202 @@
+"""
+routing_table.py
+─────────────────────────────────────────────────────────────
+Hot-reloadable agent routing table backed by AGENT_CONFIG_URI.
+
+The table used to be read once at import, so onboarding a campaign
+needed a redeploy (or a forced cold start).  Now:
+
+* the first `load()` fetches agent_config.json and pre-resolves every
+  route (handler imported / pipeline compiled) before it is published;
+* afterwards, any lookup made more than ROUTER_CONFIG_TTL_S after the
+  last check kicks off a background refresh (stale-while-revalidate –
+  the request itself never waits);
+* refreshes are generation-conditional GETs (`if_generation_not_match`),
+  so an unchanged file costs a 304 and no body transfer;
+* a new table is built and resolved off to the side and published with
+  a single reference swap – a request works from one consistent
+  snapshot from lookup to dispatch.
+
+A failed or malformed fetch keeps the current table.
+"""
+
+import json
+import os
+import threading
+import time
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+from google.api_core.exceptions import NotFound, NotModified
+
+TTL = float(os.getenv("ROUTER_CONFIG_TTL_S", "60"))
+
+Route = Tuple[Dict[str, Any], Any]  # (agent config, resolved handle)
+
+
+class Snapshot:
+    """One immutable published version of the table."""
+
+    __slots__ = ("configs", "routes", "generation", "loaded_at")
+
+    def __init__(self, configs: Dict[str, Dict], routes: Dict[str, Route], generation: Optional[int]):
+        self.configs: Mapping[str, Dict] = MappingProxyType(configs)
+        self.routes: Mapping[str, Route] = MappingProxyType(routes)
+        self.generation = generation
+        self.loaded_at = time.time()
+
+
+def _agents(data: dict) -> Dict[str, Dict]:
+    return data.get("agents", {})
+
+
+class RoutingTable:
+    """
+    `storage_factory()` returns a storage client (or None).
+    `parse(data)` turns the decoded JSON into {agent_id: config}.
+    `resolve(agent_id, config)` returns whatever dispatch needs (e.g. the
+    handle function); an exception raised there is stored in its place.
+    With `merge_defaults` the GCS entries are layered over `defaults`,
+    otherwise they replace them.
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        defaults: Dict[str, Dict],
+        storage_factory: Callable[[], Any],
+        parse: Callable[[dict], Dict[str, Dict]] = _agents,
+        resolve: Callable[[str, Dict], Any] = None,
+        merge_defaults: bool = True,
+        ttl: float = TTL,
+    ):
+        self.uri = uri
+        self.defaults = dict(defaults)
+        self._storage_factory = storage_factory
+        self._parse = parse
+        self._resolve = resolve
+        self.merge_defaults = merge_defaults
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._checked_at = 0.0
+        self._snap: Optional[Snapshot] = None
+        # last generation downloaded, published or not – a broken file is
+        # not re-downloaded every TTL
+        self._seen_generation: Optional[int] = None
+        self._stats = {"checks": 0, "not_modified": 0, "reloads": 0, "errors": 0}
+
+    # ───────────────────────── Reads ─────────────────────────
+    def snapshot(self) -> Snapshot:
+        snap = self._snap
+        if snap is None:
+            snap = self.load()
+        elif self.uri and time.monotonic() - self._checked_at > self.ttl:
+            self._refresh_in_background()
+        return snap
+
+    def route(self, agent_id: str) -> Optional[Route]:
+        """(config, resolved) for `agent_id`, or None if it is not routed."""
+        return self.snapshot().routes.get(agent_id)
+
+    def configs(self) -> Mapping[str, Dict]:
+        return self.snapshot().configs
+
+    def stats(self) -> Dict[str, Any]:
+        snap = self._snap
+        return {
+            **self._stats,
+            "agents": len(snap.configs) if snap else 0,
+            "generation": snap.generation if snap else None,
+        }
+
+    # ───────────────────────── Loading ───────────────────────
+    def load(self) -> Snapshot:
+        """Synchronous (re)load – used for the first table and by tests."""
+        with self._lock:
+            if self._snap is None or self._snap_is_stale():
+                self._reload()
+            return self._snap
+
+    def _snap_is_stale(self) -> bool:
+        return bool(self.uri) and time.monotonic() - self._checked_at > self.ttl
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                with self._lock:
+                    self._reload()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="routing-refresh", daemon=True).start()
+
+    def _fetch(self) -> Tuple[Optional[dict], Optional[int]]:
+        """(decoded JSON, generation); (None, None) if unchanged."""
+        current = self._seen_generation if self._snap else None
+        client = self._storage_factory()
+        if client is None:
+            raise RuntimeError("storage client unavailable")
+        bucket, path = self.uri.split("/", 1)
+        blob = client.bucket(bucket).blob(path)
+        self._stats["checks"] += 1
+        try:
+            if current is not None:
+                body = blob.download_as_bytes(if_generation_not_match=current)
+            else:
+                body = blob.download_as_bytes()
+        except NotModified:
+            self._stats["not_modified"] += 1
+            return None, None
+        self._seen_generation = blob.generation
+        return json.loads(body), blob.generation
+
+    def _reload(self) -> None:
+        # caller holds self._lock
+        self._checked_at = time.monotonic()
+        data, generation = None, None
+        if self.uri:
+            try:
+                data, generation = self._fetch()
+            except NotFound:
+                print(f"routing_table: {self.uri} not found – using built-in routes")
+                self._stats["errors"] += 1
+            except Exception as exc:
+                print(f"routing_table: failed to load {self.uri}: {exc}")
+                self._stats["errors"] += 1
+            if data is None and self._snap is not None:
+                return  # unchanged (304) or failed – keep serving the current table
+
+        configs = dict(self.defaults) if (self.merge_defaults or data is None) else {}
+        if data is not None:
+            try:
+                configs.update(self._parse(data))
+            except Exception as exc:
+                print(f"routing_table: malformed {self.uri}: {exc}")
+                self._stats["errors"] += 1
+                if self._snap is not None:
+                    return
+                configs = dict(self.defaults)
+
+        routes = {aid: (cfg, self._resolve_one(aid, cfg)) for aid, cfg in configs.items()}
+        self._snap = Snapshot(configs, routes, generation)  # atomic publish
+        self._stats["reloads"] += 1
+        print(
+            f"routing_table: {len(configs)} route(s) loaded"
+            + (f" from {self.uri} (generation {generation})" if generation else "")
+        )
+
+    def _resolve_one(self, agent_id: str, config: Dict) -> Any:
+        if self._resolve is None:
+            return None
+        try:
+            return self._resolve(agent_id, config)
+        except Exception as exc:
+            print(f"routing_table: route for {agent_id} failed to resolve: {exc}")
+            return exc
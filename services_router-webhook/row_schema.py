@@ -0,0 +1,145 @@
+"""
+row_schema.py
+─────────────────────────────────────────────────────────────
+Declarative CSV column specs, compiled once into a row extractor.
+
+A handler describes its CSV as data:
+
+    COLUMNS = [
+        Column("Phone",    "call",     ("to_number",), "phone"),
+        Column("DNC",      "analysis", ("_dnc", "_d_n_c"), "lower"),
+        Column("Zip",      "vars",     VAR_ALIASES["Zip"]),
+        Column("Processed"),                      # constant ""
+        ...
+    ]
+    HEADERS   = headers(COLUMNS)
+    build_row = compile_columns(COLUMNS, label="Core handler")
+
+Sources are the four dicts build_row has always received – `call`,
+`vars`, `analysis`, `cost` – or None for a constant.  The first alias
+present wins, otherwise `default` ("").  `analysis` keys are matched
+after str(k).strip() (Retell sometimes pads them); the other sources
+are matched exactly.
+
+Transforms:
+  None        value as-is
+  "lower"     str(value).lower()
+  "phone"     digits only, leading US "1" dropped
+  "datetime"  epoch s/ms → "YYYY-MM-DD HH:MM:SS" (local time), "" if invalid
+
+`dtype` only matters to typed sinks (gcs_parquet.py): "int", "float",
+"bool", "timestamp" or None.  None means "timestamp" for "datetime"
+columns and string for everything else; the CSV cell is unchanged.
+
+`compile_columns` generates one flat function (one dict literal, each
+cell a chain of `in` checks), so the analysis dict is normalised once
+per row instead of once per field.
+"""
+
+from datetime import datetime
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+SOURCES = ("call", "vars", "analysis", "cost")
+
+
+class Column(NamedTuple):
+    header: str
+    source: Optional[str] = None  # one of SOURCES, or None for a constant
+    keys: Tuple[str, ...] = ()
+    transform: Optional[str] = None
+    default: Any = ""
+    dtype: Optional[str] = None  # typed sinks only, see module docstring
+
+
+def headers(columns: Sequence[Column]) -> List[str]:
+    return [c.header for c in columns]
+
+
+# ───────────────────────── Transforms ──────────────────────────
+def normalize_phone(raw: str) -> str:
+    if not raw or not isinstance(raw, str):
+        return ""
+    digits = "".join(ch for ch in raw if ch.isdigit())
+    return digits[1:] if len(digits) == 11 and digits.startswith("1") else digits
+
+
+def get_valid_datetime(ts, label: str = "row_schema"):
+    try:
+        if ts and isinstance(ts, (int, float)):
+            if ts > 10 ** 12:  # ms → s
+                ts /= 1000
+        return datetime.fromtimestamp(ts)
+    except Exception as e:
+        print(f"{label} warning: bad timestamp {ts}: {e}")
+    return None
+
+
+def _lower(value: Any) -> str:
+    return str(value).lower()
+
+
+def _datetime_formatter(label: str) -> Callable[[Any], str]:
+    def fmt(ts: Any) -> str:
+        dt = get_valid_datetime(None if ts == "" else ts, label)
+        return dt.strftime("%Y-%m-%d %H:%M:%S") if dt else ""
+
+    return fmt
+
+
+# ───────────────────────── Compiler ────────────────────────────
+_SRC_VAR = {"call": "c", "vars": "v", "analysis": "a", "cost": "o"}
+
+
+def compile_columns(
+    columns: Sequence[Column], label: str = "row_schema"
+) -> Callable[[dict, dict, dict, dict], Dict[str, Any]]:
+    """Build `extract(call, vars_, analysis, cost) -> row dict` for `columns`."""
+    env: Dict[str, Any] = {
+        "_lower": _lower,
+        "_phone": normalize_phone,
+        "_datetime": _datetime_formatter(label),
+    }
+    transforms = {None: None, "lower": "_lower", "phone": "_phone", "datetime": "_datetime"}
+
+    cells = []
+    for i, col in enumerate(columns):
+        if col.transform not in transforms:
+            raise ValueError(f"{col.header!r}: unknown transform {col.transform!r}")
+        default = f"_d{i}"
+        env[default] = col.default
+
+        if col.source is None:
+            expr = default
+        elif col.source in _SRC_VAR:
+            var = _SRC_VAR[col.source]
+            keys = [k.strip() if col.source == "analysis" else k for k in col.keys]
+            # a["k1"] if "k1" in a else a["k2"] if "k2" in a else _dN
+            expr = default
+            for k in reversed(keys):
+                expr = f"{var}[{k!r}] if {k!r} in {var} else {expr}"
+        else:
+            raise ValueError(f"{col.header!r}: unknown source {col.source!r}")
+
+        fn = transforms[col.transform]
+        if fn is not None:
+            expr = f"{fn}({expr})"
+        cells.append(f"        {col.header!r}: {expr},")
+
+    src = "\n".join(
+        [
+            "def extract(call, vars_, analysis, cost):",
+            "    c = call if isinstance(call, dict) else {}",
+            "    v = vars_ if isinstance(vars_, dict) else {}",
+            "    a = {str(k).strip(): x for k, x in analysis.items()} if isinstance(analysis, dict) else {}",
+            "    o = cost if isinstance(cost, dict) else {}",
+            "    return {",
+            *cells,
+            "    }",
+        ]
+    )
+    code = compile(src, f"<row_schema:{label}>", "exec")
+    exec(code, env)
+    extract = env["extract"]
+    extract.__doc__ = f"Compiled row extractor for {len(columns)} columns ({label})."
+    extract.source = src
+    return extract